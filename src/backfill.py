@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Backfills the market history of every coin in CRYPTOS into the klines table.
+
+Every (symbol, interval) pair is walked from the coin's date_founded (binance
+starts at the listing date for coins founded before they were listed) up to
+now. Pairs are fetched concurrently while sharing one request weight budget,
+each page is written with one bulk insert and the position reached is
+checkpointed in the backfill_checkpoints table after every page, so an
+interrupted backfill picks up where it stopped when rerun.
+
+Usage:
+    python3 backfill.py                       # daily candles for all coins
+    python3 backfill.py --intervals 1h 1m --threads 8
+    python3 backfill.py --daily-tables        # also fill the per coin tables
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from cryptocurrencies import CRYPTOS
+from database_wrapper import DatabaseWrapper
+from kline_store import KlineStore
+from ornus_data_manager import DataManager
+from data_collection.rate_limiter import RateLimiter
+from data_collection.utilities import (INTERVAL_MILLISECONDS, error,
+                                       get_kline_pages)
+
+
+# Binance allows 1200 weight per minute per ip, leave some room for the
+# daily collection that may be running at the same time
+WEIGHT_PER_MINUTE = 1000
+NUM_THREADS = 8
+REPORT_INTERVAL = 10
+
+
+class BackfillCheckpoints:
+    """
+    Class for the backfill_checkpoints table which stores, per (symbol,
+    interval), the open time (ms) of the next candle to fetch
+    """
+
+    def __init__(self, database):
+        self._database = database
+
+
+    def create_table(self):
+        if "backfill_checkpoints" in self._database.show_tables():
+            return
+        self._database.execute("""
+CREATE TABLE backfill_checkpoints (
+    symbol VARCHAR(20) NOT NULL,
+    interval_name VARCHAR(4) NOT NULL,
+    next_open_time BIGINT UNSIGNED NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (symbol, interval_name)
+); """)
+
+
+    def get(self, symbol: str, interval: str):
+        """Returns the next open time to fetch, None if never started"""
+        result = self._database.query(
+            "SELECT next_open_time FROM backfill_checkpoints WHERE "
+            "symbol = '{0}' AND interval_name = '{1}'".format(symbol, interval))
+        return int(result[0][0]) if result else None
+
+
+    def set(self, symbol: str, interval: str, next_open_time: int):
+        self._database.execute(
+            "INSERT INTO backfill_checkpoints (symbol, interval_name, next_open_time) "
+            "VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE "
+            "next_open_time = VALUES(next_open_time)",
+            (symbol, interval, int(next_open_time)))
+
+
+    def reset(self):
+        self._database.execute("DELETE FROM backfill_checkpoints")
+
+
+class BackfillProgress:
+    """
+    Thread safe tally of the candles written which estimates how many
+    candles are left from the position of every job, used to print the
+    rows/sec and ETA of the backfill
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._rows = 0
+        self._remaining = dict()
+
+
+    def update(self, job, rows: int, next_open_time: int, interval: str):
+        now = int(time.time() * 1000)
+        with self._lock:
+            self._rows += rows
+            self._remaining[job] = max(now - next_open_time, 0) // \
+                INTERVAL_MILLISECONDS[interval]
+
+
+    def finish(self, job):
+        with self._lock:
+            self._remaining[job] = 0
+
+
+    def report(self) -> str:
+        with self._lock:
+            elapsed = max(time.time() - self._start, 1e-9)
+            rate = self._rows / elapsed
+            remaining = sum(self._remaining.values())
+        eta = remaining / rate if rate > 0 else float("inf")
+        return ("{0} candles written, {1:0.0f} rows/s, ~{2} candles left, "
+                "ETA {3}".format(self._rows, rate, remaining, _format_seconds(eta)))
+
+
+def backfill(coins=CRYPTOS, intervals=("1d",), num_threads=NUM_THREADS,
+             weight_per_minute=WEIGHT_PER_MINUTE, verbose=True) -> int:
+    """
+    Backfills the candles of every coin at every interval, returns the
+    number of candles written
+
+    :param coins: iterable of Cryptocurrency objects
+    :param intervals: iterable of keys of INTERVAL_MILLISECONDS
+    :param num_threads: int of how many (symbol, interval) pairs are fetched
+                        at the same time
+    :param weight_per_minute: float of the binance request weight budget
+                              shared by all threads
+    """
+    manager = DataManager(coins)
+    manager.create_tables()
+    manager.fill_cryptocurrency_table()
+    checkpoints = BackfillCheckpoints(DatabaseWrapper())
+    checkpoints.create_table()
+
+    jobs = list()
+    seen = set()
+    for coin in coins:
+        coin_id = manager.get_coin_id(coin.name)
+        for interval in intervals:
+            if coin_id is None or (coin.pairing(), interval) in seen:
+                continue
+            seen.add((coin.pairing(), interval))
+            jobs.append((coin, coin_id, interval))
+
+    limiter = RateLimiter(weight_per_minute)
+    progress = BackfillProgress()
+    finished = threading.Event()
+    if verbose:
+        reporter = threading.Thread(target=_report, args=(progress, finished))
+        reporter.daemon = True
+        reporter.start()
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = {executor.submit(_backfill_job, coin, coin_id, interval,
+                                   limiter, progress): (coin, interval)
+                   for coin, coin_id, interval in jobs}
+        num_rows = 0
+        for future, (coin, interval) in futures.items():
+            # A symbol binance doesn't list shouldn't stop the other coins,
+            # its checkpoint is kept so it resumes once the issue is fixed
+            try:
+                num_rows += future.result()
+            except Exception as e:
+                error("Backfill of {0} {1} failed: {2}".format(
+                    coin.pairing(), interval, e))
+    finished.set()
+    if verbose:
+        print(progress.report())
+    return num_rows
+
+
+def _backfill_job(coin, coin_id: int, interval: str, limiter, progress) -> int:
+    """Backfills a single (symbol, interval) pair, resuming from its checkpoint"""
+    # Database connections can't be shared between threads
+    database = DatabaseWrapper()
+    store = KlineStore(database)
+    checkpoints = BackfillCheckpoints(database)
+    symbol = coin.pairing()
+    job = (symbol, interval)
+
+    start_time = checkpoints.get(symbol, interval)
+    if start_time is None:
+        start_time = int(pd.Timestamp(coin.date_founded).value // 10 ** 6)
+    # The candle that is still open is left to the next run
+    end_time = int(time.time() * 1000) - INTERVAL_MILLISECONDS[interval]
+
+    num_rows = 0
+    for page in get_kline_pages(symbol, interval, start_time,
+                                end_time=end_time, rate_limiter=limiter):
+        rows = store.insert(coin_id, interval, page)
+        next_open_time = int(page["open_time"].iloc[-1]) + INTERVAL_MILLISECONDS[interval]
+        checkpoints.set(symbol, interval, next_open_time)
+        progress.update(job, rows, next_open_time, interval)
+        num_rows += rows
+    progress.finish(job)
+    return num_rows
+
+
+def fill_daily_tables(coins=CRYPTOS) -> int:
+    """
+    Fills the per coin market data tables with the backfilled daily candles,
+    converting altcoin prices from BTC to USD with the BTCUSDT candles of the
+    same day. Days that already have a row (and their sentiment) are left as
+    is, the sentiment columns of the new rows are NULL.
+    Returns how many rows were inserted.
+    """
+    manager = DataManager(coins)
+    store = KlineStore()
+    database = DatabaseWrapper()
+    bitcoin = next((coin for coin in coins if coin.ticker == "BTC"), None)
+    if bitcoin is None:
+        raise ValueError("The daily tables need BTC among the coins, its "
+                         "BTCUSDT candles convert the other coins' prices to USD")
+    btc_usd = store.read(manager.get_coin_id(bitcoin.name), "1d")
+
+    num_rows = 0
+    for coin in {coin.name: coin for coin in coins}.values():
+        candles = store.read(manager.get_coin_id(coin.name), "1d")
+        if candles.empty:
+            continue
+        prices = candles[["open", "high", "low", "close"]]
+        if coin.ticker != "BTC":
+            prices = prices.mul(btc_usd[["open", "high", "low", "close"]]).dropna()
+        rows = [(open_time.strftime("%Y-%m-%d"),) + tuple(float(price) for price in row) +
+                (float(candles.at[open_time, "volume"]),
+                 int(candles.at[open_time, "num_trades"]))
+                for open_time, row in zip(prices.index, prices.values)]
+        num_rows += database.executemany(
+            "INSERT IGNORE INTO `{0}` (date, open, high, low, close, volume, "
+            "num_trades) VALUES (%s, %s, %s, %s, %s, %s, %s)".format(coin.name),
+            rows)
+    return num_rows
+
+
+def _report(progress, finished):
+    while not finished.wait(REPORT_INTERVAL):
+        print(progress.report())
+
+
+def _format_seconds(seconds: float) -> str:
+    if seconds == float("inf"):
+        return "unknown"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{0}h{1:02d}m{2:02d}s".format(hours, minutes, seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Backfill the market history of every coin in CRYPTOS")
+    parser.add_argument("--intervals", nargs="+", default=["1d"],
+                        choices=list(INTERVAL_MILLISECONDS.keys()))
+    parser.add_argument("--threads", type=int, default=NUM_THREADS)
+    parser.add_argument("--weight-per-minute", type=float,
+                        default=WEIGHT_PER_MINUTE)
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore the checkpoints and start over")
+    parser.add_argument("--daily-tables", action="store_true",
+                        help="also fill the per coin tables from the 1d candles")
+    args = parser.parse_args()
+
+    if args.restart:
+        checkpoints = BackfillCheckpoints(DatabaseWrapper())
+        checkpoints.create_table()
+        checkpoints.reset()
+    intervals = list(args.intervals)
+    if args.daily_tables and "1d" not in intervals:
+        intervals.append("1d")
+    backfill(intervals=intervals, num_threads=args.threads,
+             weight_per_minute=args.weight_per_minute)
+    if args.daily_tables:
+        print("Inserted", fill_daily_tables(), "rows into the per coin tables")
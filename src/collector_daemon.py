@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Long running collector that keeps its resources warm between runs.
+
+daily_data.py pays for its imports, database connections, the sentiment
+lexicon and the twitter key check on every invocation. The daemon does all
+of that once and then runs each job on its own schedule:
+    tweets: collect and insert the tweets of CRYPTOS (default every 15m)
+    klines: pull the latest hourly candles of every coin (default every 1h)
+    market_data: fill the daily market data tables with the day's
+                 sentiment from the rollups (default every 1d)
+    archive: export the new tweets to the parquet archive (default every 1d,
+             see tweet_archive.py)
+
+Jobs are aligned to their interval (a 15m job runs at :00, :15, ...) and a
+run that is due while the previous run of the same job is still going is
+skipped. SIGINT/SIGTERM stop the scheduling and wait for the running jobs.
+The status of every job and the metrics are written to STATUS_FILE after
+each run and can also be served over http (--status-port).
+
+Usage:
+    python3 collector_daemon.py --tweets-every 15m --klines-every 1h \\
+        --market-data-every 1d --status-port 9100
+"""
+
+import argparse
+import json
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptocurrencies import CRYPTOS
+from data_collection import error
+from data_collection.metrics import METRICS
+
+
+STATUS_FILE = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reports",
+        "daemon-status.json")
+# Seconds the running jobs get to finish on shutdown
+SHUTDOWN_TIMEOUT = 300
+# Candles pulled by the klines job, and how far back it starts for coins
+# that have none yet
+KLINES_INTERVAL = "1h"
+KLINES_LOOKBACK = 2 * 24 * 60 * 60
+# Binance request weight the klines and market data jobs share per minute
+BINANCE_WEIGHT_PER_MINUTE = 1000
+
+DEFAULT_SCHEDULE = {
+    "tweets": "15m",
+    "klines": "1h",
+    "market_data": "1d",
+    "archive": "1d",
+}
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+class Job:
+    """A function that runs every interval seconds, never twice at once"""
+
+    def __init__(self, name: str, interval: float, function, on_done=None):
+        """
+        :param interval: float of seconds between two runs
+        :param function: callable run without arguments
+        :param on_done: optional callable run after every run of the job
+        """
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.on_done = on_done
+        self.next_run = _next_boundary(time.time(), interval)
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_start = None
+        self.last_duration = None
+        self.last_error = None
+        self._thread = None
+
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+
+    def start(self):
+        """Runs the job in a background thread, skips it if it's still running"""
+        self.next_run = _next_boundary(time.time(), self.interval)
+        if self.running:
+            self.skipped += 1
+            METRICS.counter("daemon_runs_skipped_total", job=self.name).inc()
+            error("Skipping {0}, its previous run is still going".format(self.name))
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.start()
+
+
+    def join(self, timeout: float = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+    def status(self) -> dict:
+        return {
+            "interval_seconds": self.interval,
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "last_start": _isoformat(self.last_start),
+            "last_duration_seconds": self.last_duration,
+            "last_error": self.last_error,
+            "next_run": _isoformat(self.next_run),
+        }
+
+
+    def _run(self):
+        self.last_start = time.time()
+        try:
+            with METRICS.timer("daemon_job_seconds", job=self.name):
+                self.function()
+            self.last_error = None
+        except Exception as e:
+            self.failures += 1
+            self.last_error = "{0}: {1}".format(type(e).__name__, e)
+            METRICS.counter("daemon_job_failures_total", job=self.name).inc()
+            error("Job {0} failed: {1}".format(self.name, self.last_error))
+        finally:
+            self.runs += 1
+            self.last_duration = time.time() - self.last_start
+            if self.on_done is not None:
+                self.on_done()
+
+
+class CollectorDaemon:
+    """
+    Class that owns the warm resources and runs the collection jobs.
+
+    Usage:
+        >>> daemon = CollectorDaemon({"tweets": "15m", "market_data": "1d"})
+        >>> daemon.run()  # until SIGINT/SIGTERM
+    """
+
+    def __init__(self, schedule: dict = DEFAULT_SCHEDULE, num_threads: int = None,
+                 status_file: str = STATUS_FILE):
+        """
+        :param schedule: dict of job name -> interval ("30s", "15m", "1h", "1d")
+        :param num_threads: int of the threads used to insert tweets,
+                            defaults to daily_data.NUM_THREADS
+        :param status_file: str path the status is written to after each run
+        """
+        unknown = set(schedule) - set(DEFAULT_SCHEDULE)
+        if unknown:
+            raise ValueError("Unknown jobs: " + ", ".join(sorted(unknown)))
+        self.status_file = status_file
+        self.started = time.time()
+        self._stop = threading.Event()
+        self._status_lock = threading.Lock()
+        self._num_threads = num_threads
+        self._warm_up()
+        self.jobs = [Job(name, parse_interval(interval), getattr(self, "_" + name),
+                         on_done=self.write_status)
+                     for name, interval in schedule.items()]
+
+
+    def run(self):
+        """Runs the jobs on their schedule until stop() is called"""
+        for job in self.jobs:
+            print("{0}: every {1:.0f}s, first run at {2}".format(
+                job.name, job.interval, _isoformat(job.next_run)))
+        while not self._stop.is_set():
+            now = time.time()
+            for job in self.jobs:
+                if job.next_run <= now:
+                    job.start()
+            next_run = min(job.next_run for job in self.jobs)
+            self._stop.wait(max(next_run - time.time(), 0))
+
+        print("Shutting down, waiting for the running jobs...")
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        for job in self.jobs:
+            job.join(max(deadline - time.time(), 0))
+        self.write_status()
+
+
+    def stop(self, *args):
+        """Stops scheduling new runs (also the SIGINT/SIGTERM handler)"""
+        self._stop.set()
+
+
+    def status(self) -> dict:
+        """Returns the state of every job along with the metrics"""
+        return {
+            "started": _isoformat(self.started),
+            "uptime_seconds": time.time() - self.started,
+            "stopping": self._stop.is_set(),
+            "jobs": {job.name: job.status() for job in self.jobs},
+            "metrics": METRICS.snapshot(),
+        }
+
+
+    def write_status(self):
+        status = self.status()
+        with self._status_lock:
+            METRICS.write_json_report(self.status_file, extra={
+                "uptime_seconds": status["uptime_seconds"],
+                "stopping": status["stopping"],
+                "jobs": status["jobs"],
+            })
+
+
+    def serve_status(self, port: int):
+        """Serves /status (JSON) and /metrics (Prometheus) from a background thread"""
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith("/metrics"):
+                    content = METRICS.prometheus_text().encode("utf8")
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path.startswith("/status"):
+                    content = json.dumps(daemon.status(), indent=4,
+                                         default=str).encode("utf8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name="status_server")
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+    def _warm_up(self):
+        """Loads everything the jobs share once, instead of on every run"""
+        start = time.time()
+        import daily_data
+        from data_collection import TweetManager
+        from data_collection.rate_limiter import RateLimiter
+        from data_collection.sentiment import get_scorer
+        from database_wrapper import DatabaseWrapper
+        from influencer_leaderboard import InfluencerLeaderboard
+        from kline_store import KlineStore
+        from ornus_data_manager import DataManager
+        from tweet_archive import TweetArchive
+        from tweet_index import TweetIndex
+        from tweet_sketches import TweetSketches
+        from tfidf_features import TfidfFeatures
+        from twitter_user_cache import TwitterUserCache
+
+        self._daily_data = daily_data
+        self._num_threads = self._num_threads or daily_data.NUM_THREADS
+        self._database = DataManager(CRYPTOS)
+        self._database.create_tables()
+        self._database.fill_cryptocurrency_table()
+        # Kept across runs, so unchanged users are never written again
+        self._user_cache = TwitterUserCache()
+        self._inserters = [DataManager(CRYPTOS, user_cache=self._user_cache)
+                           for _ in range(self._num_threads)]
+        self._index = TweetIndex()
+        self._leaderboard_database = DatabaseWrapper()
+        self._leaderboard = InfluencerLeaderboard(self._leaderboard_database, CRYPTOS)
+        # Its own connection, the listeners load their rows from inserter threads
+        self._sketch_database = DatabaseWrapper()
+        self._sketches = TweetSketches(self._sketch_database, CRYPTOS, source="daemon")
+        self._frequencies = TfidfFeatures()
+        for database in self._inserters:
+            database.add_batch_listener(self._index.add)
+            database.add_batch_listener(self._leaderboard.add)
+            database.add_batch_listener(self._sketches.add)
+            database.add_batch_listener(self._frequencies.add)
+        self._kline_database = DatabaseWrapper()
+        self._kline_store = KlineStore(self._kline_database)
+        # The jobs can run at the same time, so they share the weight budget
+        self._binance_limiter = RateLimiter(BINANCE_WEIGHT_PER_MINUTE)
+        self._archive_database = DatabaseWrapper()
+        self._tweet_archive = TweetArchive()
+        self._tweet_manager = TweetManager(CRYPTOS, num_threads=self._num_threads)
+        # Loads the lexicon/corpora of the scorer
+        get_scorer().score("warm up")
+        METRICS.gauge("daemon_warm_up_seconds").set(time.time() - start)
+        print("Warm up took {0:.2f}s".format(time.time() - start))
+
+
+    def _tweets(self):
+        for database in self._inserters:
+            database.ping()
+        self._leaderboard_database.ping()
+        self._sketch_database.ping()
+        tweets = self._tweet_manager.get_tweets(
+            num_tweets_per_coin=self._daily_data.NUM_TWEETS)
+        try:
+            threader = self._daily_data.SentimentMultithreader(
+                tweets, self._num_threads, databases=self._inserters)
+            threader.analyze_sentiment()
+        finally:
+            tweets.close()
+            self._index.flush()
+            self._leaderboard.flush()
+            self._sketches.flush()
+            self._frequencies.flush()
+
+
+    def _klines(self):
+        self._kline_database.ping()
+        # Coins without candles yet start from the last two days rather than
+        # their whole history, that's what backfill.py is for
+        default_start = int((time.time() - KLINES_LOOKBACK) * 1000)
+        for coin in CRYPTOS:
+            coin_id = self._database.get_coin_id(coin.name)
+            if coin_id is None:
+                continue
+            last = self._kline_store.last_open_time(coin_id, KLINES_INTERVAL)
+            start_time = default_start if last is None else last * 1000
+            self._kline_store.fetch(coin, coin_id, KLINES_INTERVAL,
+                                    start_time=start_time,
+                                    rate_limiter=self._binance_limiter)
+
+
+    def _market_data(self):
+        self._database.ping()
+        # The job runs as a day starts, the row is of the day that just ended
+        # (the 24 hour tickers cover it too)
+        today = datetime.utcnow().date()
+        yesterday = (today - timedelta(days=1)).isoformat()
+        sentiment = self._database.sentiment_totals(start=yesterday,
+                                                    end=today.isoformat())
+        coins = [coin for coin in CRYPTOS if coin.name in sentiment]
+        self._database.fill_market_data_tables(sentiment, verbose=True,
+                                               coins=coins, date=yesterday,
+                                               rate_limiter=self._binance_limiter)
+
+
+    def _archive(self):
+        self._archive_database.ping()
+        self._tweet_archive.update(self._archive_database)
+
+
+def parse_interval(interval) -> float:
+    """Converts "30s", "15m", "1h", "1d" (or a number of seconds) to seconds"""
+    if isinstance(interval, (int, float)):
+        return float(interval)
+    interval = interval.strip().lower()
+    if interval[-1] in _UNITS:
+        return float(interval[:-1]) * _UNITS[interval[-1]]
+    return float(interval)
+
+
+def _next_boundary(now: float, interval: float) -> float:
+    """Returns the first multiple of interval (since the epoch) after now"""
+    return (now // interval + 1) * interval
+
+
+def _isoformat(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Run the collection jobs on a schedule with warm resources")
+    for name, interval in DEFAULT_SCHEDULE.items():
+        parser.add_argument("--{0}-every".format(name.replace("_", "-")),
+                            dest=name, default=interval,
+                            help="interval of the {0} job, 'off' disables it "
+                                 "(default: {1})".format(name, interval))
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--status-file", default=STATUS_FILE)
+    parser.add_argument("--status-port", type=int, default=None,
+                        help="also serve /status and /metrics on this port")
+    args = parser.parse_args()
+
+    schedule = {name: getattr(args, name) for name in DEFAULT_SCHEDULE
+                if getattr(args, name) != "off"}
+    daemon = CollectorDaemon(schedule, num_threads=args.threads,
+                             status_file=args.status_file)
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    if args.status_port is not None:
+        daemon.serve_status(args.status_port)
+    daemon.run()
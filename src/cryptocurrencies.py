@@ -2,43 +2,15 @@
 
 """
 All Cryptocurrency Constants
+
+The coins are defined in coins.json, CRYPTOS is a CoinRegistry so coins can
+be looked up by name, ticker, binance pair or database id.
 """
-from data_collection import Cryptocurrency
+import os
+
+from data_collection import CoinRegistry
+
 
+COINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "coins.json")
 
-CRYPTOS = (
-        Cryptocurrency("Bitcoin", "BTC"),
-        Cryptocurrency("Ethereum", "ETH"),
-        Cryptocurrency("Ripple", "XRP"),
-        Cryptocurrency("Bitcoin_Cash", "BCHABC"),
-        Cryptocurrency("Eos", "EOS"),
-        Cryptocurrency("Stellar", "XLM"),
-        Cryptocurrency("Litecoin", "LTC"),
-        Cryptocurrency("Bitcoin_SV", "BCHSV"),
-        Cryptocurrency("Tron", "TRX"),
-        Cryptocurrency("Cardano", "ADA"),
-        Cryptocurrency("Tron", "TRX"),
-        Cryptocurrency("Iota", "IOTA"),
-        Cryptocurrency("Binance_Coin", "BNB"),
-        Cryptocurrency("Monero", "XMR"),
-        Cryptocurrency("Dash", "DASH"),
-        Cryptocurrency("NEM", "XEM"),
-        Cryptocurrency("Ethereum_Classic", "ETC"),
-        Cryptocurrency("Neo", "NEO"),
-        Cryptocurrency("Zcash", "ZEC"),
-        Cryptocurrency("Waves", "WAVES"),
-        Cryptocurrency("Bitcoin_Gold", "BTG"),
-        Cryptocurrency("Vechain", "VET"),
-        Cryptocurrency("True_USD", "TUSD"),
-        Cryptocurrency("Qtum", "QTUM"),
-        Cryptocurrency("OmiseGo", "OMG"),
-        Cryptocurrency("Ziliqa", "ZIL"),
-        Cryptocurrency("Zcash", "ZEC"),
-        Cryptocurrency("Ontology", "ONT"),
-        Cryptocurrency("0x", "ZRX"),
-        Cryptocurrency("Basic_Attention_Token", "BAT"),
-        Cryptocurrency("LISK", "LSK"),
-        Cryptocurrency("Nano", "NANO"),
-        Cryptocurrency("Decred", "DCR"),
-        Cryptocurrency("Icon", "ICX")
-)
+CRYPTOS = CoinRegistry.from_file(COINS_FILE)
@@ -5,78 +5,209 @@
 """
 Collects the data for the selected coins in CRYPTOS and inserts them into
 the database.
+
+The progress of every run is journaled (see run_journal.py), a run that
+died can be picked up where it stopped with --resume.
 """
 
 import time
 start = time.time()
+import argparse
+import contextlib
 import sys
 import os
 import threading
 from queue import Queue
 
 from cryptocurrencies import CRYPTOS
-from data_collection import Cryptocurrency, TweetManager
+from data_collection import (Cryptocurrency, TweetManager, RedditManager,
+                             SentimentAggregator, error)
+from data_collection.metrics import METRICS, ProgressReporter
+from database_wrapper import DatabaseWrapper
+from influencer_leaderboard import InfluencerLeaderboard
+from tweet_sketches import TweetSketches
+from tfidf_features import TfidfFeatures
 from ornus_data_manager import DataManager
+from twitter_user_cache import TwitterUserCache
+from profiling import Profiler, PROFILE_MODES, PROFILE_DIRECTORY
+from run_journal import RunJournal
+from tweet_index import TweetIndex
+METRICS.gauge("import_seconds").set(time.time() - start)
 print("Importing Complete, took {:0.2f}s".format(time.time() - start))
 
 NUM_TWEETS = 500
 NUM_THREADS = 16
+# How many tweets are inserted (and added to the sentiment rollups) at once
+INSERT_BATCH_SIZE = 100
 MULTITHREADING = True
+# Keep the full text index of the tweets (see tweet_index.py) up to date
+INDEX_TWEETS = True
+# Keep the influencer leaderboard of every coin (see influencer_leaderboard.py) up to date
+RANK_INFLUENCERS = True
+# Keep the distinct user and hashtag sketches (see tweet_sketches.py) up to date
+SKETCH_TWEETS = True
+# Keep the TF-IDF document frequencies (see tfidf_features.py) up to date
+COUNT_DOCUMENT_FREQUENCIES = True
+# Also collect the newest posts (and their comments) of each coin's subreddit
+COLLECT_REDDIT = False
+NUM_REDDIT_POSTS = 100
+
+# Where the JSON report of each run's metrics is written
+METRICS_DIRECTORY = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reports")
 
 
-def main():
+def main(prometheus_file=None, profiler=None, reddit=COLLECT_REDDIT,
+         journal=None):
+    """
+    :param prometheus_file: optional str path of a file the run's metrics
+                            are also written to in the Prometheus text format
+    :param profiler: optional Profiler that profiles each stage of the run
+    :param reddit: bool for whether to also collect reddit posts and comments
+    :param journal: optional RunJournal of an unfinished run to resume, its
+                    completed work is skipped, a new run is started otherwise
+    """
+    if profiler is None:
+        profiler = Profiler(None)
+    if journal is None:
+        journal = RunJournal.create(num_tweets_per_coin=NUM_TWEETS, reddit=reddit)
+    else:
+        print("Resuming run", journal.run_id, "completed stages:",
+              ", ".join(journal.stages()) or "none")
+    num_tweets = journal.params.get("num_tweets_per_coin", NUM_TWEETS)
+    reddit = journal.params.get("reddit", reddit)
+
     print("Initiallizing...")
     database = DataManager(CRYPTOS)
     # First Make sure all the tables for the database are built
     print("Creating Tables")
-    database.create_tables()
+    with stage("create_tables", profiler):
+        database.create_tables()
     print()
     # Populate the cryptocurrency database
     print("Populating cryptocurrency table...")
     database.fill_cryptocurrency_table()
-    # Get all the tweets needed for one day
-    print("Generating TweetManager...")
-    tweet_manager = TweetManager(CRYPTOS, num_threads=NUM_THREADS)
-    tweets = tweet_manager.get_tweets(num_tweets_per_coin=NUM_TWEETS, verbose=False)
-    print(len(tweets), "tweets identified for", len(CRYPTOS), "cryptocurrencies")
+    # Get all the tweets needed for one day, the scored tweets of every
+    # search round are written to the journal as they come in
+    if journal.stage_done("collect_tweets"):
+        print("Tweets already collected")
+    else:
+        print("Generating TweetManager...")
+        with stage("collect_tweets", profiler):
+            tweet_manager = TweetManager(CRYPTOS, num_threads=NUM_THREADS)
+            tweet_manager.get_tweets(num_tweets_per_coin=num_tweets, verbose=False,
+                                     skip=journal.fetched,
+                                     on_batch=journal.record_fetch).close()
+        journal.complete_stage("collect_tweets",
+                               failed=sorted(tweet_manager.failed_coins))
+    print(journal.num_tweets(), "tweets identified for", len(CRYPTOS), "cryptocurrencies")
 
     # Go through the coins and insert each tweet to the database
-    # And collect all the sentiment data to insert into the market data tables
+    # And collect all the sentiment data to insert into the market data tables,
+    # the batches that were inserted before a resume are only aggregated
     print("Collecting Coin Sentiment")
-    coin_sentiment = dict()
-    start = time.time()
-    
-    if MULTITHREADING:
-        threader = SentimentMultithreader(tweets, NUM_THREADS)
-        coin_sentiment = threader.analyze_sentiment()
-    else:
-        from tqdm import tqdm
-        for index, tweet in tqdm(enumerate(tweets)):
-            if tweet["coin"] not in coin_sentiment.keys():
-                coin_sentiment[tweet["coin"]] = {
-                        "length": 0, 
-                        "sum": 0, 
-                        "pos_sentiment": 0, 
-                        "neg_sentiment": 0
-                }
-            if tweet["sentiment"] > 0:
-                coin_sentiment[tweet["coin"]]["pos_sentiment"] += 1
-            elif tweet["sentiment"] < 0: 
-                coin_sentiment[tweet["coin"]]["neg_sentiment"] += 1
-
-            coin_sentiment[tweet["coin"]]["sum"] += tweet["sentiment"]
-            coin_sentiment[tweet["coin"]]["length"] += 1
-
-            database.insert_tweet(tweet)
-            if (index + 1) % 500 == 0:
-                print("Processed sentiment for", (index+1), "of", len(tweets), "tweets.", end=" ")
-                print("Percent Complete: {:0.2f}".format(index/len(tweets)))
-
-    print("Collecting coin sentiment took {:0.2f}s".format(time.time() - start))
+    index = TweetIndex() if INDEX_TWEETS else None
+    leaderboard = (InfluencerLeaderboard(DatabaseWrapper(), CRYPTOS)
+                   if RANK_INFLUENCERS else None)
+    sketches = (TweetSketches(DatabaseWrapper(), CRYPTOS, source="daily")
+                if SKETCH_TWEETS else None)
+    frequencies = TfidfFeatures() if COUNT_DOCUMENT_FREQUENCIES else None
+    sinks = [sink for sink in (index, leaderboard, sketches, frequencies)
+             if sink is not None]
+    listeners = [sink.add for sink in sinks]
+    _replay_unflushed(journal, sinks)
+    with stage("insert_tweets", profiler) as timer:
+        if MULTITHREADING:
+            threader = SentimentMultithreader(None, NUM_THREADS, journal=journal,
+                                              batch_listeners=listeners)
+            coin_sentiment = threader.analyze_sentiment()
+        else:
+            from tqdm import tqdm
+            new_tweets = list()
+            for listener in listeners + [new_tweets.extend]:
+                database.add_batch_listener(listener)
+            aggregator = SentimentAggregator(CRYPTOS)
+            for batch_id, batch in tqdm(journal.tweet_batches(INSERT_BATCH_SIZE)):
+                if not journal.inserted(batch_id):
+                    new_tweets.clear()
+                    database.insert_tweets(batch)
+                    journal.record_insert(batch_id, [tweet["id"] for tweet in new_tweets])
+                aggregator.add(batch)
+            coin_sentiment = aggregator.result()
+        for sink in sinks:
+            sink.flush()
+            journal.record_flush(type(sink).__name__)
+    journal.complete_stage("insert_tweets")
+    print("Collecting coin sentiment took {:0.2f}s".format(timer.elapsed))
+
+    if reddit and not journal.stage_done("collect_reddit"):
+        print("Collecting Reddit Posts")
+        with stage("collect_reddit", profiler):
+            reddit_manager = RedditManager(CRYPTOS, num_threads=NUM_THREADS)
+            collection = reddit_manager.collect(num_posts_per_coin=NUM_REDDIT_POSTS)
+            counts = database.insert_reddit(collection)
+            print("Inserted", ", ".join("{0} {1}".format(count, table)
+                                        for table, count in counts.items()))
+        journal.complete_stage("collect_reddit", **counts)
 
     # Insert the market data for all the coins in CRYPTOS
-    print("Beginning to Process Market Data")
-    database.fill_market_data_tables(coin_sentiment, verbose=True)
+    if not journal.stage_done("market_data"):
+        print("Beginning to Process Market Data")
+        # Coins skipped for failing (or without tweets) have no sentiment
+        collected = [coin for coin in CRYPTOS if coin.name in coin_sentiment]
+        with stage("market_data", profiler):
+            database.fill_market_data_tables(coin_sentiment, verbose=True,
+                                             coins=collected)
+        journal.complete_stage("market_data",
+                               coins=[coin.name for coin in collected])
+
+    journal.finish()
+    write_metrics(prometheus_file)
+
+
+@contextlib.contextmanager
+def stage(name: str, profiler):
+    """
+    Context manager for a stage of the run, times it into the stage_seconds
+    metric and profiles it when profiling is enabled
+    """
+    with profiler.stage(name), METRICS.timer("stage_seconds", stage=name) as timer:
+        yield timer
+
+
+def write_metrics(prometheus_file=None):
+    """
+    Writes the run's metrics to METRICS_DIRECTORY/run-<date>.json and, if
+    given, to prometheus_file
+    """
+    report_path = os.path.join(METRICS_DIRECTORY, "run-{0}.json".format(
+        time.strftime("%Y-%m-%d-%H%M%S")))
+    METRICS.write_json_report(report_path, extra={
+        "num_tweets_per_coin": NUM_TWEETS,
+        "num_threads": NUM_THREADS,
+        "num_coins": len(CRYPTOS),
+    })
+    print("Metrics written to", report_path)
+    if prometheus_file is not None:
+        METRICS.write_prometheus(prometheus_file)
+
+
+def _replay_unflushed(journal, sinks: list):
+    """
+    Feeds every sink the new tweets of the batches a crashed run inserted
+    after the sink's last flush, which the sink lost with the process
+    """
+    unflushed = {sink: journal.unflushed(type(sink).__name__) for sink in sinks}
+    if not any(unflushed.values()):
+        return
+    num_batches = 0
+    for batch_id, batch in journal.tweet_batches(INSERT_BATCH_SIZE):
+        for sink, batches in unflushed.items():
+            if batch_id in batches:
+                new_ids = set(batches[batch_id])
+                sink.add([tweet for tweet in batch if tweet["id"] in new_ids])
+                num_batches += 1
+    print("Replayed", num_batches, "unflushed batches to the tweet listeners")
 
 
 class SentimentMultithreader:
@@ -85,19 +216,40 @@ class SentimentMultithreader:
     and also calculating their sentiment
     """
 
-    def __init__(self, tweets: list, num_threads=10):
+    def __init__(self, tweets, num_threads=10, databases=None, user_cache=None,
+                 journal=None, batch_listeners=None):
         """
-        :param tweets: list of dicts where each dict is a tweet (as generated 
-                       by data_collection/json_parser.py)
+        :param tweets: TweetBuffer (or list) of dicts where each dict is a
+                       tweet (as generated by data_collection/json_parser.py),
+                       ignored when a journal is given
         :param num_threads: int of how many threads to use
+        :param databases: optional list of num_threads DataManagers for the
+                          threads to reuse instead of connecting on every run
+        :param user_cache: optional TwitterUserCache to use, ex: one kept
+                           across runs
+        :param journal: optional RunJournal whose fetched tweets are inserted
+                        instead, skipping (but still aggregating) the batches
+                        it has already journaled as inserted
+        :param batch_listeners: optional list of callables registered on the
+                                DataManagers the threads create (see
+                                DataManager.add_batch_listener())
         """
 
         self.num_threads = num_threads
-        self._lock = threading.Lock()
         self._tweets = tweets
-        self._length = len(tweets)
+        self._journal = journal
+        self._batch_listeners = list(batch_listeners or [])
+        self._length = len(tweets) if journal is None else journal.num_tweets()
         self._queue = None
-        self._coin_sentiment = None
+        self._databases = databases
+        # Shared so a user is only written once per run unless it changed
+        self._user_cache = user_cache if user_cache is not None else TwitterUserCache()
+        # The new tweets of the batch each thread is inserting, journaled
+        # along with the batch
+        self._local = threading.local()
+        # (batch id, exception) of the batches whose insert failed
+        self._failures = list()
+        self._failures_lock = threading.Lock()
 
 
     def analyze_sentiment(self) -> dict:
@@ -117,24 +269,36 @@ class SentimentMultithreader:
         Here length means how many tweets referenced that coin, sum is a
         cumulative sum of the sentiment (note this number can be negative since
         tweets can have a negative sentiment), then pos_sentiment and neg_sentiment 
-        is what percentage of tweets have a positive or negative sentiment.
+        is how many tweets have a positive or negative sentiment.
+        The threads only insert the tweets, the statistics are computed by a
+        SentimentAggregator as the batches are queued.
         """
         
-        self._coin_sentiment = dict()
-        self._queue = Queue()
+        # Bounded so only a few batches are read back from the buffer ahead
+        # of the threads
+        self._queue = Queue(maxsize=2 * self.num_threads)
     
         # Initialize Threads
         threads = []
         for x in range(self.num_threads):
-            t = threading.Thread(target=self._threader)
+            t = threading.Thread(target=self._threader, args=(x,))
             t.daemon = True  
             t.name = x
             threads.append(t)
             t.start()
             
-        # Add the hashtags to be searched into the queue
-        list(map(self._queue.put, self._tweets))
-        self._queue.join()
+        # Add the tweets to the queue in batches so each thread inserts
+        # (and updates the sentiment rollups) once per batch
+        aggregator = SentimentAggregator(CRYPTOS)
+        processed = METRICS.counter("tweets_processed_total")
+        with ProgressReporter(processed, total=self._length, label="tweets inserted"):
+            for batch_id, batch in self._numbered_batches():
+                aggregator.add(batch)
+                if self._journal is not None and self._journal.inserted(batch_id):
+                    processed.inc(len(batch))
+                    continue
+                self._queue.put((batch_id, batch))
+            self._queue.join()
         
         # Stop workers
         for i in range(self.num_threads):
@@ -142,61 +306,85 @@ class SentimentMultithreader:
         
         # Stop threads
         list(map(lambda t: t.join(), threads))
-        return self._coin_sentiment
 
+        if self._failures:
+            # The failed batches aren't journaled as inserted, so --resume
+            # inserts them again
+            batch_id, exception = self._failures[0]
+            error("{0} batches failed to insert, the first one ({1}) with: {2}".format(
+                len(self._failures), batch_id, exception))
+            raise exception
+        return aggregator.result()
 
-    def _process_tweet(self, tweet, database, coin_sentiment):
-        if tweet["coin"] not in coin_sentiment.keys():
-            coin_sentiment[tweet["coin"]] = {
-                    "length": 0, 
-                    "sum": 0, 
-                    "pos_sentiment": 0, 
-                    "neg_sentiment": 0
-            }
-        if tweet["sentiment"] > 0:
-            coin_sentiment[tweet["coin"]]["pos_sentiment"] += 1
-        elif tweet["sentiment"] < 0: 
-            coin_sentiment[tweet["coin"]]["neg_sentiment"] += 1
 
-        coin_sentiment[tweet["coin"]]["sum"] += tweet["sentiment"]
-        coin_sentiment[tweet["coin"]]["length"] += 1
-        database.insert_tweet(tweet)
+    def _numbered_batches(self):
+        """Generator of (batch_id, batch), the ids are only stable with a journal"""
+        if self._journal is not None:
+            return self._journal.tweet_batches(INSERT_BATCH_SIZE)
+        return enumerate(_batches(self._tweets, INSERT_BATCH_SIZE))
 
 
-    def _threader(self):
-        database = DataManager(CRYPTOS)
-        coin_sentiment = dict()
+    def _threader(self, index: int):
+        if self._databases is not None:
+            database = self._databases[index]
+        else:
+            database = DataManager(CRYPTOS, user_cache=self._user_cache)
+            for listener in self._batch_listeners + [self._capture]:
+                database.add_batch_listener(listener)
         while True:
-            tweet = self._queue.get()
-
-            # When the multithreading is done, add the results to the final dict
-            if tweet is None:
-                with self._lock:
-                    for coin in coin_sentiment.keys():
-                        if coin not in self._coin_sentiment.keys():
-                            self._coin_sentiment[coin] = {
-                                    "length": 0, 
-                                    "sum": 0, 
-                                    "pos_sentiment": 0, 
-                                    "neg_sentiment": 0
-                            }
-                        self._coin_sentiment[coin]["length"] += coin_sentiment[coin]["length"]
-                        self._coin_sentiment[coin]["sum"] += coin_sentiment[coin]["sum"]
-                        self._coin_sentiment[coin]["pos_sentiment"] += coin_sentiment[coin]["pos_sentiment"]
-                        self._coin_sentiment[coin]["neg_sentiment"] += coin_sentiment[coin]["neg_sentiment"]
+            item = self._queue.get()
+            if item is None:
                 break
 
-            self._process_tweet(tweet, database, coin_sentiment)
-            self._queue.task_done()
-            with self._lock:
-                size = self._queue.qsize()
-                num_complete = self._length - size
-                if (num_complete + 1) % 500 == 0:
-                    print("Processed sentiment for", (num_complete+1), 
-                            "of", self._length, "tweets.", end=" ")
-                    print("Percent Complete: {:0.2f}".format(num_complete/self._length))
+            batch_id, batch = item
+            self._local.new_ids = None
+            try:
+                database.insert_tweets(batch)
+                if self._journal is not None:
+                    self._journal.record_insert(batch_id, self._local.new_ids)
+            except Exception as e:
+                # The thread keeps going so the queue is still drained and
+                # analyze_sentiment() raises once every batch was handled
+                with self._failures_lock:
+                    self._failures.append((batch_id, e))
+            finally:
+                self._queue.task_done()
+
+
+    def _capture(self, tweets: list):
+        self._local.new_ids = [tweet["id"] for tweet in tweets]
+
+
+def _batches(tweets, batch_size: int):
+    if hasattr(tweets, "batches"):
+        return tweets.batches(batch_size)
+    return (tweets[i:i + batch_size] for i in range(0, len(tweets), batch_size))
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+            description="Collect the daily tweets and market data of CRYPTOS")
+    parser.add_argument("--prometheus-file", default=None,
+                        help="also write the run's metrics to this file in "
+                             "the Prometheus text format")
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=None,
+                        help="profile every stage of the run, including its "
+                             "worker threads, with cProfile or a sampling profiler")
+    parser.add_argument("--profile-dir", default=PROFILE_DIRECTORY,
+                        help="directory the pstats/collapsed stack files are "
+                             "written to")
+    parser.add_argument("--reddit", action="store_true", default=COLLECT_REDDIT,
+                        help="also collect the newest posts and comments of "
+                             "each coin's subreddit")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None,
+                        metavar="RUN_ID",
+                        help="resume an unfinished run, the latest one unless "
+                             "its id is given, skipping its completed work")
+    args = parser.parse_args()
+    journal = None
+    if args.resume is not None:
+        journal = RunJournal.resume(None if args.resume == "latest" else args.resume)
+    main(prometheus_file=args.prometheus_file,
+         profiler=Profiler(args.profile, output_dir=args.profile_dir),
+         reddit=args.reddit, journal=journal)
 
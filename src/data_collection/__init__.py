@@ -1,6 +1,41 @@
 #!/usr/bin/env python3
 # coding: utf8
-from .tweet_manager import TweetManager
-from .cryptocurrency import Cryptocurrency
-from .utilities import error, clean_text_for_tfidf, make_directory
-from .utilities import text_sentiment
+"""
+The submodules are only imported when one of their names is first used
+(PEP 562), so importing one thing from data_collection doesn't also pull in
+the twitter client, pandas, numpy and textblob.
+"""
+import importlib
+
+# name: submodule that defines it
+_EXPORTS = {
+    "TweetManager": ".tweet_manager",
+    "RedditManager": ".reddit_manager",
+    "Cryptocurrency": ".cryptocurrency",
+    "CoinRegistry": ".coin_registry",
+    "SentimentAggregator": ".sentiment_aggregator",
+    "RateLimiter": ".rate_limiter",
+    "SentimentScorer": ".sentiment",
+    "get_scorer": ".sentiment",
+    "TweetBuffer": ".tweet_buffer",
+    "error": ".utilities",
+    "clean_text_for_tfidf": ".utilities",
+    "make_directory": ".utilities",
+    "text_sentiment": ".utilities",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(
+            __name__, name))
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    # Cache it so later lookups don't go through __getattr__ again
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -42,7 +42,13 @@ class APIManager:
     # Twitter api has a 15 min cooldown period 
     TWITTER_API_RESET_TIME = 900
 
-    def __init__(self):
+    def __init__(self, shard=None):
+        """
+        :param shard: optional tuple of (index, count) to only use every
+                      count-th key starting at index, so processes that
+                      collect at the same time don't share keys
+        """
+        self._shard = shard
         self._api_keys = Queue()
         self._time = time.time()
         self._load_keys()
@@ -66,7 +72,11 @@ class APIManager:
         except json.decoder.JSONDecodeError:
             error("Error: Json file is not properly formatted!")
             exit(-1)
-        list(map(self._api_keys.put, key_json["keys"]))
+        keys = key_json["keys"]
+        if self._shard is not None:
+            index, count = self._shard
+            keys = keys[index % count::count]
+        list(map(self._api_keys.put, keys))
 
 
     def next_api_key(self):
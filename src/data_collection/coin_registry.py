@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Registry of the collected coins with constant time lookups.
+
+The coins are defined in a JSON data file (see src/coins.json), one object
+per coin with its "name", "ticker" and optionally "date_founded". Duplicate
+names, tickers or binance pairs are rejected since every duplicate costs a
+second round of searches, scoring and market data calls for the same coin.
+"""
+
+import json
+import threading
+
+from .cryptocurrency import Cryptocurrency
+
+
+class CoinRegistry(tuple):
+    """
+    Tuple of Cryptocurrency (so it can be used wherever CRYPTOS was) indexed
+    by name, ticker, binance pair and database id.
+
+    Usage:
+        >>> coins = CoinRegistry.from_file("coins.json")
+        >>> coins.by_ticker("ETH")
+        >>> coins.load_ids(database)  # one query to the cryptocurrencies table
+        >>> coins.id_of("Ethereum")
+        ... 2
+    """
+
+    def __new__(cls, coins=()):
+        """
+        :param coins: iterable of Cryptocurrency
+        :raises ValueError: if two coins share a name, ticker or pair
+        """
+        coins = tuple(coins)
+        for coin in coins:
+            if not isinstance(coin, Cryptocurrency):
+                raise TypeError("All cryptocurrencies must be of type 'Cryptocurrency'")
+        return super().__new__(cls, coins)
+
+
+    def __init__(self, coins=()):
+        self._by_name = _index(self, lambda coin: coin.name.lower(), "name")
+        self._by_ticker = _index(self, lambda coin: coin.ticker, "ticker")
+        self._by_pair = _index(self, lambda coin: coin.pairing(), "pair")
+        self._ids = dict()
+        self._by_id = dict()
+        self._lock = threading.Lock()
+
+
+    @classmethod
+    def from_file(cls, path: str):
+        """Loads the coins of a JSON data file"""
+        with open(path, "r") as f:
+            definitions = json.load(f)
+        return cls(Cryptocurrency(**definition) for definition in definitions)
+
+
+    def by_name(self, name: str):
+        """Returns the coin called name (case insensitive), None if unknown"""
+        return self._by_name.get(name.lower())
+
+
+    def by_ticker(self, ticker: str):
+        return self._by_ticker.get(ticker.upper())
+
+
+    def by_pair(self, symbol: str):
+        """Returns the coin whose binance pair is symbol, ex: "ETHBTC" """
+        return self._by_pair.get(symbol.upper())
+
+
+    def by_id(self, coin_id: int):
+        """Returns the coin with id in the cryptocurrencies table (see load_ids())"""
+        return self._by_id.get(coin_id)
+
+
+    def id_of(self, name: str):
+        """
+        Returns the id of a coin in the cryptocurrencies table, None if it's
+        not in the table or load_ids() wasn't called
+        """
+        return self._ids.get(name.lower())
+
+
+    @property
+    def ids_loaded(self) -> bool:
+        return bool(self._ids)
+
+
+    def load_ids(self, database):
+        """
+        Loads the ids of every coin from the cryptocurrencies table in a
+        single query
+
+        :param database: DatabaseWrapper connected to the database
+        """
+        rows = database.query("SELECT id, name FROM cryptocurrencies")
+        ids = dict()
+        by_id = dict()
+        for coin_id, name in rows:
+            coin = self.by_name(name)
+            if coin is not None:
+                ids[coin.name.lower()] = coin_id
+                by_id[coin_id] = coin
+        with self._lock:
+            self._ids = ids
+            self._by_id = by_id
+
+
+def _index(coins, key, label: str) -> dict:
+    index = dict()
+    duplicates = list()
+    for coin in coins:
+        value = key(coin)
+        if value in index:
+            duplicates.append(value)
+        index[value] = coin
+    if duplicates:
+        raise ValueError("Duplicate coin {0}: {1}".format(
+            label, ", ".join(sorted(set(duplicates)))))
+    return index
+
+
+if __name__ == "__main__":
+    pass
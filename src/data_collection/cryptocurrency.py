@@ -3,10 +3,8 @@
 
 
 import os
-from datetime import datetime
-import pandas as pd
 
-from .utilities import get_bars
+from .utilities import get_ticker_snapshot, usd_market_data
 
 
 class Cryptocurrency:
@@ -26,37 +24,39 @@ class Cryptocurrency:
                 f"({self.ticker}) at location <{hex(id(self))}>")
 
 
-    def current_market_data(self):
+    def current_market_data(self, tickers=None):
         """
         Returns dictionary containing the current coin's price data
+
+        :param tickers: optional dataframe of get_ticker_snapshot(), pulled
+                        if not given
         """
-        # open_time = " 15:59:59.999000"
-        today = datetime.today().strftime('%Y-%m-%d')
-        index = today 
+        # The snapshot of both symbols is a single request
+        if tickers is None:
+            tickers = get_ticker_snapshot()
+        data = usd_market_data(tickers, [self])
+        if data.empty:
+            raise KeyError("No market data for " + self.pairing())
+        row = data.iloc[0]
+        return {
+                "date": row["date"],
+                "open": float(row["open"]),
+                "high": float(row["high"]),
+                "low": float(row["low"]),
+                "close": float(row["close"]),
+                "volume": float(row["volume"]),
+                "num_trades": int(row["num_trades"]),
+        }
 
-        # Pair data returns the prices of btc in usdt so that altcoins 
-        # can have their data in usdt rather than btc
-        pair_data = get_bars("BTCUSDT", interval="1d")
 
+    def pairing(self) -> str:
+        """
+        Returns the binance symbol the coin's prices are pulled from, altcoins
+        are quoted in BTC and bitcoin itself in USDT
+        """
         if self.ticker == "BTC":
-            pairing = "BTCUSDT"
-            for key in pair_data.keys():
-                pair_data[key] = 1
-        else:
-            pairing = self.ticker + "BTC"
-
-        data = get_bars(pairing, interval="1d")
-
-        todays_data = {
-                "date": today,
-                "open": float(data.loc[index]["open"]) * float(pair_data.loc[index]["open"]),
-                "high": float(data.loc[index]["high"]) * float(pair_data.loc[index]["high"]),
-                "low": float(data.loc[index]["low"]) * float(pair_data.loc[index]["low"]),
-                "close": float(data.loc[index]["close"]) * float(pair_data.loc[index]["close"]),
-                "volume": data.loc[index]["volume"],
-                "num_trades": data.loc[index]["num_trades"]
-        }
-        return todays_data
+            return "BTCUSDT"
+        return self.ticker + "BTC"
 
 
     def schema(self):
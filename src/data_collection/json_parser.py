@@ -10,17 +10,20 @@ import sys
 import os
 # sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from .utilities import text_sentiment
+from .metrics import METRICS
 
 
 class JSONTweetParser:
 
-    def __init__(self, tweet: dict, coin: str):
+    def __init__(self, tweet: dict, coin: str, scorer=None):
         """
         :param tweet: dict object as gathered from the twitter api
+        :param scorer: optional str name of the sentiment scorer (see
+                       sentiment.py), defaults to SENTIMENT_SCORER
         """
         self.tweet_json = tweet
         self.coin = coin
+        self.scorer = scorer
 
 
     def get_tweetid(self) -> int:
@@ -43,12 +46,22 @@ class JSONTweetParser:
         return JSONTweetParser.format_time(self.tweet_json["created_at"])
 
 
+    def get_timestamp(self) -> str:
+        """
+        :return: the date and time (UTC) of which a tweet was posted in the
+                 format of: 2014-4-25 10:43:41
+        """
+        return JSONTweetParser.format_timestamp(self.tweet_json["created_at"])
+
+
     def get_retweets(self) -> int:
         return self.tweet_json['retweet_count']
 
 
     def get_tweet_sentiment(self) -> float:
-        return text_sentiment(self.get_tweet())
+        from .sentiment import get_scorer, score_texts
+
+        return float(score_texts([self.get_tweet()], get_scorer(self.scorer))[0])
 
     def get_userinfo(self) -> dict:
         """
@@ -69,24 +82,53 @@ class JSONTweetParser:
         return self.tweet_json['text']
 
 
-    def construct_tweet_json(self):
+    def construct_tweet_json(self, score=True):
         """
+        :param score: bool for whether to score the sentiment of the tweet,
+                      when False the "sentiment" is None and is expected to be
+                      filled in later (see construct_tweet_jsons())
         :return dict containing all the different information about
         a certain tweet
         """
-        tweet = {
-            "id": self.get_tweetid(),
-            "text": self.get_tweet(),
-            "hashtags": self.get_hashtags(),
-            "date": self.get_date(),
-            "retweets": self.get_retweets(),
-            "user": self.get_userinfo(),
-            "coin": self.coin,
-            "sentiment": self.get_tweet_sentiment(),
-        }
+        # Includes the time spent scoring sentiment (sentiment_score_seconds)
+        with METRICS.timer("tweet_parse_seconds"):
+            tweet = {
+                "id": self.get_tweetid(),
+                "text": self.get_tweet(),
+                "hashtags": self.get_hashtags(),
+                "date": self.get_date(),
+                "created_at": self.get_timestamp(),
+                "retweets": self.get_retweets(),
+                "user": self.get_userinfo(),
+                "coin": self.coin,
+                "sentiment": self.get_tweet_sentiment() if score else None,
+            }
         return tweet
 
 
+    @staticmethod
+    def construct_tweet_jsons(statuses: list, coin: str, scorer=None) -> list:
+        """
+        Parses a list of tweets as gathered from the twitter api and scores
+        their sentiment in a single batch, which is much faster than scoring
+        them one at a time
+
+        :param statuses: list of tweet dicts
+        :param coin: str name of the coin the tweets were searched for
+        :param scorer: optional str name of the sentiment scorer
+        """
+        from .sentiment import get_scorer, score_texts
+
+        tweets = [JSONTweetParser(status, coin).construct_tweet_json(score=False)
+                  for status in statuses]
+        if tweets:
+            scores = score_texts([tweet["text"] for tweet in tweets],
+                                 get_scorer(scorer))
+            for tweet, sentiment in zip(tweets, scores.tolist()):
+                tweet["sentiment"] = sentiment
+        return tweets
+
+
     @staticmethod
     def format_time(date: str, separator='-') -> str:
         """
@@ -119,5 +161,15 @@ class JSONTweetParser:
         return separator.join([year, month_to_digit[month], day])
 
 
+    @staticmethod
+    def format_timestamp(date: str) -> str:
+        """
+        Takes a string in the format of: "Fri Apr 25 10:43:41 +0000 2014" 
+        and returns it in a format of: 2014-4-25 10:43:41
+        """
+        clock = date.split()[3]
+        return JSONTweetParser.format_time(date) + " " + clock
+
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Lightweight in-process metrics: counters, gauges and latency histograms.
+
+Every metric is identified by a name plus optional labels and is safe to
+update from any thread. The process wide registry METRICS is what the rest
+of the project records into, at the end of a run it can be written out as a
+JSON report and/or a Prometheus text format file.
+
+Usage:
+    >>> from data_collection.metrics import METRICS
+    >>> METRICS.counter("tweets_inserted_total").inc(100)
+    >>> with METRICS.timer("api_request_seconds", api="binance"):
+    ...     get_bars("ETHBTC")
+    >>> METRICS.write_json_report("run.json")
+"""
+
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    """Monotonically increasing count"""
+    kind = "counter"
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Gauge:
+    """Value that can go up and down"""
+    kind = "gauge"
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Histogram:
+    """Distribution of observed values (usually latencies in seconds)"""
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+            if value > self._max:
+                self._max = value
+
+    @property
+    def count(self):
+        return self._count
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile from the buckets (upper bound of its bucket)"""
+        with self._lock:
+            counts, total, maximum = list(self._counts), self._count, self._max
+        if total == 0:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets + (maximum,), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, maximum)
+        return maximum
+
+    def snapshot(self):
+        with self._lock:
+            count, total, maximum = self._count, self._sum, self._max
+            counts = list(self._counts)
+        return {
+            "count": count,
+            "sum": total,
+            "mean": total / count if count else 0.0,
+            "max": maximum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], counts)),
+        }
+
+    def cumulative_buckets(self):
+        with self._lock:
+            counts = list(self._counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield bound, cumulative
+
+
+class _Timer:
+    """Context manager / decorator that observes its duration into a histogram"""
+
+    __slots__ = ("_histogram", "_start", "elapsed")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self._start
+        self._histogram.observe(self.elapsed)
+        return False
+
+    def __call__(self, function):
+        histogram = self._histogram
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+
+
+class MetricsRegistry:
+    """
+    Collection of named metrics. Getting a metric that doesn't exist yet
+    creates it, so instrumented code doesn't need to declare anything.
+    """
+
+    def __init__(self):
+        self._metrics = dict()
+        self._help = dict()
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+
+    def counter(self, name: str, help: str = None, **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+
+    def gauge(self, name: str, help: str = None, **labels) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+
+    def histogram(self, name: str, help: str = None, **labels) -> Histogram:
+        return self._get(Histogram, name, help, labels)
+
+
+    def timer(self, name: str, **labels) -> _Timer:
+        """
+        Returns a context manager (that can also decorate functions) which
+        observes how long its body took, in seconds, into histogram name
+        """
+        return _Timer(self.histogram(name, **labels))
+
+
+    def snapshot(self) -> dict:
+        """
+        Returns every metric's current value as a dict of the form:
+            {name: [{"labels": {...}, "type": ..., "value": ...}, ...]}
+        """
+        with self._lock:
+            metrics = list(self._metrics.items())
+        snapshot = dict()
+        for (name, labels), metric in sorted(metrics, key=lambda m: m[0]):
+            snapshot.setdefault(name, []).append({
+                "labels": dict(labels),
+                "type": metric.kind,
+                "value": metric.snapshot(),
+            })
+        return snapshot
+
+
+    def write_json_report(self, path: str, extra: dict = None):
+        """
+        Writes a JSON run report containing every metric
+
+        :param path: str of the file to write
+        :param extra: optional dict of additional top level entries
+        """
+        report = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration_seconds": time.time() - self.started,
+            "metrics": self.snapshot(),
+        }
+        if extra:
+            report.update(extra)
+        _write_atomically(path, json.dumps(report, indent=4, default=str))
+
+
+    def write_prometheus(self, path: str):
+        """Writes every metric in the Prometheus text exposition format"""
+        _write_atomically(path, self.prometheus_text())
+
+
+    def prometheus_text(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda m: m[0])
+        lines = list()
+        described = set()
+        for (name, labels), metric in metrics:
+            if name not in described:
+                described.add(name)
+                if self._help.get(name):
+                    lines.append("# HELP {0} {1}".format(name, self._help[name]))
+                lines.append("# TYPE {0} {1}".format(name, metric.kind))
+            if metric.kind == "histogram":
+                for bound, count in metric.cumulative_buckets():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("{0}_bucket{1} {2}".format(
+                        name, _labels_text(labels + (("le", le),)), count))
+                snapshot = metric.snapshot()
+                lines.append("{0}_sum{1} {2}".format(name, _labels_text(labels),
+                                                     snapshot["sum"]))
+                lines.append("{0}_count{1} {2}".format(name, _labels_text(labels),
+                                                       snapshot["count"]))
+            else:
+                lines.append("{0}{1} {2}".format(name, _labels_text(labels),
+                                                 metric.value))
+        return "\n".join(lines) + "\n"
+
+
+    def reset(self):
+        """Removes every metric"""
+        with self._lock:
+            self._metrics = dict()
+            self.started = time.time()
+
+
+    def _get(self, kind, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = kind()
+                    self._metrics[key] = metric
+                    if help:
+                        self._help[name] = help
+        if not isinstance(metric, kind):
+            raise TypeError("Metric {0} is a {1}, not a {2}".format(
+                name, metric.kind, kind.kind))
+        return metric
+
+
+class ProgressReporter:
+    """
+    Background thread that periodically prints how far a counter has got
+    towards a total, so workers only increment the counter on the hot path
+
+    Usage:
+        >>> with ProgressReporter(counter, total=len(tweets), label="tweets inserted"):
+        ...     run_workers()
+    """
+
+    def __init__(self, counter, total: int, label: str, interval: float = 5.0):
+        self._counter = counter
+        self._start_value = counter.value
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.report()
+        return False
+
+    def report(self):
+        done = self._counter.value - self._start_value
+        percent = done / self.total if self.total else 1.0
+        print("{0} of {1} {2}. Percent Complete: {3:0.2f}".format(
+            done, self.total, self.label, percent))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+
+def _labels_text(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+
+def _write_atomically(path: str, content: str):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        f.write(content)
+    os.replace(temporary_path, path)
+
+
+# Process wide registry used throughout the project
+METRICS = MetricsRegistry()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Thread safe token bucket for staying within an api's request weight limits.
+"""
+
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket that refills at a constant rate, every request takes as many
+    tokens as its weight and blocks until enough tokens are available.
+
+    Usage:
+        >>> limiter = RateLimiter(weight_per_minute=1200)
+        >>> limiter.acquire(weight=5)  # blocks if the budget is used up
+    """
+
+    def __init__(self, weight_per_minute: float, burst: float = None):
+        """
+        :param weight_per_minute: float of how much weight can be used per minute
+        :param burst: float of how much weight can be used at once after being
+                      idle, defaults to a tenth of a minute's budget
+        """
+        self.rate = weight_per_minute / 60.0
+        self.capacity = burst if burst is not None else max(weight_per_minute / 10.0, 1)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self, weight: float = 1):
+        """Blocks until weight tokens are available and takes them"""
+        weight = min(weight, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= weight:
+                    self._tokens -= weight
+                    return
+                wait = (weight - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+if __name__ == "__main__":
+    pass
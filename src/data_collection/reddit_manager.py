@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Multithreaded collection of reddit posts and comments for several different
+cryptocurrencies, the reddit counterpart of TweetManager.
+
+Every coin is mapped to a subreddit whose newest posts are paged through
+with reddit's 'after' cursor, the comment tree of every post is then fetched
+concurrently. Posts and comments are normalized to compact dicts that match
+the reddit_* tables (see DataManager.insert_reddit()) and scored with the
+configured sentiment scorer in one batch per subreddit/post.
+
+Only reddit's public JSON endpoints are used, which allow about 60 requests
+per minute per client, every RedditManager shares one RateLimiter between
+its threads.
+"""
+
+import concurrent.futures
+import threading
+import time
+from datetime import datetime, timezone
+
+from .cryptocurrency import Cryptocurrency
+from .metrics import METRICS
+from .rate_limiter import RateLimiter
+from .resilience import RetryPolicy, call
+from .utilities import error
+
+
+REDDIT_URL = "https://www.reddit.com"
+USER_AGENT = "python:ornus.data_collection:v1.0"
+REQUESTS_PER_MINUTE = 60
+# Largest page reddit returns for a listing
+PAGE_SIZE = 100
+
+# Lengths of the VARCHAR columns of the reddit_* tables
+MAX_TITLE_LENGTH = 500
+MAX_POST_LENGTH = 10000
+MAX_COMMENT_LENGTH = 8000
+MAX_USERNAME_LENGTH = 20
+
+
+class RedditManager:
+    """
+    class for handling all interactions with reddit.
+    Usage:
+        >>> from data_collection import Cryptocurrency, RedditManager
+        >>> coins = [Cryptocurrency("bitcoin", "btc"), \\
+        ...     Cryptocurrency("ethereum", "eth")]
+        >>> reddit_manager = RedditManager(coins, num_threads=4)
+        >>> reddit_manager.collect(num_posts_per_coin=100)
+        ... {"subreddits": [...], "posts": [...], "comments": [...], "users": [...]}
+    """
+
+    def __init__(self, cryptocurrencies, subreddits: dict = None, num_threads=8,
+                 base_url: str = REDDIT_URL,
+                 requests_per_minute: float = REQUESTS_PER_MINUTE, scorer=None,
+                 retry_policy: RetryPolicy = None):
+        """
+        :param cryptocurrencies: list or tuple of Cryptocurrency
+        :param subreddits: optional dict of coin name -> subreddit name for
+                           coins whose subreddit isn't their lowercased name
+        :param num_threads: int of how many requests are made concurrently
+        :param base_url: str of the api's address, ex: a StubServer's url
+        :param requests_per_minute: float of the request budget of the client
+        :param scorer: optional str name of the sentiment scorer (see
+                       sentiment.py), defaults to SENTIMENT_SCORER
+        :param retry_policy: optional RetryPolicy of every request
+        """
+        if not isinstance(cryptocurrencies, (list, tuple)):
+            raise TypeError("Cryptocurrencies must be of type 'list' or 'tuple'")
+        for coin in cryptocurrencies:
+            if not isinstance(coin, Cryptocurrency):
+                raise TypeError("All cryptocurrencies must be of type 'Cryptocurrency'")
+
+        self.cryptocurrencies = cryptocurrencies
+        self.subreddits = dict(subreddits or {})
+        self.num_threads = num_threads
+        self.base_url = base_url.rstrip("/")
+        self.scorer = scorer
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._rate_limiter = RateLimiter(requests_per_minute)
+        # requests.Session isn't thread safe, so every thread gets its own
+        self._local = threading.local()
+
+
+    def subreddit_name(self, coin: Cryptocurrency) -> str:
+        return self.subreddits.get(coin.name, coin.name.replace("_", "").lower())
+
+
+    def collect(self, num_posts_per_coin=100, comments=True, verbose=False) -> dict:
+        """
+        Returns a dict with the normalized "subreddits", "posts", "comments"
+        and "users" of every coin's subreddit, coins whose subreddit couldn't
+        be collected are reported and left out
+
+        :param num_posts_per_coin: int of how many of the newest posts to pull
+        :param comments: bool for whether to pull the comment tree of each post
+        :param verbose: bool for whether to print the progress of each coin
+        """
+        start = time.time()
+        collection = {"subreddits": [], "posts": [], "comments": [], "users": {}}
+        with concurrent.futures.ThreadPoolExecutor(self.num_threads) as pool:
+            listings = {pool.submit(self._collect_subreddit, coin, num_posts_per_coin): coin
+                        for coin in self.cryptocurrencies}
+            trees = dict()
+            for future in concurrent.futures.as_completed(listings):
+                coin = listings[future]
+                try:
+                    subreddit, posts = future.result()
+                except Exception as e:
+                    METRICS.counter("collection_failures_total", api="reddit").inc()
+                    error("Failed to collect r/{0}: {1}".format(
+                        self.subreddit_name(coin), e))
+                    continue
+                collection["subreddits"].append(subreddit)
+                collection["posts"].extend(posts)
+                if verbose:
+                    print("Got", len(posts), "posts for", coin.name)
+                if comments:
+                    for post in posts:
+                        trees[pool.submit(self._collect_comments, post)] = post
+
+            for future in concurrent.futures.as_completed(trees):
+                try:
+                    collection["comments"].extend(future.result())
+                except Exception as e:
+                    METRICS.counter("collection_failures_total", api="reddit").inc()
+                    error("Failed to collect the comments of {0}: {1}".format(
+                        trees[future]["id"], e))
+
+        for record in collection["posts"] + collection["comments"]:
+            user = record.pop("user", None)
+            if user is not None:
+                collection["users"][user["id"]] = user
+        collection["users"] = list(collection["users"].values())
+
+        METRICS.gauge("reddit_collection_seconds").set(time.time() - start)
+        print("Collected {0} posts and {1} comments in {2:.3f} seconds".format(
+            len(collection["posts"]), len(collection["comments"]), time.time() - start))
+        return collection
+
+
+    def _collect_subreddit(self, coin: Cryptocurrency, num_posts: int):
+        """Returns the normalized subreddit and its newest num_posts posts"""
+        name = self.subreddit_name(coin)
+        about = self._get("/r/{0}/about.json".format(name))["data"]
+        subreddit = {
+            "name": name,
+            "subscribers": about.get("subscribers") or 0,
+            "date_created": _date(about.get("created_utc")),
+        }
+
+        posts = list()
+        after = None
+        while len(posts) < num_posts:
+            params = {"limit": min(PAGE_SIZE, num_posts - len(posts))}
+            if after is not None:
+                params["after"] = after
+            listing = self._get("/r/{0}/new.json".format(name), params)["data"]
+            posts.extend(_normalize_post(child["data"], coin.name, name)
+                         for child in listing["children"] if child["kind"] == "t3")
+            after = listing.get("after")
+            if after is None or not listing["children"]:
+                break
+
+        self._score(posts, [post["title"] + " " + post["content"] for post in posts])
+        METRICS.counter("reddit_posts_collected_total", coin=coin.name).inc(len(posts))
+        return subreddit, posts
+
+
+    def _collect_comments(self, post: dict) -> list:
+        """Returns every comment of a post, flattened and normalized"""
+        _, listing = self._get("/comments/{0}.json".format(post["id"]),
+                               {"limit": 500, "raw_json": 1})
+        comments = list()
+        # Depth first walk of the tree, without recursion as trees can be deep
+        stack = list(reversed(listing["data"]["children"]))
+        while stack:
+            child = stack.pop()
+            if child["kind"] != "t1":
+                # "more" stubs need one request per stub, they're skipped
+                continue
+            data = child["data"]
+            comments.append(_normalize_comment(data, post))
+            replies = data.get("replies")
+            if replies:
+                stack.extend(reversed(replies["data"]["children"]))
+
+        self._score(comments, [comment["content"] for comment in comments])
+        METRICS.counter("reddit_comments_collected_total", coin=post["coin"]).inc(len(comments))
+        return comments
+
+
+    def _score(self, records: list, texts: list):
+        if not records:
+            return
+        from .sentiment import get_scorer, score_texts
+
+        scores = score_texts(texts, get_scorer(self.scorer))
+        for record, sentiment in zip(records, scores.tolist()):
+            record["sentiment"] = sentiment
+
+
+    def _get(self, path: str, params: dict = None):
+        """
+        Rate limited GET of a reddit JSON endpoint, retried on rate limits,
+        server errors and timeouts (see resilience.py)
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            import requests
+
+            session = requests.Session()
+            session.headers["User-Agent"] = USER_AGENT
+            self._local.session = session
+
+        def attempt(timeout):
+            self._rate_limiter.acquire()
+            METRICS.counter("api_requests_total", api="reddit").inc()
+            try:
+                with METRICS.timer("api_request_seconds", api="reddit"):
+                    response = session.get(self.base_url + path, params=params,
+                                           timeout=timeout)
+                    response.raise_for_status()
+                    return response.json()
+            except Exception:
+                METRICS.counter("api_errors_total", api="reddit").inc()
+                raise
+
+        return call("reddit", attempt, self.retry_policy)
+
+
+def _normalize_post(data: dict, coin: str, subreddit: str) -> dict:
+    user = _user(data)
+    return {
+        "id": data["id"],
+        "date": _date(data["created_utc"]),
+        "title": data.get("title", "")[:MAX_TITLE_LENGTH],
+        "content": data.get("selftext", "")[:MAX_POST_LENGTH],
+        "coin": coin,
+        "sentiment": None,
+        "user_id": user["id"] if user else None,
+        # The score columns are unsigned
+        "score": max(data.get("score", 0), 0),
+        "num_comments": data.get("num_comments", 0),
+        "upvote_percentage": data.get("upvote_ratio"),
+        "subreddit": subreddit,
+        "link": data.get("permalink", ""),
+        "user": user,
+    }
+
+
+def _normalize_comment(data: dict, post: dict) -> dict:
+    user = _user(data)
+    return {
+        "id": data["id"],
+        "date": _date(data["created_utc"]),
+        "content": data.get("body", "")[:MAX_COMMENT_LENGTH],
+        "coin": post["coin"],
+        "sentiment": None,
+        # reddit_comments stores the numeric value of the base36 ids
+        "user_id": int(user["id"], 36) if user else 0,
+        "score": max(data.get("score", 0), 0),
+        "parent_id": int(data["parent_id"].split("_", 1)[1], 36),
+        "permalink": data.get("permalink", ""),
+        "submission_id": post["id"],
+        "user": user,
+    }
+
+
+def _user(data: dict):
+    """Returns the author of a post/comment, None if it was deleted"""
+    fullname = data.get("author_fullname")
+    if not fullname:
+        return None
+    return {"id": fullname.split("_", 1)[1],
+            "username": data.get("author", "")[:MAX_USERNAME_LENGTH]}
+
+
+def _date(created_utc) -> str:
+    if created_utc is None:
+        return None
+    return datetime.fromtimestamp(created_utc, timezone.utc).strftime("%Y-%m-%d")
+
+
+if __name__ == "__main__":
+    # Benchmark of the comments collected per second against a local stub
+    # server that answers every request after a simulated round trip, and
+    # fails fault_rate of them
+    # Usage: python3 -m data_collection.reddit_manager [num_threads] [latency] [fault_rate]
+    import sys
+    from .resilience import RetryPolicy
+    from .stub_server import FakeReddit, StubServer
+
+    num_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    fault_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    coins = [Cryptocurrency("coin{0}".format(i), "C{0}".format(i)) for i in range(10)]
+    fake_reddit = FakeReddit(num_posts=150, num_comments=40)
+    with StubServer(fake_reddit.routes(), latency=latency, fault_rate=fault_rate,
+                    faults=(429, 500, 503, "timeout"), hang=2, retry_after=0.1,
+                    seed=0) as server:
+        manager = RedditManager(coins, num_threads=num_threads,
+                                base_url=server.url, requests_per_minute=10 ** 6,
+                                retry_policy=RetryPolicy(base_delay=0.05, timeout=1))
+        start = time.time()
+        collection = manager.collect(num_posts_per_coin=150)
+        elapsed = time.time() - start
+    print("{0} threads, {1:.0f}ms latency: {2} requests ({3} faults), "
+          "{4:.0f} comments/s, {5:.0f} posts/s".format(
+              num_threads, latency * 1000, server.request_count, server.fault_count,
+              len(collection["comments"]) / elapsed,
+              len(collection["posts"]) / elapsed))
+    retries = {key: value for key, value in METRICS.snapshot().items()
+               if key.startswith(("api_retries_total", "api_giveups_total",
+                                  "circuit_breaker"))}
+    for name, values in retries.items():
+        for value in values:
+            print(name, value["labels"], value["value"])
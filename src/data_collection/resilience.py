@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Retries with backoff and circuit breaking shared by the api clients.
+
+Every call goes through call(endpoint, function), which retries the
+failures that are worth retrying:
+    rate limits (429, 420 and binance's 418): waits for Retry-After (or the
+        twitter reset time) unless an on_rate_limit callback can get around
+        it right away, ex: by switching api keys
+    server errors (5xx), timeouts and dropped connections: jittered
+        exponential backoff, these also count towards the endpoint's breaker
+    anything else (ex: 401, 404, bad parameters) is raised right away
+within a deadline for the whole call, including the waits. Once an endpoint
+fails BREAKER_THRESHOLD times in a row its circuit opens and calls fail
+immediately with CircuitOpenError for BREAKER_RESET_SECONDS, after which a
+single trial call decides whether it closes again.
+
+Usage:
+    >>> response = call("binance/klines",
+    ...                 lambda timeout: requests.get(url, timeout=timeout))
+"""
+
+import random
+import socket
+import sys
+import threading
+import time
+
+from .metrics import METRICS
+from .utilities import error
+
+
+MAX_ATTEMPTS = 5
+# Backoff before the nth retry is uniform in [0, min(MAX_DELAY, BASE_DELAY * 2^n)]
+BASE_DELAY = 0.5
+MAX_DELAY = 30
+# Seconds a call may take including its retries, and each attempt at most
+DEADLINE = 120
+REQUEST_TIMEOUT = 10
+
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 60
+
+RATE_LIMIT_STATUSES = (418, 420, 429)
+
+RATE_LIMITED = "rate_limit"
+SERVER_ERROR = "server_error"
+TIMEOUT = "timeout"
+CONNECTION = "connection"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit is open"""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a call runs out of time before an attempt succeeded"""
+
+
+class RetryPolicy:
+    """How often and for how long a call is retried"""
+
+    def __init__(self, max_attempts: int = MAX_ATTEMPTS,
+                 base_delay: float = BASE_DELAY, max_delay: float = MAX_DELAY,
+                 deadline: float = DEADLINE, timeout: float = REQUEST_TIMEOUT):
+        """
+        :param max_attempts: int of attempts, including the first one
+        :param base_delay: float of seconds of the first backoff
+        :param max_delay: float cap on the seconds of a single backoff
+        :param deadline: float of seconds the whole call may take
+        :param timeout: float of seconds a single attempt may take
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.timeout = timeout
+
+
+    def backoff(self, retry: int) -> float:
+        """Returns the seconds to wait before the retry-th retry (full jitter)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+class CircuitBreaker:
+    """
+    Thread safe circuit breaker of one endpoint.
+
+    Usage:
+        >>> breaker = CircuitBreaker("reddit")
+        >>> breaker.allow()  # raises CircuitOpenError while open
+        >>> breaker.record_failure()
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, endpoint: str, threshold: int = BREAKER_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        """
+        :param threshold: int of consecutive failures that open the circuit
+        :param reset_seconds: float of seconds the circuit stays open
+        """
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+
+    def allow(self):
+        """Raises CircuitOpenError unless a call to the endpoint may go ahead"""
+        with self._lock:
+            if self.state == CircuitBreaker.OPEN:
+                if time.monotonic() - self._opened < self.reset_seconds:
+                    raise CircuitOpenError("Circuit of {0} is open".format(self.endpoint))
+                self._set_state(CircuitBreaker.HALF_OPEN)
+            if self.state == CircuitBreaker.HALF_OPEN:
+                # Only one trial call at a time
+                if self._trial:
+                    raise CircuitOpenError("Circuit of {0} is half open".format(self.endpoint))
+                self._trial = True
+
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial = False
+            if self.state != CircuitBreaker.CLOSED:
+                self._set_state(CircuitBreaker.CLOSED)
+
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self.state == CircuitBreaker.HALF_OPEN or \
+                    self._failures >= self.threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    METRICS.counter("circuit_breaker_opened_total",
+                                    endpoint=self.endpoint).inc()
+                    error("Opening the circuit of {0} after {1} failures".format(
+                        self.endpoint, self._failures))
+                self._opened = time.monotonic()
+                self._set_state(CircuitBreaker.OPEN)
+
+
+    def record_neutral(self):
+        """Ends a trial call whose outcome says nothing about the endpoint"""
+        with self._lock:
+            self._trial = False
+
+
+    def _set_state(self, state: str):
+        self.state = state
+        states = (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN)
+        METRICS.gauge("circuit_breaker_state", endpoint=self.endpoint).set(
+            states.index(state))
+
+
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    """Returns the CircuitBreaker of an endpoint, shared by every thread"""
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(endpoint)
+        return _breakers[endpoint]
+
+
+def call(endpoint: str, function, policy: RetryPolicy = DEFAULT_POLICY,
+         on_rate_limit=None):
+    """
+    Returns function(timeout) once an attempt succeeds, retrying the
+    retryable failures (see classify()) within the policy's deadline
+
+    :param endpoint: str name of the endpoint, every endpoint has its own
+                     circuit breaker and metrics, ex: "binance/klines"
+    :param function: callable that makes the request, it gets the float of
+                     seconds the attempt may take
+    :param policy: RetryPolicy of the call
+    :param on_rate_limit: optional callable(exception) run when rate limited,
+                          if it returns True the call is retried after a
+                          regular backoff instead of waiting for the limit
+    :raises CircuitOpenError: if the endpoint's circuit is open
+    :raises DeadlineExceeded: if the deadline passes before a retry
+    :raises: the last exception once attempts run out or if it isn't retryable
+    """
+    breaker = get_breaker(endpoint)
+    deadline = time.monotonic() + policy.deadline
+    attempt = 0
+    while True:
+        breaker.allow()
+        attempt += 1
+        remaining = deadline - time.monotonic()
+        try:
+            result = function(max(min(policy.timeout, remaining), 0.001))
+        except Exception as e:
+            reason, wait = classify(e)
+            if reason in (SERVER_ERROR, TIMEOUT, CONNECTION):
+                breaker.record_failure()
+            else:
+                breaker.record_neutral()
+            if reason is None:
+                raise
+            if attempt >= policy.max_attempts:
+                METRICS.counter("api_giveups_total", endpoint=endpoint,
+                                reason=reason).inc()
+                raise
+
+            if reason != RATE_LIMITED or wait is None or \
+                    (on_rate_limit is not None and on_rate_limit(e)):
+                wait = policy.backoff(attempt - 1)
+            if time.monotonic() + wait > deadline:
+                METRICS.counter("api_giveups_total", endpoint=endpoint,
+                                reason="deadline").inc()
+                raise DeadlineExceeded("{0} gave up after {1} attempts: {2}".format(
+                    endpoint, attempt, e)) from e
+            METRICS.counter("api_retries_total", endpoint=endpoint, reason=reason).inc()
+            METRICS.histogram("api_retry_wait_seconds", endpoint=endpoint).observe(wait)
+            time.sleep(wait)
+            continue
+        breaker.record_success()
+        return result
+
+
+def classify(exception):
+    """
+    Returns a tuple of (reason, seconds to wait) for a failed request, the
+    reason is None if it isn't worth retrying and the wait is None if the
+    response didn't say how long to wait
+
+    Understands the exceptions of requests, the twitter package and urllib
+    """
+    status, headers = _status(exception)
+    if status in RATE_LIMIT_STATUSES:
+        return RATE_LIMITED, _retry_after(headers)
+    if status is not None and status >= 500:
+        return SERVER_ERROR, None
+    if status is not None:
+        return None, None
+
+    requests = sys.modules.get("requests")
+    if isinstance(exception, (socket.timeout, TimeoutError)) or \
+            (requests is not None and isinstance(exception, requests.Timeout)):
+        return TIMEOUT, None
+    if isinstance(exception, ConnectionError) or \
+            (requests is not None and isinstance(exception, requests.ConnectionError)):
+        return CONNECTION, None
+    reason = getattr(exception, "reason", None)
+    if isinstance(reason, (socket.timeout, TimeoutError)):
+        # urllib wraps timeouts while connecting in a URLError
+        return TIMEOUT, None
+    if isinstance(reason, OSError):
+        return CONNECTION, None
+    return None, None
+
+
+def _status(exception):
+    """Returns the (status, headers) of the http response of an exception"""
+    # requests.HTTPError
+    response = getattr(exception, "response", None)
+    if response is not None and getattr(response, "status_code", None) is not None:
+        return response.status_code, response.headers
+    # TwitterHTTPError wraps the urllib HTTPError in .e
+    response = getattr(exception, "e", exception)
+    if isinstance(getattr(response, "code", None), int):
+        return response.code, getattr(response, "headers", None)
+    return None, None
+
+
+def _retry_after(headers):
+    """Returns the seconds the rate limit lasts, None if the headers don't say"""
+    if not headers:
+        return None
+    value = headers.get("Retry-After")
+    if value is not None:
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            return None
+    # Twitter sends the epoch second the limit resets at instead
+    value = headers.get("x-rate-limit-reset")
+    if value is not None:
+        try:
+            return max(float(value) - time.time(), 0)
+        except ValueError:
+            return None
+    return None
+
+
+if __name__ == "__main__":
+    pass
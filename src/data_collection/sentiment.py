@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Pluggable sentiment scorers. Every scorer scores a batch of texts at a time
+and returns their polarity, from -1 (most negative) to 1 (most positive), as
+a numpy array.
+
+Scorers:
+    textblob: TextBlob(content).sentiment.polarity, the original scorer
+    lexicon: a plain dict lookup into the same pattern lexicon TextBlob uses,
+             with pattern's negation and intensifier rules, without building
+             a TextBlob per text
+
+The scorer used by JSONTweetParser and TweetManager is picked with the
+SENTIMENT_SCORER environment variable (default: textblob), or by passing its
+name to them.
+"""
+
+import abc
+import os
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+
+from .metrics import METRICS
+from .utilities import clean_text_for_tfidf, text_sentiment
+
+
+DEFAULT_SCORER = os.environ.get("SENTIMENT_SCORER", "textblob")
+
+# Words that flip (and weaken) the polarity of the next sentiment word, as in
+# pattern's Sentiment.assessments()
+NEGATIONS = frozenset(("not", "never", "no", "n't", "nor", "without"))
+NEGATION_FACTOR = -0.5
+
+
+class SentimentScorer(abc.ABC):
+    """Base class of the sentiment scorers"""
+    name = None
+
+    @abc.abstractmethod
+    def score_batch(self, texts) -> np.ndarray:
+        """
+        :param texts: iterable of str (raw tweet text, the scorer cleans it)
+        :return: float64 array of the polarity of each text
+        """
+
+    def score(self, text: str) -> float:
+        return float(self.score_batch([text])[0])
+
+
+class TextBlobScorer(SentimentScorer):
+    """Scores every text with TextBlob's pattern analyzer"""
+    name = "textblob"
+
+    def score_batch(self, texts) -> np.ndarray:
+        return np.fromiter((text_sentiment(text) for text in texts),
+                           dtype=np.float64)
+
+
+class LexiconScorer(SentimentScorer):
+    """
+    Fast approximation of TextBlob's polarity. The lexicon is reduced once to
+    a token -> polarity dict (and a token -> intensity dict for intensifiers
+    such as 'very'), each text is then scored with one pass over its tokens.
+    """
+    name = "lexicon"
+
+    def __init__(self, lexicon_path: str = None):
+        """
+        :param lexicon_path: optional str path of a pattern sentiment xml
+                             file, defaults to the one shipped with textblob
+        """
+        self.polarity, self.intensity = load_lexicon(lexicon_path)
+
+    def score_batch(self, texts) -> np.ndarray:
+        texts = list(texts)
+        scores = np.zeros(len(texts), dtype=np.float64)
+        polarity = self.polarity
+        intensity = self.intensity
+        for index, text in enumerate(texts):
+            total = 0.0
+            count = 0
+            modifier = 1.0
+            for token in clean_text_for_tfidf(text).split():
+                if token in NEGATIONS:
+                    modifier = NEGATION_FACTOR
+                    continue
+                value = polarity.get(token)
+                if value is None:
+                    continue
+                boost = intensity.get(token)
+                if boost is not None:
+                    # Intensifiers modify the next word instead of counting
+                    modifier *= boost
+                    continue
+                value *= modifier
+                total += -1.0 if value < -1.0 else 1.0 if value > 1.0 else value
+                count += 1
+                modifier = 1.0
+            if count:
+                scores[index] = total / count
+        return scores
+
+
+def load_lexicon(path: str = None):
+    """
+    Reads a pattern sentiment xml file and returns a tuple of dicts:
+        (word -> polarity, intensifier -> intensity)
+    Like pattern, a word's polarity is the average over its adjective senses
+    (or over all its senses when it is never an adjective).
+    """
+    if path is None:
+        import textblob
+        path = os.path.join(os.path.dirname(textblob.__file__), "en",
+                            "en-sentiment.xml")
+
+    senses = dict()
+    for _, element in ElementTree.iterparse(path):
+        if element.tag != "word":
+            continue
+        form = element.get("form", "").lower()
+        if not form or " " in form:
+            continue
+        senses.setdefault(form, []).append((
+            element.get("pos", ""),
+            float(element.get("polarity", 0.0)),
+            float(element.get("intensity", 1.0)),
+        ))
+        element.clear()
+
+    polarity = dict()
+    intensity = dict()
+    for form, entries in senses.items():
+        adjectives = [entry for entry in entries if entry[0].startswith("JJ")]
+        entries = adjectives or entries
+        polarity[form] = sum(entry[1] for entry in entries) / len(entries)
+        adverb_intensity = [entry[2] for entry in senses[form]
+                            if entry[0].startswith("RB") and entry[2] != 1.0]
+        if adverb_intensity:
+            intensity[form] = sum(adverb_intensity) / len(adverb_intensity)
+    return polarity, intensity
+
+
+SCORERS = {
+    TextBlobScorer.name: TextBlobScorer,
+    LexiconScorer.name: LexiconScorer,
+}
+_instances = dict()
+_instances_lock = threading.Lock()
+
+
+def get_scorer(name: str = None) -> SentimentScorer:
+    """
+    Returns the shared scorer called name (see SCORERS), defaults to the
+    SENTIMENT_SCORER environment variable
+    """
+    name = name or DEFAULT_SCORER
+    if name not in SCORERS:
+        raise ValueError("Unknown sentiment scorer '{0}', expected one of {1}".format(
+            name, sorted(SCORERS)))
+    scorer = _instances.get(name)
+    if scorer is None:
+        with _instances_lock:
+            scorer = _instances.get(name)
+            if scorer is None:
+                scorer = SCORERS[name]()
+                _instances[name] = scorer
+    return scorer
+
+
+def score_texts(texts, scorer: SentimentScorer = None) -> np.ndarray:
+    """Scores a batch of texts with scorer (default: get_scorer())"""
+    scorer = scorer or get_scorer()
+    texts = list(texts)
+    with METRICS.timer("sentiment_score_seconds", scorer=scorer.name):
+        scores = scorer.score_batch(texts)
+    METRICS.counter("sentiment_texts_scored_total", scorer=scorer.name).inc(len(texts))
+    return scores
+
+
+def agreement_report(texts, reference: SentimentScorer = None,
+                     candidate: SentimentScorer = None) -> dict:
+    """
+    Compares two scorers on the same texts, returns a dict with the
+    correlation, mean absolute error and how often both agree on the sign
+    (positive/neutral/negative) along with each scorer's texts per second
+
+    :param reference: defaults to TextBlobScorer()
+    :param candidate: defaults to LexiconScorer()
+    """
+    texts = list(texts)
+    reference = reference or get_scorer("textblob")
+    candidate = candidate or get_scorer("lexicon")
+
+    start = time.perf_counter()
+    expected = reference.score_batch(texts)
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = candidate.score_batch(texts)
+    candidate_time = time.perf_counter() - start
+
+    if len(texts) > 1 and expected.std() > 0 and actual.std() > 0:
+        correlation = float(np.corrcoef(expected, actual)[0, 1])
+    else:
+        correlation = float("nan")
+    return {
+        "num_texts": len(texts),
+        "correlation": correlation,
+        "mean_absolute_error": float(np.abs(expected - actual).mean()) if texts else 0.0,
+        "sign_agreement": float((np.sign(expected) == np.sign(actual)).mean()) if texts else 1.0,
+        "within_0.1": float((np.abs(expected - actual) <= 0.1).mean()) if texts else 1.0,
+        reference.name + "_texts_per_second": len(texts) / max(reference_time, 1e-9),
+        candidate.name + "_texts_per_second": len(texts) / max(candidate_time, 1e-9),
+    }
+
+
+if __name__ == "__main__":
+    # Accuracy agreement and throughput of the lexicon scorer against
+    # TextBlob, on a file with one text per line
+    # Usage: python3 -m data_collection.sentiment tweets.txt
+    import json
+    import sys
+
+    with open(sys.argv[1], "r") as f:
+        texts = [line.strip() for line in f if line.strip()]
+    print(json.dumps(agreement_report(texts), indent=4))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Vectorized aggregation of tweet sentiment per coin.
+Coin names are mapped to integer codes once and every statistic is then
+computed for all coins at the same time with np.bincount instead of
+updating nested dicts one tweet at a time.
+"""
+
+import numpy as np
+
+
+# Statistics that are counts and are returned as ints
+COUNT_STATISTICS = ("length", "pos_sentiment", "neg_sentiment")
+
+
+class SentimentAggregator:
+    """
+    Class for computing the per coin sentiment statistics consumed by
+    DataManager.fill_market_data_tables()
+
+    Usage:
+        >>> aggregator = SentimentAggregator(CRYPTOS)
+        >>> aggregator.add(tweets)
+        >>> aggregator.result()
+        ... {"Bitcoin": {"length": 412, "sum": 31.2, ...}, ...}
+    """
+
+    def __init__(self, coins, extra_statistics=False):
+        """
+        :param coins: iterable of Cryptocurrency objects (or coin names)
+        :param extra_statistics: bool on whether to also compute the median,
+                                 standard deviation and the follower and
+                                 retweet weighted means of each coin
+        """
+        self.coin_names = list()
+        self._codes = dict()
+        for coin in coins:
+            name = getattr(coin, "name", coin)
+            if name not in self._codes:
+                self._codes[name] = len(self.coin_names)
+                self.coin_names.append(name)
+
+        self.extra_statistics = extra_statistics
+        self._chunks = list()
+
+
+    def encode(self, names) -> np.ndarray:
+        """
+        Returns an int array with the code of each coin name, names that
+        don't belong to any coin are encoded as -1
+        """
+        codes = self._codes
+        return np.fromiter((codes.get(name, -1) for name in names),
+                           dtype=np.int32)
+
+
+    def add(self, tweets):
+        """
+        Adds a batch of tweets (as generated by data_collection/json_parser.py)
+        to the aggregation
+        """
+        tweets = list(tweets)
+        if not tweets:
+            return
+        codes = self.encode(tweet["coin"] for tweet in tweets)
+        sentiments = np.fromiter((tweet["sentiment"] for tweet in tweets),
+                                 dtype=np.float64, count=len(tweets))
+        followers = retweets = None
+        if self.extra_statistics:
+            followers = np.fromiter((tweet["user"]["followers"] for tweet in tweets),
+                                    dtype=np.float64, count=len(tweets))
+            retweets = np.fromiter((tweet["retweets"] for tweet in tweets),
+                                   dtype=np.float64, count=len(tweets))
+        self.add_arrays(codes, sentiments, followers, retweets)
+
+
+    def add_arrays(self, codes, sentiments, followers=None, retweets=None):
+        """
+        Adds already encoded tweets to the aggregation
+
+        :param codes: int array of coin codes (see encode())
+        :param sentiments: float array of the sentiment of each tweet
+        :param followers: float array of the followers of each tweet's user,
+                          only needed for extra_statistics
+        :param retweets: float array of the retweets of each tweet, only
+                         needed for extra_statistics
+        """
+        codes = np.asarray(codes)
+        known = codes >= 0
+        chunk = [codes[known], np.asarray(sentiments, dtype=np.float64)[known]]
+        if self.extra_statistics:
+            chunk.append(np.asarray(followers, dtype=np.float64)[known])
+            chunk.append(np.asarray(retweets, dtype=np.float64)[known])
+        self._chunks.append(chunk)
+
+
+    def result(self) -> dict:
+        """
+        returns a dict with the following structure
+            {
+                coin_1: {
+                    "length": 0,
+                    "sum": 0,
+                    "pos_sentiment": 0,
+                    "neg_sentiment": 0
+                },
+                coin_2: {
+                    ...
+            }
+        Only coins with at least one tweet are included. With
+        extra_statistics each coin also has "median", "std",
+        "follower_weighted" and "retweet_weighted" entries.
+        """
+        if not self._chunks:
+            return dict()
+        columns = [np.concatenate(column) for column in zip(*self._chunks)]
+        self._chunks = [columns]
+        codes, sentiments = columns[0], columns[1]
+
+        num_coins = len(self.coin_names)
+        length = np.bincount(codes, minlength=num_coins)
+        total = np.bincount(codes, weights=sentiments, minlength=num_coins)
+        positive = np.bincount(codes, weights=sentiments > 0, minlength=num_coins)
+        negative = np.bincount(codes, weights=sentiments < 0, minlength=num_coins)
+
+        statistics = {
+            "length": length,
+            "sum": total,
+            "pos_sentiment": positive,
+            "neg_sentiment": negative,
+        }
+        if self.extra_statistics:
+            statistics.update(self._extra(codes, sentiments, columns[2],
+                                          columns[3], length, total))
+
+        coin_sentiment = dict()
+        for code in np.flatnonzero(length):
+            coin_sentiment[self.coin_names[code]] = {
+                key: int(values[code]) if key in COUNT_STATISTICS
+                else float(values[code])
+                for key, values in statistics.items()
+            }
+        return coin_sentiment
+
+
+    def reset(self):
+        """Removes every tweet that was added"""
+        self._chunks = list()
+
+
+    def _extra(self, codes, sentiments, followers, retweets, length, total):
+        num_coins = len(self.coin_names)
+        safe_length = np.maximum(length, 1)
+        mean = total / safe_length
+        squares = np.bincount(codes, weights=sentiments ** 2, minlength=num_coins)
+        std = np.sqrt(np.maximum(squares / safe_length - mean ** 2, 0))
+
+        # Sort by coin and then sentiment so every coin's sentiments form a
+        # contiguous sorted run, the median sits in the middle of each run
+        ordered = sentiments[np.lexsort((sentiments, codes))]
+        starts = np.concatenate(([0], np.cumsum(length)[:-1]))
+        lower = starts + (safe_length - 1) // 2
+        upper = starts + safe_length // 2
+        median = np.zeros(num_coins)
+        has_tweets = length > 0
+        median[has_tweets] = (ordered[lower[has_tweets]] +
+                              ordered[upper[has_tweets]]) / 2
+
+        return {
+            "median": median,
+            "std": std,
+            "follower_weighted": _weighted_mean(codes, sentiments, followers,
+                                                mean, num_coins),
+            "retweet_weighted": _weighted_mean(codes, sentiments, retweets,
+                                               mean, num_coins),
+        }
+
+
+def _weighted_mean(codes, sentiments, weights, fallback, num_coins):
+    """
+    Per coin mean of sentiments weighted by weights, coins whose weights
+    are all 0 fall back to their unweighted mean
+    """
+    weighted = np.bincount(codes, weights=sentiments * weights,
+                           minlength=num_coins)
+    weight_total = np.bincount(codes, weights=weights, minlength=num_coins)
+    return np.divide(weighted, weight_total, out=fallback.copy(),
+                     where=weight_total > 0)
+
+
+def _dict_aggregate(coins, sentiments):
+    """The per tweet dict implementation, kept for the benchmark below"""
+    coin_sentiment = dict()
+    for coin, sentiment in zip(coins, sentiments):
+        if coin not in coin_sentiment.keys():
+            coin_sentiment[coin] = {
+                    "length": 0,
+                    "sum": 0,
+                    "pos_sentiment": 0,
+                    "neg_sentiment": 0
+            }
+        if sentiment > 0:
+            coin_sentiment[coin]["pos_sentiment"] += 1
+        elif sentiment < 0:
+            coin_sentiment[coin]["neg_sentiment"] += 1
+        coin_sentiment[coin]["sum"] += sentiment
+        coin_sentiment[coin]["length"] += 1
+    return coin_sentiment
+
+
+if __name__ == "__main__":
+    # Benchmark against the per tweet dict updates with 1M tweets
+    import time
+
+    NUM_TWEETS = 1000000
+    names = ["coin_{0}".format(i) for i in range(34)]
+    rng = np.random.default_rng(0)
+    codes = rng.integers(0, len(names), NUM_TWEETS)
+    sentiments = np.round(rng.uniform(-1, 1, NUM_TWEETS), 2)
+    sentiments[rng.random(NUM_TWEETS) < 0.4] = 0
+    followers = rng.integers(0, 100000, NUM_TWEETS).astype(np.float64)
+    retweets = rng.integers(0, 50, NUM_TWEETS).astype(np.float64)
+    coins = [names[code] for code in codes]
+    sentiment_list = sentiments.tolist()
+
+    start = time.time()
+    expected = _dict_aggregate(coins, sentiment_list)
+    dict_time = time.time() - start
+
+    start = time.time()
+    aggregator = SentimentAggregator(names)
+    aggregator.add_arrays(aggregator.encode(coins), sentiments)
+    result = aggregator.result()
+    encoded_time = time.time() - start
+
+    start = time.time()
+    aggregator = SentimentAggregator(names)
+    aggregator.add_arrays(codes, sentiments)
+    aggregator.result()
+    vector_time = time.time() - start
+
+    start = time.time()
+    aggregator = SentimentAggregator(names, extra_statistics=True)
+    aggregator.add_arrays(codes, sentiments, followers, retweets)
+    aggregator.result()
+    extra_time = time.time() - start
+
+    for name in names:
+        assert result[name]["length"] == expected[name]["length"]
+        assert abs(result[name]["sum"] - expected[name]["sum"]) < 1e-6
+
+    print("{0} tweets, {1} coins".format(NUM_TWEETS, len(names)))
+    print("dict updates:              {:0.3f}s".format(dict_time))
+    print("bincount (with encoding):  {:0.3f}s".format(encoded_time))
+    print("bincount (pre encoded):    {:0.3f}s".format(vector_time))
+    print("bincount + extra stats:    {:0.3f}s".format(extra_time))
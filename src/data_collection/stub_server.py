@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Local stub HTTP server for exercising the collectors without touching the
+real apis (and their rate limits).
+
+Routes map a path prefix to a handler that gets the request path and query
+and returns (status, body), bodies are sent as JSON. FakeReddit provides the
+routes of the subset of reddit's JSON api used by RedditManager.
+
+Faults can be injected into a fraction of the responses to exercise the
+retries and circuit breakers of resilience.py: error statuses (rate limits
+come with a Retry-After header) and "timeout", which holds the response back
+for hang seconds.
+
+Usage:
+    >>> with StubServer(FakeReddit(num_posts=50).routes(), latency=0.01) as server:
+    ...     manager = RedditManager(coins, base_url=server.url)
+    ...     manager.collect(num_posts_per_coin=50)
+    >>> StubServer(routes, fault_rate=0.2, faults=(429, 503, "timeout"), hang=15)
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class StubServer:
+    """Threaded HTTP server running in a background thread"""
+
+    def __init__(self, routes: dict = None, latency: float = 0.0,
+                 host: str = "127.0.0.1", port: int = 0, fault_rate: float = 0.0,
+                 faults=(429, 500, 503), hang: float = 30.0,
+                 retry_after: float = 1, seed: int = None):
+        """
+        :param routes: dict of path prefix -> handler(path, query) which
+                       returns a tuple of (int status, JSON serializable body)
+                       and optionally a dict of headers
+        :param latency: float of seconds every response is delayed by, to
+                        simulate the round trip to the real api
+        :param port: int port to listen on, 0 picks a free one
+        :param fault_rate: float probability that a request gets one of the
+                           faults instead of its route's response
+        :param faults: tuple of the injected faults, int statuses or "timeout"
+        :param hang: float of seconds a "timeout" holds the response back
+        :param retry_after: float of seconds sent in the Retry-After header
+                            of injected rate limits
+        :param seed: optional int seed of which requests get faults
+        """
+        self.routes = dict(routes or {})
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.faults = tuple(faults)
+        self.hang = hang
+        self.retry_after = retry_after
+        self.request_count = 0
+        self.fault_count = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+
+    def route(self, prefix: str, handler):
+        self.routes[prefix] = handler
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="stub_server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+
+    def handle(self, path: str, query: dict):
+        """
+        Returns the (status, body, headers) of a request, the longest prefix
+        wins
+        """
+        with self._lock:
+            self.request_count += 1
+            fault = None
+            if self.faults and self._random.random() < self.fault_rate:
+                fault = self._random.choice(self.faults)
+                self.fault_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fault == "timeout":
+            time.sleep(self.hang)
+            return 504, {"error": 504, "message": "Injected timeout"}, {}
+        if fault is not None:
+            headers = dict()
+            if fault in (418, 420, 429):
+                headers["Retry-After"] = str(self.retry_after)
+            return fault, {"error": fault, "message": "Injected fault"}, headers
+
+        for prefix in sorted(self.routes, key=len, reverse=True):
+            if path.startswith(prefix):
+                try:
+                    response = self.routes[prefix](path, query)
+                except Exception as e:
+                    return 500, {"error": 500, "message": str(e)}, {}
+                return response if len(response) == 3 else (*response, {})
+        return 404, {"error": 404, "message": "Not Found"}, {}
+
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                status, body, headers = stub.handle(url.path, query)
+                content = json.dumps(body).encode("utf8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(content)))
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    self.wfile.write(content)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up on a hanging response
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class FakeReddit:
+    """
+    Deterministic fake of reddit's listing, about and comments endpoints,
+    every subreddit has num_posts posts with up to num_comments comments each
+    """
+    WORDS = ("moon", "great", "terrible", "hodl", "buy", "sell", "not", "very",
+             "good", "bad", "scam", "bullish", "bearish", "price", "happy",
+             "crash", "pump", "dump", "love", "hate", "the", "is", "to", "a")
+
+    def __init__(self, num_posts: int = 100, num_comments: int = 20,
+                 seed: int = 0):
+        self.num_posts = num_posts
+        self.num_comments = num_comments
+        self.seed = seed
+        self._subreddits = dict()
+
+
+    def routes(self) -> dict:
+        return {"/r/": self.subreddit, "/comments/": self.comments}
+
+
+    def subreddit(self, path: str, query: dict):
+        parts = path.strip("/").split("/")
+        if len(parts) < 3:
+            return 404, {"error": 404}
+        name, endpoint = parts[1], parts[2]
+        index = self._subreddit_index(name)
+        if endpoint == "about.json":
+            return 200, {"kind": "t5", "data": {
+                "display_name": name, "name": "t5_" + to_base36(index + 1),
+                "subscribers": 1000 * (index + 1),
+                "created_utc": 1300000000.0 + index * 86400}}
+        if endpoint != "new.json":
+            return 404, {"error": 404}
+
+        limit = min(int(query.get("limit", 25)), 100)
+        start = 0
+        if query.get("after"):
+            start = self._post_number(query["after"][3:]) % 1000000 + 1
+        numbers = range(start, min(start + limit, self.num_posts))
+        children = [{"kind": "t3", "data": self._post(name, index, number)}
+                    for number in numbers]
+        after = children[-1]["data"]["name"] if numbers and \
+            numbers[-1] + 1 < self.num_posts else None
+        return 200, {"kind": "Listing", "data": {"after": after,
+                                                 "children": children}}
+
+
+    def comments(self, path: str, query: dict):
+        post_id = path.strip("/").split("/")[1]
+        if post_id.endswith(".json"):
+            post_id = post_id[:-len(".json")]
+        number = self._post_number(post_id)
+        index, number = divmod(number, 1000000)
+        names = [name for name, i in self._subreddits.items() if i == index]
+        if not names or number >= self.num_posts:
+            return 404, {"error": 404}
+        post = self._post(names[0], index, number)
+
+        rng = random.Random("{0}-{1}".format(self.seed, post_id))
+        num_comments = rng.randint(0, self.num_comments)
+        comments = list()
+        for position in range(num_comments):
+            # Each comment replies to the post or to an earlier comment
+            parent = rng.randint(-1, position - 1) if position else -1
+            comments.append({
+                "id": to_base36(int(post_id, 36) * 1000 + position),
+                "parent": parent,
+                "score": rng.randint(-5, 200),
+                "body": self._text(rng, 6, 30),
+                "author": "user{0}".format(rng.randint(0, 5000)),
+            })
+
+        def build(position):
+            comment = comments[position]
+            replies = [build(child) for child, reply in enumerate(comments)
+                       if reply["parent"] == position]
+            return {"kind": "t1", "data": {
+                "id": comment["id"], "name": "t1_" + comment["id"],
+                "body": comment["body"], "author": comment["author"],
+                "author_fullname": "t2_" + to_base36(int(comment["author"][4:]) + 1),
+                "created_utc": post["created_utc"] + 60 * (position + 1),
+                "score": comment["score"],
+                "parent_id": "t1_" + comments[comment["parent"]]["id"]
+                             if comment["parent"] >= 0 else post["name"],
+                "link_id": post["name"],
+                "permalink": post["permalink"] + comment["id"] + "/",
+                "replies": {"kind": "Listing", "data": {"after": None,
+                                                        "children": replies}}
+                           if replies else "",
+            }}
+
+        top_level = [build(position) for position, comment in enumerate(comments)
+                     if comment["parent"] == -1]
+        return 200, [
+            {"kind": "Listing", "data": {"after": None, "children": [
+                {"kind": "t3", "data": post}]}},
+            {"kind": "Listing", "data": {"after": None, "children": top_level}},
+        ]
+
+
+    def _subreddit_index(self, name: str) -> int:
+        return self._subreddits.setdefault(name.lower(), len(self._subreddits))
+
+
+    def _post(self, name: str, index: int, number: int) -> dict:
+        post_id = to_base36(index * 1000000 + number + 1)
+        rng = random.Random("{0}-{1}".format(self.seed, post_id))
+        author = rng.randint(0, 5000)
+        return {
+            "id": post_id, "name": "t3_" + post_id,
+            "title": self._text(rng, 4, 12), "selftext": self._text(rng, 0, 60),
+            "author": "user{0}".format(author),
+            "author_fullname": "t2_" + to_base36(author + 1),
+            # Newest first, like /new
+            "created_utc": 1550000000.0 - number * 600,
+            "score": rng.randint(0, 500), "num_comments": self.num_comments,
+            "upvote_ratio": round(rng.uniform(0.5, 1.0), 2),
+            "subreddit": name, "subreddit_id": "t5_" + to_base36(index + 1),
+            "permalink": "/r/{0}/comments/{1}/".format(name, post_id),
+        }
+
+
+    def _post_number(self, post_id: str) -> int:
+        return int(post_id, 36) - 1
+
+
+    def _text(self, rng, min_words: int, max_words: int) -> str:
+        return " ".join(rng.choice(self.WORDS)
+                        for _ in range(rng.randint(min_words, max_words)))
+
+
+def to_base36(number: int) -> str:
+    """Encodes a non negative int the way reddit encodes its ids"""
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    encoded = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = digits[remainder] + encoded
+        if number == 0:
+            return encoded
+
+
+if __name__ == "__main__":
+    # Serves a fake reddit until interrupted
+    # Usage: python3 -m data_collection.stub_server [port]
+    import sys
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    with StubServer(FakeReddit().routes(), port=port) as server:
+        print("Serving a fake reddit on", server.url)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
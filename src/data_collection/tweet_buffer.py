@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Append only buffer of parsed tweets that keeps its memory use bounded.
+
+Tweets are encoded as they are appended (msgpack when it is installed,
+json otherwise) and kept as length-prefixed records in one bytearray, once
+that reaches max_memory_bytes it is written out as a segment file in a
+temporary directory. Iterating the buffer memory-maps the segments one at a
+time and decodes one record at a time, so neither collecting nor consuming
+a run ever holds every tweet in memory.
+
+Usage:
+    >>> with TweetBuffer() as tweets:
+    ...     tweets.extend(parsed_tweets)
+    ...     for batch in tweets.batches(100):
+    ...         database.insert_tweets(batch)
+"""
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .metrics import METRICS
+
+
+# Size of the in memory records before they are spilled to a segment file
+MAX_MEMORY_BYTES = 16 * 1024 * 1024
+
+# Every record is prefixed by its length as a little endian uint32
+_LENGTH = struct.Struct("<I")
+
+
+class TweetBuffer:
+    """
+    Thread safe, append only sequence of tweet dicts (as generated by
+    data_collection/json_parser.py) that spills to disk
+    """
+
+    def __init__(self, max_memory_bytes: int = MAX_MEMORY_BYTES,
+                 directory: str = None):
+        """
+        :param max_memory_bytes: int of how many bytes of encoded tweets are
+                                 kept in memory before spilling them
+        :param directory: optional str of the directory the temporary segment
+                          directory is created in (default: the system's)
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self._parent_directory = directory
+        self._directory = None
+        self._segments = list()
+        self._pending = bytearray()
+        self._length = 0
+        self._lock = threading.Lock()
+        if msgpack is not None:
+            self._encode = msgpack.packb
+            self._decode = msgpack.unpackb
+        else:
+            self._encode = _json_encode
+            self._decode = json.loads
+
+
+    def __len__(self):
+        return self._length
+
+
+    def __iter__(self):
+        """Iterates over every tweet in the order they were appended"""
+        with self._lock:
+            segments = list(self._segments)
+            pending = bytes(self._pending)
+        for path in segments:
+            with open(path, "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield from self._records(data)
+        yield from self._records(pending)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+    def append(self, tweet: dict):
+        self.extend([tweet])
+
+
+    def extend(self, tweets):
+        """Encodes and appends tweets, spilling to disk past the threshold"""
+        records = bytearray()
+        count = 0
+        for tweet in tweets:
+            record = self._encode(tweet)
+            records += _LENGTH.pack(len(record))
+            records += record
+            count += 1
+        with self._lock:
+            self._pending += records
+            self._length += count
+            if len(self._pending) >= self.max_memory_bytes:
+                self._spill()
+
+
+    def batches(self, batch_size: int):
+        """Yields the tweets as lists of at most batch_size tweets"""
+        batch = list()
+        for tweet in self:
+            batch.append(tweet)
+            if len(batch) == batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+
+    @property
+    def num_segments(self) -> int:
+        return len(self._segments)
+
+
+    def close(self):
+        """Drops every tweet and removes the segment files"""
+        with self._lock:
+            if self._directory is not None:
+                shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+            self._segments = list()
+            self._pending = bytearray()
+            self._length = 0
+
+
+    def _spill(self):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix="tweets-",
+                                               dir=self._parent_directory)
+        path = os.path.join(self._directory,
+                            "{0:06d}.seg".format(len(self._segments)))
+        with open(path, "wb") as f:
+            f.write(self._pending)
+        METRICS.counter("tweet_buffer_spilled_bytes_total").inc(len(self._pending))
+        self._segments.append(path)
+        self._pending = bytearray()
+
+
+    def _records(self, data):
+        decode = self._decode
+        offset = 0
+        end = len(data)
+        while offset < end:
+            length, = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            yield decode(data[offset:offset + length])
+            offset += length
+
+
+def _json_encode(tweet: dict) -> bytes:
+    return json.dumps(tweet, separators=(",", ":")).encode("utf8")
+
+
+if __name__ == "__main__":
+    # Peak memory of buffering and reading back a large run
+    # Usage: python3 -m data_collection.tweet_buffer [num_tweets]
+    import resource
+    import sys
+    import time
+
+    num_tweets = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    tweet = {"id": 0, "text": "Bitcoin is going to the moon! #btc " * 4,
+             "hashtags": ["btc", "crypto"], "date": "2019-4-25",
+             "created_at": "2019-4-25 10:43:41", "retweets": 3,
+             "user": {"date_created": "2014-4-25", "id": 1, "followers": 150,
+                      "friends": 80},
+             "coin": "bitcoin", "sentiment": 0.25}
+    start = time.time()
+    with TweetBuffer() as tweets:
+        for index in range(0, num_tweets, 1000):
+            tweets.extend(dict(tweet, id=i) for i in range(index, index + 1000))
+        num_read = sum(len(batch) for batch in tweets.batches(100))
+        print("{0} tweets written and read back in {1:.2f}s, {2} segments, "
+              "{3} encoding".format(num_read, time.time() - start,
+                                    tweets.num_segments,
+                                    "msgpack" if msgpack else "json"))
+    print("Peak RSS: {0:.1f} MB".format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
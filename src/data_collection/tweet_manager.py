@@ -33,9 +33,13 @@ from twitter import Twitter, OAuth, TwitterHTTPError
 from .json_parser import JSONTweetParser
 from .api_manager import APIManager 
 from .utilities import error
+from .metrics import METRICS
+from .resilience import call
+from .tweet_buffer import TweetBuffer
 # sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from .cryptocurrency import Cryptocurrency
+from .coin_registry import CoinRegistry
 
 
 class TweetManager:
@@ -47,62 +51,84 @@ class TweetManager:
         ...     Cryptocurrency("ethereum", "eth", "date")]
         >>> tweet_manager = TweetManager(coins, num_threads=2)
         >>> tweet_manager.get_tweets(num_tweets_per_coin=2)
-        ... [{<tweet_1_info>}, {...}] 
+        ... TweetBuffer([{<tweet_1_info>}, {...}])
     """
     SECONDS_PER_ITERATION = 5
+    # Coins whose search failed this many times in a row are skipped for
+    # the rest of get_tweets()
+    MAX_COIN_FAILURES = 2
 
-    def __init__(self, cryptocurrencies, num_threads=12):
+    def __init__(self, cryptocurrencies, num_threads=12, scorer=None,
+                 api_manager=None):
+        """
+        :param cryptocurrencies: list or tuple of Cryptocurrency to search for
+        :param num_threads: int of the max number of threads searching twitter
+        :param scorer: optional str name of the sentiment scorer used for the
+                       tweets (see sentiment.py), defaults to SENTIMENT_SCORER
+        :param api_manager: optional APIManager to take the api keys from,
+                            ex: one limited to a shard of the keys
+        """
         if not isinstance(cryptocurrencies, list) and \
                 not isinstance(cryptocurrencies, tuple):
             raise TypeError("Cryptocurrencies must be of type 'list' or 'tuple'")
 
-        for coin in cryptocurrencies:
-            if not isinstance(coin, Cryptocurrency):
-                raise TypeError("All cryptocurrencies must be of type 'Cryptocurrency'")
+        # Also rejects duplicate coins, which would be searched twice
+        if not isinstance(cryptocurrencies, CoinRegistry):
+            cryptocurrencies = CoinRegistry(cryptocurrencies)
 
         self.cryptocurrencies = cryptocurrencies
         self.num_threads = min(num_threads, len(cryptocurrencies))
+        self.scorer = scorer
 
-        self._api_manager = APIManager()
+        self._api_manager = api_manager if api_manager is not None else APIManager()
+        # Loaded (and its key verified) on the first call to get_tweets()
         self._twitter = None
         
         # This is used for get_tweets()
-        self._tweets = list()
+        self._tweets = None
+        self._on_batch = None
+        # Index of the current search round of get_tweets()
+        self._round = 0
         
         # Used for storing the all the tasks to complete when multithreading
         self._queue = None
+        # coin name -> (consecutive failures, last error) of the current run
+        self.failed_coins = dict()
         # Lock for prining with threads
         self._lock = threading.Lock()
         self._threads = list()
 
-        # Loads the self._twitter object using the first api key that is functional
-        while True:
-            self._load_twitter_api()
-            try: 
-                raw_tweets = self._twitter.search.tweets(q="test",
-                    result_type='recent', lang='en', count=1)
-                break
-            except TwitterHTTPError as e:
-                continue
-
 
-    def get_tweets(self, num_tweets_per_coin=200, verbose=False):
+    def get_tweets(self, num_tweets_per_coin=200, verbose=False, skip=None,
+                   on_batch=None):
         """
-        Returns a list of dicts where each dict contains all the information
-        regarding a specific tweet, look at json_parser.py for more information
+        Returns a TweetBuffer of dicts where each dict contains all the
+        information regarding a specific tweet, look at json_parser.py for more
+        information. The buffer spills the tweets to disk past a memory
+        threshold, close() it once it has been consumed.
 
         :param num_tweets_per_coin: The maximum number of tweets that will be pulled
                                     from twitter (per coin), note that the limit will 
                                     not always be reached; around 95% of this number will.
         :param verbose: bool for whether to display more in-progress information
+        :param skip: optional callable(coin name, search round) returning True
+                     for the rounds of a coin that were already collected
+        :param on_batch: optional callable(coin name, search round, tweets)
+                         that each round's scored tweets of a coin are passed
+                         to (from the searching threads) instead of being kept
+                         in the returned buffer
         """
         start = time.time()
+        self._ensure_twitter_api()
         print("Beginning to pull data for...")
         for coin in self.cryptocurrencies:
             print(coin)
 
         print()    
-        self._tweets = list()
+        self._tweets = TweetBuffer()
+        self.failed_coins = dict()
+        self._on_batch = on_batch
+        self._round = 0
         while num_tweets_per_coin > 0:
             iteration_start = time.time()
             num_tweets_to_pull = min(num_tweets_per_coin, 200)
@@ -118,8 +144,10 @@ class TweetManager:
                 self._threads.append(t)
                 t.start()
                 
-            # Add the hashtags to be searched into the queue
-            list(map(self._queue.put, self.cryptocurrencies))
+            # Add the hashtags to be searched into the queue, except the ones
+            # that keep failing
+            list(map(self._queue.put, [coin for coin in self._coins_to_search()
+                                       if skip is None or not skip(coin.name, self._round)]))
 
             # for coin in self.cryptocurrencies:
                 # self._queue.put(coin)
@@ -137,8 +165,11 @@ class TweetManager:
 
         
             num_tweets_per_coin -= num_tweets_to_pull
+            self._round += 1
+            iteration_time = time.time() - iteration_start
+            METRICS.histogram("tweet_collection_iteration_seconds").observe(iteration_time)
             print("Num Tweets remaining: {0}".format(num_tweets_per_coin))
-            print("Time Elapsed: {:.3f} seconds\n".format(time.time() - iteration_start))
+            print("Time Elapsed: {:.3f} seconds\n".format(iteration_time))
             
             # Wait at least until the designated number of seconds allocated
             # for each iteration has passed
@@ -146,10 +177,34 @@ class TweetManager:
                 if (time.time() - iteration_start) >= TweetManager.SECONDS_PER_ITERATION:
                     break
         
+        skipped = self._skipped_coins()
+        if skipped:
+            error("Skipped {0} coins that kept failing: {1}".format(
+                len(skipped), ", ".join(skipped)))
+        METRICS.gauge("tweet_collection_seconds").set(time.time() - start)
+        METRICS.gauge("tweets_collected").set(len(self._tweets))
         print("Entire Job Took: {:.3f} seconds".format(time.time() - start))
         return self._tweets
 
 
+    def _ensure_twitter_api(self):
+        """
+        Loads the self._twitter object using the first api key that is
+        functional, only the first call makes a test search so a TweetManager
+        that is kept around only verifies its key once
+        """
+        if self._twitter is not None:
+            return
+        while True:
+            self._load_twitter_api()
+            try: 
+                raw_tweets = self._twitter.search.tweets(q="test",
+                    result_type='recent', lang='en', count=1)
+                break
+            except TwitterHTTPError as e:
+                continue
+
+
     def _load_twitter_api(self):
         """
         Function to create a twitter api object using the next available
@@ -191,9 +246,34 @@ class TweetManager:
             hashtag = self._queue.get()
             if hashtag is None:
                 break
-            self._mine_tweet_data(hashtag, num_tweets=num_tweets,
-                    verbose=verbose)
-            self._queue.task_done()
+            try:
+                self._mine_tweet_data(hashtag, num_tweets=num_tweets,
+                        verbose=verbose)
+                with self._lock:
+                    self.failed_coins.pop(hashtag.name, None)
+            except Exception as e:
+                # One coin failing shouldn't cost the tweets of the others
+                METRICS.counter("collection_failures_total", api="twitter").inc()
+                error("Failed to collect the tweets of {0}: {1}".format(
+                    hashtag.name, e))
+                with self._lock:
+                    failures, _ = self.failed_coins.get(hashtag.name, (0, None))
+                    self.failed_coins[hashtag.name] = (failures + 1, str(e))
+            finally:
+                self._queue.task_done()
+
+
+    def _coins_to_search(self) -> list:
+        with self._lock:
+            return [coin for coin in self.cryptocurrencies
+                    if self.failed_coins.get(coin.name, (0, None))[0]
+                    < TweetManager.MAX_COIN_FAILURES]
+
+
+    def _skipped_coins(self) -> list:
+        with self._lock:
+            return sorted(name for name, (failures, _) in self.failed_coins.items()
+                          if failures >= TweetManager.MAX_COIN_FAILURES)
 
 
     def _mine_tweet_data(self, hashtag: Cryptocurrency, verbose=False, num_tweets=200):
@@ -211,29 +291,33 @@ class TweetManager:
         length = len(raw_tweets['statuses'])
         num_tweets -= length
 
-        # Construct formatted tweet data and append it to the list of clean_tweets
-        clean_tweets = list()
-        for index, tweet in enumerate(raw_tweets['statuses']):
-            jsonParser = JSONTweetParser(raw_tweets['statuses'][index], coin=hashtag.name)
-            clean_tweets.append(jsonParser.construct_tweet_json())
+        statuses = list(raw_tweets['statuses'])
 
         # Search for the remainder of tweets using the coin's ticker symbol
         raw_tweets = self._search_twitter(query=hashtag.ticker, num_tweets=num_tweets)
 
         length += len(raw_tweets["statuses"])
-        for index, tweet in enumerate(raw_tweets['statuses']):
-            jsonParser = JSONTweetParser(raw_tweets['statuses'][index], coin=hashtag.name)
-            clean_tweets.append(jsonParser.construct_tweet_json())
+        statuses.extend(raw_tweets['statuses'])
+
+        # Construct the formatted tweets, scoring their sentiment in one batch
+        clean_tweets = JSONTweetParser.construct_tweet_jsons(
+            statuses, coin=hashtag.name, scorer=self.scorer)
 
+        METRICS.counter("tweets_collected_total", coin=hashtag.name).inc(length)
+        if self._on_batch is not None:
+            self._on_batch(hashtag.name, self._round, clean_tweets)
+        else:
+            self._tweets.extend(clean_tweets)
         with self._lock:
-            self._tweets = self._tweets + clean_tweets
             if verbose:
                 print("Mine Tweet Data call, got", length, "tweets for", hashtag.name)
 
 
     def _search_twitter(self, query: str, num_tweets: int):
         """
-        Searches Twitter for a term and returns the raw data pulled from the api
+        Searches Twitter for a term and returns the raw data pulled from the api,
+        rate limits switch to the next api key and server errors and timeouts
+        are retried (see resilience.py)
         :param query: the str to be searched
         :param num_tweets: int of max number of tweets to search
         """
@@ -241,17 +325,25 @@ class TweetManager:
         query = ' ' + query + ' '
         if num_tweets == 0:
             return {"statuses": []}
-        try:
-            raw_tweets = self._twitter.search.tweets(q=query,
-                result_type='recent', lang='en', count=num_tweets)
-        except TwitterHTTPError as err:
-            self._load_twitter_api()
-            raw_tweets = self._twitter.search.tweets(q=query,
-                result_type='recent', lang='en', count=num_tweets)
-        except Exception as e:
-            print(e)
-            exit(-1)
-        return raw_tweets
+
+        def attempt(timeout):
+            METRICS.counter("api_requests_total", api="twitter").inc()
+            try:
+                with METRICS.timer("api_request_seconds", api="twitter"):
+                    return self._twitter.search.tweets(q=query,
+                        result_type='recent', lang='en', count=num_tweets,
+                        _timeout=timeout)
+            except Exception:
+                METRICS.counter("api_errors_total", api="twitter").inc()
+                raise
+
+        return call("twitter/search", attempt, on_rate_limit=self._switch_api_key)
+
+
+    def _switch_api_key(self, exception) -> bool:
+        """Rate limits are per key, so the next key can be used right away"""
+        self._load_twitter_api()
+        return True
 
 
 if __name__ == "__main__":
@@ -8,13 +8,12 @@ including ones for cleaning data
 import os
 import re
 import sys
-import requests        
-import json            
 import datetime as dt  
 
-import pandas as pd    
-import numpy as np     
-from textblob import TextBlob
+from .metrics import METRICS
+
+# pandas, requests and textblob take seconds to import so they are only
+# imported by the functions that need them, see startup_benchmark.py
 
 
 def make_directory(file_path: str):
@@ -53,31 +52,221 @@ def text_sentiment(content: str) -> float:
     :param content: str of the data to convert
     """
 
+    from textblob import TextBlob
+
     content = clean_text_for_tfidf(content)
     analysis = TextBlob(content)
     return analysis.sentiment.polarity
                        
 
-def get_bars(symbol: str, interval = "1d"):
+BINANCE_KLINES_URL = 'https://api.binance.com/api/v1/klines'
+BINANCE_TICKER_URL = 'https://api.binance.com/api/v1/ticker/24hr'
+# Weight of a 24hr ticker request without a symbol, i.e. of every symbol
+BINANCE_TICKER_WEIGHT = 40
+# Maximum number of candles binance returns per klines request
+BINANCE_KLINES_LIMIT = 1000
+
+# Length of every kline interval binance supports, in milliseconds
+INTERVAL_MILLISECONDS = {
+    "1m": 60 * 1000,
+    "3m": 3 * 60 * 1000,
+    "5m": 5 * 60 * 1000,
+    "15m": 15 * 60 * 1000,
+    "30m": 30 * 60 * 1000,
+    "1h": 60 * 60 * 1000,
+    "2h": 2 * 60 * 60 * 1000,
+    "4h": 4 * 60 * 60 * 1000,
+    "6h": 6 * 60 * 60 * 1000,
+    "8h": 8 * 60 * 60 * 1000,
+    "12h": 12 * 60 * 60 * 1000,
+    "1d": 24 * 60 * 60 * 1000,
+    "3d": 3 * 24 * 60 * 60 * 1000,
+    "1w": 7 * 24 * 60 * 60 * 1000,
+}
+
+KLINE_COLUMNS = ['open_time',
+                 'open', 'high', 'low', 'close', 'volume',
+                 'close_time', 'quote_asset_vol', 'num_trades',
+                 'taker_base_vol', 'taker_quote_vol', 'ignore']
+
+
+def get_bars(symbol: str, interval = "1d", start_time: int = None,
+             end_time: int = None, limit: int = None):
     """
     Uses binance api to pull historical data on a coin pairing 
     
     :param symbol: str of the form COIN_1COIN_2 ex: ETHBTC
     :interval: str frequency of candles, ex: 1h, 1d, 1w, 1m, 
+    :param start_time: optional int timestamp in ms of the first candle
+    :param end_time: optional int timestamp in ms of the last candle
+    :param limit: optional int of the max number of candles (up to 1000)
     :returns: pandas dataframe with all the historical data
     """
-    root_url = 'https://api.binance.com/api/v1/klines'
-    url = root_url + '?symbol=' + symbol + '&interval=' + interval
-    data = json.loads(requests.get(url).text)
-    df = pd.DataFrame(data)
-    df.columns = ['open_time',
-                    'open', 'high', 'low', 'close', 'volume',
-                    'close_time', 'quote_asset_vol', 'num_trades',
-                    'taker_base_vol', 'taker_quote_vol', 'ignore']
+    import pandas as pd
+
+    params = {"symbol": symbol, "interval": interval}
+    if start_time is not None:
+        params["startTime"] = int(start_time)
+    if end_time is not None:
+        params["endTime"] = int(end_time)
+    if limit is not None:
+        params["limit"] = int(limit)
+    data = _binance_get("binance/klines", BINANCE_KLINES_URL, params)
+    df = pd.DataFrame(data, columns=KLINE_COLUMNS)
+    numeric = [column for column in KLINE_COLUMNS if column != 'ignore']
+    df[numeric] = df[numeric].apply(pd.to_numeric)
     df.index = [str(dt.datetime.fromtimestamp(x/1000.0)).split()[0] for x in df.close_time]
     return df
 
 
+def _binance_get(endpoint: str, url: str, params: dict = None):
+    """
+    GET of a binance endpoint that is retried on rate limits, server errors
+    and timeouts (see resilience.py), returns the decoded JSON
+    """
+    import requests
+    from .resilience import call
+
+    def attempt(timeout):
+        METRICS.counter("api_requests_total", api="binance").inc()
+        try:
+            with METRICS.timer("api_request_seconds", api="binance"):
+                response = requests.get(url, params=params, timeout=timeout)
+                response.raise_for_status()
+                return response.json()
+        except Exception:
+            METRICS.counter("api_errors_total", api="binance").inc()
+            raise
+
+    return call(endpoint, attempt)
+
+
+def klines_weight(limit: int) -> int:
+    """Returns the binance request weight of a klines call with this limit"""
+    if limit <= 100:
+        return 1
+    if limit <= 500:
+        return 2
+    return 5
+
+
+def get_kline_pages(symbol: str, interval: str, start_time: int,
+                    end_time: int = None, limit: int = BINANCE_KLINES_LIMIT,
+                    rate_limiter=None):
+    """
+    Generator that pulls every candle of a pairing from start_time to
+    end_time, one request of at most limit candles at a time, yielding a
+    dataframe per page (see get_bars())
+
+    :param symbol: str of the form COIN_1COIN_2 ex: ETHBTC
+    :param interval: str key of INTERVAL_MILLISECONDS
+    :param start_time: int timestamp in ms to start from, binance starts
+                       from the listing date if this is before it
+    :param end_time: optional int timestamp in ms to stop at, defaults to now
+    :param rate_limiter: optional RateLimiter shared between threads that
+                         every request acquires its weight from
+    """
+    step = INTERVAL_MILLISECONDS[interval]
+    while end_time is None or start_time <= end_time:
+        if rate_limiter is not None:
+            rate_limiter.acquire(klines_weight(limit))
+        page = get_bars(symbol, interval=interval, start_time=start_time,
+                        end_time=end_time, limit=limit)
+        if page.empty:
+            return
+        yield page
+        if len(page) < limit:
+            return
+        start_time = int(page["open_time"].iloc[-1]) + step
+
+
+def resample_klines(df, interval: str):
+    """
+    Downsamples candles to a coarser interval, ex: 1m candles to 1h candles.
+    Buckets are aligned on the unix epoch like binance's own candles (weekly
+    candles are the exception, binance starts them on mondays).
+
+    :param df: dataframe of candles indexed by their open time (DatetimeIndex)
+               with at least open, high, low, close and volume columns
+    :param interval: str key of INTERVAL_MILLISECONDS to downsample to
+    :returns: dataframe of the coarser candles, empty buckets are dropped
+    """
+    import pandas as pd
+
+    aggregation = {"open": "first", "high": "max", "low": "min",
+                   "close": "last", "volume": "sum"}
+    for column in ("quote_volume", "quote_asset_vol", "num_trades"):
+        if column in df.columns:
+            aggregation[column] = "sum"
+    rule = pd.Timedelta(milliseconds=INTERVAL_MILLISECONDS[interval])
+    resampled = df.resample(rule, origin="epoch", label="left",
+                            closed="left").agg(aggregation)
+    return resampled.dropna(subset=["open"])
+
+
+# Columns of the 24hr ticker -> names used for the klines and market data
+TICKER_COLUMNS = {
+    "openPrice": "open",
+    "highPrice": "high",
+    "lowPrice": "low",
+    "lastPrice": "close",
+    "volume": "volume",
+    "quoteVolume": "quote_volume",
+    "count": "num_trades",
+    "closeTime": "close_time",
+}
+
+
+def get_ticker_snapshot(symbols=None, rate_limiter=None):
+    """
+    Uses binance api to pull the rolling 24 hour statistics of every symbol
+    in a single request
+
+    :param symbols: optional iterable of the symbols to keep, ex: ETHBTC
+    :param rate_limiter: optional RateLimiter shared between threads that
+                         the request acquires its weight from
+    :returns: pandas dataframe indexed by symbol with the open, high, low,
+              close, volume, quote_volume, num_trades and close_time columns
+    """
+    import pandas as pd
+
+    if rate_limiter is not None:
+        rate_limiter.acquire(BINANCE_TICKER_WEIGHT)
+    data = _binance_get("binance/ticker", BINANCE_TICKER_URL)
+    df = pd.DataFrame(data).set_index("symbol")
+    df = df[list(TICKER_COLUMNS)].rename(columns=TICKER_COLUMNS)
+    df = df.apply(pd.to_numeric)
+    if symbols is not None:
+        df = df.reindex(list(symbols))
+    return df
+
+
+def usd_market_data(tickers, coins):
+    """
+    Converts the daily statistics of every coin's pairing to USD at once,
+    altcoins are quoted in BTC so their prices are multiplied field by field
+    by the BTCUSDT prices
+
+    :param tickers: dataframe indexed by symbol (see get_ticker_snapshot())
+    :param coins: iterable of Cryptocurrency
+    :returns: dataframe indexed by coin name with the date, open, high, low,
+              close, volume and num_trades columns, coins whose pairing isn't
+              in tickers are left out
+    """
+    prices = ["open", "high", "low", "close"]
+    names = [coin.name for coin in coins]
+    pairings = [coin.pairing() for coin in coins]
+    # reindex copies, so tickers is left untouched
+    data = tickers.reindex(pairings)[prices + ["volume", "num_trades"]]
+    data.index = names
+    quoted_in_btc = [pairing != "BTCUSDT" for pairing in pairings]
+    data.loc[quoted_in_btc, prices] = \
+        data.loc[quoted_in_btc, prices].mul(tickers.loc["BTCUSDT", prices], axis=1)
+    data = data.dropna(subset=prices)
+    data.insert(0, "date", dt.datetime.today().strftime('%Y-%m-%d'))
+    return data
+
+
 def clean_text_function(content: str) -> str:
     """
     This function takes text and cleans it according to Glove standards
@@ -7,8 +7,14 @@ through python.
 Note: this is for mysql databases only
 """
 
-import mysql.connector
-from hidden import DB_NAME, DB_HOST, DB_USERNAME, DB_PASSWORD, DB_PORT
+from data_collection.metrics import METRICS
+
+# Number of rows pulled from the server per fetchmany() call when streaming
+STREAM_BATCH_SIZE = 50000
+
+# Columns converted to pandas categoricals / datetimes in query_df_chunks()
+CATEGORICAL_COLUMNS = ("coin", "name", "hashtag")
+DATE_COLUMNS = ("date", "date_created")
 
 
 class DatabaseWrapper:
@@ -19,8 +25,14 @@ class DatabaseWrapper:
         >>> dbw.show_tables()
         ... [table1, table2, ... ]
     """
+    # SQL dialect of the statements, for code that also runs on SQLite
+    dialect = "mysql"
 
     def __init__(self):
+        # Imported here so tools that never connect don't pay for the driver
+        import mysql.connector
+        from hidden import DB_NAME, DB_HOST, DB_USERNAME, DB_PASSWORD, DB_PORT
+
         self._database = mysql.connector.connect(
             host=DB_HOST,
             user=DB_USERNAME,
@@ -96,6 +108,8 @@ class DatabaseWrapper:
                       the values for values. So in the student table example,
                       an entry would be:
                       {"id": 123, "name": "Thomas"}
+        :return: int of how many rows were inserted, 0 if the entry was
+                 ignored because its key already exists
         """
         if not isinstance(entry, dict):
             raise TypeError("The entry to add to table must be a dictionary!")
@@ -109,8 +123,10 @@ class DatabaseWrapper:
             sql_statement = sql_statement[:-2]
             sql_statement += ")"
 
-        self._cursor.execute(sql_statement)
-        self._database.commit()
+        with METRICS.timer("db_statement_seconds", statement="insert"):
+            self._cursor.execute(sql_statement)
+            self._database.commit()
+        return self._cursor.rowcount
 
     def delete_table(self, table: str):
         """
@@ -119,21 +135,161 @@ class DatabaseWrapper:
         """
         self._cursor.execute("DROP TABLE IF EXISTS {0}".format(table))
 
-    def query(self, query: str, generator=False) -> list:
+    def query(self, query: str, generator=False):
         """
-        Runs a query and returns a list
+        Runs a query and returns a list of rows, if generator is True the
+        rows are streamed back one at a time instead (see stream())
         """
-        self._cursor.execute(query)
         if generator:
-            for row in self._cursor:
-                yield row
-        else:
-            return [r for r in self._cursor]
-
-    def execute(self, sql_statement):
-        """Will execute the given sql statement"""
-        self._cursor.execute(sql_statement, multi=False)
-        self._database.commit()
+            return self.stream(query)
+        with METRICS.timer("db_statement_seconds", statement="query"):
+            self._cursor.execute(query)
+            return self._cursor.fetchall()
+
+    def stream(self, query: str, batch_size: int = STREAM_BATCH_SIZE,
+               params=None):
+        """
+        Generator that runs a query on an unbuffered cursor and yields the
+        rows one at a time, only ever holding batch_size rows client side
+
+        :param query: str of the sql query to run
+        :param batch_size: int of how many rows to pull per fetchmany call
+        :param params: optional tuple/dict of parameters for the query
+        """
+        for _, rows in self._fetch_batches(query, batch_size, params):
+            yield from rows
+
+    def query_df_chunks(self, sql: str, chunksize: int = STREAM_BATCH_SIZE,
+                        params=None, categorical=CATEGORICAL_COLUMNS,
+                        dates=DATE_COLUMNS):
+        """
+        Generator that streams the result of a query as pandas DataFrames of
+        at most chunksize rows each.
+
+        :param sql: str of the sql query to run
+        :param chunksize: int of the max number of rows in each DataFrame
+        :param params: optional tuple/dict of parameters for the query
+        :param categorical: iterable of column names converted to the
+                            category dtype (coin names, hashtags, ...)
+        :param dates: iterable of column names converted to datetime64
+        """
+        import pandas as pd
+
+        for columns, rows in self._fetch_batches(sql, chunksize, params):
+            df = pd.DataFrame.from_records(rows, columns=columns)
+            for column in df.columns:
+                if column in categorical:
+                    df[column] = df[column].astype("category")
+                elif column in dates:
+                    df[column] = pd.to_datetime(df[column])
+            yield df
+
+    def _fetch_batches(self, query: str, batch_size: int, params=None):
+        """
+        Runs the query on its own unbuffered cursor so rows are read off the
+        connection as they are fetched rather than all at once, yields
+        tuples of (column_names, list_of_rows)
+        """
+        cursor = self._database.cursor(buffered=False)
+        exhausted = False
+        try:
+            with METRICS.timer("db_statement_seconds", statement="stream"):
+                cursor.execute(query, params)
+            columns = cursor.column_names
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    exhausted = True
+                    break
+                METRICS.counter("db_rows_streamed_total").inc(len(rows))
+                yield columns, rows
+        finally:
+            # An abandoned stream still has rows pending on the connection,
+            # they need to be discarded before the connection can be reused
+            if not exhausted:
+                self._database.consume_results()
+            cursor.close()
+
+    def ping(self):
+        """Reconnects if the server closed the connection, ex: while idle"""
+        self._database.ping(reconnect=True, attempts=3, delay=1)
+
+    def execute(self, sql_statement, params=None) -> int:
+        """
+        Will execute the given sql statement, returns the number of
+        affected rows
+
+        :param params: optional tuple/dict of parameters for the statement
+        """
+        with METRICS.timer("db_statement_seconds", statement="execute"):
+            self._cursor.execute(sql_statement, params, multi=False)
+            self._database.commit()
+        return self._cursor.rowcount
+
+    def executemany(self, sql_statement: str, rows: list) -> int:
+        """
+        Executes a parameterized statement once for every tuple in rows
+        within one transaction, returns the number of affected rows
+        """
+        if not rows:
+            return 0
+        with METRICS.timer("db_statement_seconds", statement="executemany"):
+            self._cursor.executemany(sql_statement, rows)
+            self._database.commit()
+        METRICS.counter("db_rows_written_total").inc(len(rows))
+        return self._cursor.rowcount
+
+    def execute_batch(self, statements: list) -> int:
+        """
+        Executes several parameterized statements, ex: inserts into different
+        tables, within one transaction, returns the number of affected rows
+
+        :param statements: list of (sql_statement, params) tuples
+        """
+        if not statements:
+            return 0
+        affected = 0
+        with METRICS.timer("db_statement_seconds", statement="batch"):
+            try:
+                for sql_statement, params in statements:
+                    self._cursor.execute(sql_statement, params)
+                    affected += max(self._cursor.rowcount, 0)
+                self._database.commit()
+            except Exception:
+                self._database.rollback()
+                raise
+        METRICS.counter("db_rows_written_total").inc(len(statements))
+        return affected
+
+    def show_columns(self, table: str) -> list:
+        """Return a list of the column names of table"""
+        self._cursor.execute("SHOW COLUMNS FROM {0}".format(table))
+        return [column[0] for column in self._cursor.fetchall()]
+
+    def add_column(self, table: str, column: str, column_type: str):
+        """
+        Adds a column to an existing table, does nothing if the column is
+        already there
+        """
+        if column in self.show_columns(table):
+            return
+        self._cursor.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+            table, column, column_type))
+
+    def modify_column(self, table: str, column: str, column_type: str):
+        """
+        Changes the type of an existing column, ex: to widen a VARCHAR, does
+        nothing if the column already has that type
+        """
+        self._cursor.execute("SHOW COLUMNS FROM {0}".format(table))
+        types = {row[0]: row[1] for row in self._cursor.fetchall()}
+        current = types[column]
+        if isinstance(current, bytes):
+            current = current.decode("utf8")
+        if column_type.lower().startswith(current.lower()):
+            return
+        self._cursor.execute("ALTER TABLE {0} MODIFY COLUMN {1} {2}".format(
+            table, column, column_type))
 
     def num_elements_per_table(self):
         """Print all the tables with their corresponing number of elements"""
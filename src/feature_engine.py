@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Builds the per coin modelling features out of the market data tables.
+
+Every coin's daily prices and tweet sentiment are aligned on one calendar,
+the rolling features are computed for all coins at once with vectorized
+pandas window operations and the result is stored as a memory mapped
+float32 matrix of shape (dates, coins, features) so it can be loaded for all
+coins without reading the database.
+
+Usage:
+    >>> store = FeatureStore()
+    >>> store.update(DatabaseWrapper(), CRYPTOS)  # only appends new dates
+    >>> matrix, dates, coins, features = store.load()
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+FEATURE_DIRECTORY = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "features")
+
+# Columns of the per coin market data tables the features are built from
+BASE_COLUMNS = ("open", "high", "low", "close", "volume", "num_trades",
+                "positive_tweet_sentiment", "negative_tweet_sentiment",
+                "average_tweet_sentiment")
+
+# Rolling window lengths and sentiment lags, in days
+WINDOWS = (7, 30)
+LAGS = (1, 2, 3)
+
+# How many days before the first new date are needed to compute its features
+WARMUP_DAYS = max(WINDOWS) + max(LAGS) + 1
+
+
+def load_market_panel(database, coins, since: str = None) -> dict:
+    """
+    Reads the market data tables of coins into a dict mapping each column of
+    BASE_COLUMNS to a DataFrame indexed by date with one column per coin.
+    The dates are reindexed onto a continuous daily calendar, days a coin
+    has no data for are NaN.
+
+    :param database: DatabaseWrapper to read the tables with
+    :param coins: iterable of Cryptocurrency objects
+    :param since: optional str date, only rows on or after it are read
+    """
+    frames = dict()
+    for coin in coins:
+        sql = "SELECT date, {0} FROM `{1}`".format(", ".join(BASE_COLUMNS),
+                                                  coin.name)
+        params = None
+        if since is not None:
+            sql += " WHERE date >= %s"
+            params = (since,)
+        sql += " ORDER BY date"
+        chunks = list(database.query_df_chunks(sql, params=params))
+        if chunks:
+            frames[coin.name] = pd.concat(chunks).set_index("date")
+
+    names = [coin.name for coin in coins]
+    if not frames:
+        return {column: pd.DataFrame(columns=names, dtype=np.float64)
+                for column in BASE_COLUMNS}
+
+    # Starting the calendar at since keeps it aligned with stored dates
+    if since is not None:
+        start = pd.Timestamp(since)
+    else:
+        start = min(frame.index.min() for frame in frames.values())
+    end = max(frame.index.max() for frame in frames.values())
+    calendar = pd.date_range(start, end, freq="D", name="date")
+    panel = dict()
+    for column in BASE_COLUMNS:
+        panel[column] = pd.DataFrame(
+            {name: frame[column].astype(np.float64)
+             for name, frame in frames.items()},
+            index=calendar).reindex(columns=names)
+    return panel
+
+
+def compute_features(panel: dict) -> dict:
+    """
+    Computes every feature for every coin, returns an ordered dict mapping
+    the feature name to a DataFrame shaped like the panel's frames
+
+    :param panel: dict as returned by load_market_panel()
+    """
+    close = panel["close"]
+    volume = panel["volume"]
+    sentiment = panel["average_tweet_sentiment"]
+    positive = panel["positive_tweet_sentiment"]
+    log_return = np.log(close).diff()
+
+    features = dict()
+    features["return_1d"] = close.pct_change(fill_method=None)
+    features["log_return_1d"] = log_return
+    features["range_1d"] = (panel["high"] - panel["low"]) / close
+    for window in WINDOWS:
+        features["return_{0}d".format(window)] = close.pct_change(
+            window, fill_method=None)
+        features["close_mean_{0}d".format(window)] = close.rolling(window).mean()
+        features["volatility_{0}d".format(window)] = log_return.rolling(window).std()
+        features["volume_zscore_{0}d".format(window)] = _zscore(volume, window)
+        features["sentiment_mean_{0}d".format(window)] = sentiment.rolling(
+            window, min_periods=1).mean()
+        features["sentiment_zscore_{0}d".format(window)] = _zscore(sentiment, window)
+    for lag in LAGS:
+        features["sentiment_lag_{0}d".format(lag)] = sentiment.shift(lag)
+        features["positive_sentiment_lag_{0}d".format(lag)] = positive.shift(lag)
+    return features
+
+
+def _zscore(frame, window: int):
+    mean = frame.rolling(window).mean()
+    std = frame.rolling(window).std()
+    return ((frame - mean) / std).replace([np.inf, -np.inf], np.nan)
+
+
+class FeatureStore:
+    """
+    Class for persisting the features as a memory mapped matrix.
+    Two files are kept in the directory:
+        features.f32: raw float32 matrix of shape (dates, coins, features),
+                      dates are the outer axis so new days are appended to
+                      the end of the file
+        features.json: the coins, feature names, first date and number of
+                       dates stored
+    """
+
+    def __init__(self, directory: str = FEATURE_DIRECTORY):
+        self.directory = directory
+        self._matrix_path = os.path.join(directory, "features.f32")
+        self._metadata_path = os.path.join(directory, "features.json")
+
+
+    def metadata(self):
+        """Returns the stored metadata dict, or None if nothing is stored"""
+        if not os.path.exists(self._metadata_path):
+            return None
+        with open(self._metadata_path, "r") as f:
+            return json.load(f)
+
+
+    def build(self, database, coins) -> int:
+        """
+        Recomputes the features for the whole history and replaces the
+        stored matrix, returns the number of dates stored
+        """
+        panel = load_market_panel(database, coins)
+        block, dates, features = self._block(panel)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._matrix_path, "wb") as f:
+            f.write(block.tobytes())
+        start = dates[0].strftime("%Y-%m-%d") if len(dates) else None
+        self._write_metadata([coin.name for coin in coins], features, start,
+                             len(dates))
+        return len(dates)
+
+
+    def update(self, database, coins) -> int:
+        """
+        Appends the features of the dates after the last stored date,
+        reading only the days needed to warm up the rolling windows.
+        Falls back to build() if nothing is stored yet. Returns the number
+        of dates that were appended.
+        """
+        metadata = self.metadata()
+        if metadata is None or metadata["start_date"] is None:
+            return self.build(database, coins)
+        if metadata["coins"] != [coin.name for coin in coins]:
+            raise ValueError("The coins changed since the features were "
+                             "built, run build() instead of update()")
+
+        last_date = (pd.Timestamp(metadata["start_date"]) +
+                     pd.Timedelta(days=metadata["num_dates"] - 1))
+        since = last_date - pd.Timedelta(days=WARMUP_DAYS)
+        panel = load_market_panel(database, coins,
+                                  since=since.strftime("%Y-%m-%d"))
+        block, dates, features = self._block(panel)
+        if features != metadata["features"]:
+            raise ValueError("The features changed since they were built, "
+                             "run build() instead of update()")
+        new = np.asarray(dates > last_date)
+        if not new.any():
+            return 0
+
+        # The calendar is continuous so the new dates are always a suffix
+        with open(self._matrix_path, "ab") as f:
+            f.write(block[new].tobytes())
+        self._write_metadata(metadata["coins"], features,
+                             metadata["start_date"],
+                             metadata["num_dates"] + int(new.sum()))
+        return int(new.sum())
+
+
+    def load(self):
+        """
+        Returns a tuple of (matrix, dates, coins, features) where matrix is
+        a read only np.memmap of shape (dates, coins, features), dates is a
+        DatetimeIndex and coins and features are lists of names
+        """
+        metadata = self.metadata()
+        if metadata is None:
+            raise FileNotFoundError("No features stored in " + self.directory)
+        shape = (metadata["num_dates"], len(metadata["coins"]),
+                 len(metadata["features"]))
+        dates = pd.date_range(metadata["start_date"], periods=shape[0], freq="D")
+        if shape[0] == 0:
+            return (np.empty(shape, dtype=np.float32), dates,
+                    metadata["coins"], metadata["features"])
+        matrix = np.memmap(self._matrix_path, dtype=np.float32, mode="r",
+                           shape=shape)
+        return matrix, dates, metadata["coins"], metadata["features"]
+
+
+    def frame(self, coin: str):
+        """Returns the features of a single coin as a DataFrame"""
+        matrix, dates, coins, features = self.load()
+        return pd.DataFrame(np.asarray(matrix[:, coins.index(coin), :]),
+                            index=dates, columns=features)
+
+
+    @staticmethod
+    def _block(panel: dict):
+        features = compute_features(panel)
+        names = list(features.keys())
+        dates = panel["close"].index
+        block = np.stack([features[name].to_numpy(dtype=np.float32)
+                          for name in names], axis=-1)
+        return np.ascontiguousarray(block), dates, names
+
+
+    def _write_metadata(self, coins: list, features: list, start_date,
+                        num_dates: int):
+        metadata = {
+            "coins": coins,
+            "features": features,
+            "start_date": start_date,
+            "num_dates": num_dates,
+            "dtype": "float32",
+        }
+        temporary_path = self._metadata_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(metadata, f, indent=4)
+        os.replace(temporary_path, self._metadata_path)
+
+
+if __name__ == "__main__":
+    import time
+    from cryptocurrencies import CRYPTOS
+    from database_wrapper import DatabaseWrapper
+
+    start = time.time()
+    store = FeatureStore()
+    num_dates = store.update(DatabaseWrapper(), CRYPTOS)
+    print("Added {0} dates of features in {1:0.2f}s".format(
+        num_dates, time.time() - start))
+
+    start = time.time()
+    matrix, dates, coins, features = store.load()
+    print("Loaded a {0} feature matrix in {1:0.2f}ms".format(
+        matrix.shape, (time.time() - start) * 1000))
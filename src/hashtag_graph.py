@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Sparse co-occurrence graph of the hashtags, built straight from the
+tweet_hashtag table instead of exporting its joins (tweet_hashtag_query.sql)
+and counting pairs in python loops.
+
+tweet_hashtag is read in pages of consecutive tweet ids, each page becomes
+a sparse (tweets x hashtags) indicator matrix X and the co-occurrence matrix
+is the sum of the pages' X^T X. Only a page and the co-occurrence matrix are
+ever in memory, and the latter only has an entry per pair of hashtags that
+were used together, so millions of tweets are counted in bounded memory.
+The diagonal of the co-occurrence matrix holds the number of tweets of each
+hashtag.
+
+The tweets can be restricted to some coins and to a range of dates, the
+tweet ids of a date are known from their timestamp (see
+tweet_archive.first_snowflake()) so the pages only scan that range.
+
+Weightings of the edges:
+    count: number of tweets using both hashtags
+    pmi: log(P(a, b) / (P(a) P(b))), how much more often than chance the
+         hashtags are used together, noisy for rare hashtags (see min_count)
+    jaccard: tweets using both / tweets using either
+
+Usage:
+    >>> graph = build_graph(DatabaseWrapper(), coins=["bitcoin"],
+    ...                     start="2019-02-01", end="2019-02-28", min_count=5)
+    >>> graph.neighbors("btc", n=10, weighting="pmi")
+    ... [("hodl", 3.2), ...]
+"""
+
+import argparse
+import datetime as dt
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from data_collection.metrics import METRICS
+from tweet_archive import first_snowflake
+
+
+# Rows of tweet_hashtag read (and held in memory) at once
+PAGE_SIZE = 200000
+WEIGHTINGS = ("count", "pmi", "jaccard")
+
+EDGE_QUERY = """
+SELECT tweet_hashtag.tweet_id, tweet_hashtag.hashtag_id
+FROM tweet_hashtag{joins}
+WHERE tweet_hashtag.tweet_id > %s{conditions}
+ORDER BY tweet_hashtag.tweet_id
+LIMIT %s
+"""
+
+
+class HashtagGraph:
+    """
+    Co-occurrence counts of the hashtags of a set of tweets.
+
+    Usage:
+        >>> graph = build_graph(DatabaseWrapper(), coins=["ethereum"])
+        >>> graph.count("eth")
+        ... 5120
+        >>> graph.top_neighbors(n=5, weighting="jaccard")
+        ... {"eth": [("ethereum", 0.41), ...], ...}
+    """
+
+    def __init__(self, matrix, names: list, num_tweets: int):
+        """
+        :param matrix: scipy sparse symmetric (hashtags x hashtags) matrix of
+                       the number of tweets using both hashtags
+        :param names: list of the hashtag of every row
+        :param num_tweets: int of the tweets (with hashtags) counted
+        """
+        self.matrix = sp.csr_matrix(matrix)
+        self.names = list(names)
+        self.num_tweets = num_tweets
+        # Hashtags are case insensitive like the hashtags table
+        self._index = dict()
+        for i, name in enumerate(self.names):
+            self._index.setdefault(name.lower(), i)
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def counts(self):
+        """Returns a numpy array of the number of tweets of every hashtag"""
+        return self.matrix.diagonal()
+
+
+    def count(self, hashtag: str) -> int:
+        index = self._index.get(hashtag.lower())
+        return 0 if index is None else int(self.matrix[index, index])
+
+
+    def weighted(self, weighting: str = "count"):
+        """
+        Returns the sparse matrix of the edges (the diagonal left out)
+        weighted by one of WEIGHTINGS
+        """
+        if weighting not in WEIGHTINGS:
+            raise ValueError("Unknown weighting {0}, expected one of {1}".format(
+                weighting, ", ".join(WEIGHTINGS)))
+        edges = self.matrix.tocoo()
+        off_diagonal = edges.row != edges.col
+        rows, columns = edges.row[off_diagonal], edges.col[off_diagonal]
+        together = edges.data[off_diagonal].astype(np.float64)
+        counts = self.counts().astype(np.float64)
+        if weighting == "count":
+            weights = together
+        elif weighting == "pmi":
+            weights = np.log(together * self.num_tweets /
+                             (counts[rows] * counts[columns]))
+        else:
+            weights = together / (counts[rows] + counts[columns] - together)
+        return sp.csr_matrix((weights, (rows, columns)), shape=self.matrix.shape)
+
+
+    def neighbors(self, hashtag: str, n: int = 10, weighting: str = "count",
+                  weights=None) -> list:
+        """
+        Returns the n hashtags with the heaviest edges to hashtag as a list of
+        (hashtag, weight) tuples
+
+        :param weights: optional matrix returned by weighted(weighting), to
+                        reuse it across calls
+        """
+        index = self._index.get(hashtag.lower())
+        if index is None:
+            return []
+        if weights is None:
+            weights = self.weighted(weighting)
+        start, end = weights.indptr[index], weights.indptr[index + 1]
+        columns, values = weights.indices[start:end], weights.data[start:end]
+        if len(values) > n:
+            heaviest = np.argpartition(-values, n)[:n]
+            columns, values = columns[heaviest], values[heaviest]
+        order = np.argsort(-values, kind="stable")
+        return [(self.names[column], float(value))
+                for column, value in zip(columns[order], values[order])]
+
+
+    def top_neighbors(self, n: int = 10, weighting: str = "count") -> dict:
+        """Returns a dict of every hashtag to its n heaviest neighbors (see neighbors())"""
+        weights = self.weighted(weighting)
+        return {name: self.neighbors(name, n, weights=weights) for name in self.names}
+
+
+def build_graph(database, coins=None, start: str = None, end: str = None,
+                min_count: int = 1, page_size: int = PAGE_SIZE,
+                verbose=False) -> HashtagGraph:
+    """
+    Returns the HashtagGraph of the tweets about coins between the dates
+    start and end (inclusive)
+
+    :param database: DatabaseWrapper to read tweet_hashtag with
+    :param coins: optional list of coin names, defaults to every coin
+    :param start: optional str date, ex: 2019-02-11
+    :param end: optional str date
+    :param min_count: int of the tweets a hashtag needs to be kept
+    :param page_size: int of the rows of tweet_hashtag read at once
+    :param verbose: bool on whether to print the progress after each page
+    """
+    num_columns = database.query("SELECT MAX(id) FROM hashtags")[0][0]
+    num_columns = (num_columns or 0) + 1
+    query, params = _edge_query(coins, start, end)
+
+    started = time.time()
+    cooccurrences = sp.csr_matrix((num_columns, num_columns), dtype=np.int64)
+    num_tweets = 0
+    last_id = 0
+    if start is not None:
+        # A day early as the dates of the tweets aren't necessarily UTC
+        last_id = first_snowflake(dt.date.fromisoformat(start) - dt.timedelta(days=1)) - 1
+    while True:
+        with METRICS.timer("hashtag_graph_page_seconds"):
+            page = list(database.stream(query, params=(last_id,) + params + (page_size,)))
+            if not page:
+                break
+            full = len(page) == page_size
+            if full:
+                # The last tweet can continue on the next page, it's read
+                # again there so its pairs aren't split
+                last_tweet = page[-1][0]
+                page = [row for row in page if row[0] != last_tweet]
+                if not page:
+                    raise ValueError("A tweet has more than {0} hashtags, increase "
+                                     "page_size".format(page_size))
+            last_id = page[-1][0]
+            tweets = _indicator(page, num_columns)
+            cooccurrences = cooccurrences + (tweets.T @ tweets)
+            num_tweets += tweets.shape[0]
+        METRICS.counter("hashtag_graph_rows_total").inc(len(page))
+        if verbose:
+            print("Counted {0} tweets, {1} pairs ({2:0.0f} tweets/s)".format(
+                num_tweets, cooccurrences.nnz, num_tweets / max(time.time() - started, 1e-9)))
+        if not full:
+            break
+
+    kept = np.flatnonzero(cooccurrences.diagonal() >= max(min_count, 1))
+    cooccurrences = cooccurrences[kept][:, kept]
+    names = _names(database, kept)
+    return HashtagGraph(cooccurrences, [names.get(i, str(i)) for i in kept],
+                        num_tweets)
+
+
+def _edge_query(coins, start: str, end: str):
+    """Returns the EDGE_QUERY of the slice and its parameters between the id and limit"""
+    joins = ""
+    conditions = ""
+    params = tuple()
+    if coins is not None or start is not None or end is not None:
+        joins += "\n    JOIN tweets ON tweets.id = tweet_hashtag.tweet_id"
+    if coins is not None:
+        coins = list(coins)
+        joins += "\n    JOIN cryptocurrencies ON cryptocurrencies.id = tweets.coin_id"
+        conditions += " AND cryptocurrencies.name IN ({0})".format(
+            ", ".join(["%s"] * len(coins)))
+        params += tuple(coins)
+    if start is not None:
+        conditions += " AND tweets.date >= %s"
+        params += (start,)
+    if end is not None:
+        # Tweets are at most a few hours from their date
+        conditions += " AND tweets.date <= %s AND tweet_hashtag.tweet_id < %s"
+        end_date = dt.date.fromisoformat(end) + dt.timedelta(days=2)
+        params += (end, first_snowflake(end_date))
+    return EDGE_QUERY.format(joins=joins, conditions=conditions), params
+
+
+def _indicator(page: list, num_columns: int):
+    """Returns the sparse (tweets x hashtags) 0/1 matrix of a page of rows"""
+    tweet_ids = np.fromiter((row[0] for row in page), dtype=np.uint64, count=len(page))
+    hashtag_ids = np.fromiter((row[1] for row in page), dtype=np.int64, count=len(page))
+    # The rows are sorted by tweet, a new row of the matrix starts at every change
+    rows = np.concatenate(([0], np.cumsum(tweet_ids[1:] != tweet_ids[:-1])))
+    tweets = sp.csr_matrix((np.ones(len(page), dtype=np.int64), (rows, hashtag_ids)),
+                           shape=(int(rows[-1]) + 1, num_columns))
+    # A hashtag used twice in a tweet still counts once
+    tweets.data[:] = 1
+    return tweets
+
+
+def _names(database, hashtag_ids) -> dict:
+    """Returns a dict of the names of hashtag_ids"""
+    wanted = set(int(i) for i in hashtag_ids)
+    return {hashtag_id: name for hashtag_id, name
+            in database.stream("SELECT id, name FROM hashtags")
+            if hashtag_id in wanted}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Print the strongest co-occurring hashtags")
+    parser.add_argument("hashtags", nargs="*",
+                        help="hashtags to print the neighbors of, defaults to "
+                             "the most used ones")
+    parser.add_argument("--coins", nargs="+", default=None)
+    parser.add_argument("--start", default=None)
+    parser.add_argument("--end", default=None)
+    parser.add_argument("--min-count", type=int, default=5)
+    parser.add_argument("--weighting", choices=WEIGHTINGS, default="pmi")
+    parser.add_argument("-n", type=int, default=10)
+    args = parser.parse_args()
+
+    from database_wrapper import DatabaseWrapper
+
+    start = time.time()
+    graph = build_graph(DatabaseWrapper(), args.coins, args.start, args.end,
+                        min_count=args.min_count, verbose=True)
+    print("{0} hashtags of {1} tweets in {2:0.2f}s".format(
+        len(graph), graph.num_tweets, time.time() - start))
+    hashtags = args.hashtags or [graph.names[i] for i in np.argsort(-graph.counts())[:args.n]]
+    weights = graph.weighted(args.weighting)
+    for hashtag in hashtags:
+        print("#{0} ({1} tweets):".format(hashtag, graph.count(hashtag)))
+        for neighbor, weight in graph.neighbors(hashtag, args.n, weights=weights):
+            print("    #{0}: {1:0.3f}".format(neighbor, weight))
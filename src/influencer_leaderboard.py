@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Materialized per coin leaderboard of the most influential twitter users,
+so finding them doesn't need tweet_query.sql's join and sort of every tweet.
+
+A user's reach on a day is the sum over their tweets about the coin of
+followers * (1 + retweets), their number of tweets is kept along with it.
+The leaderboard of every coin and day is updated as batches of tweets are
+inserted (see DataManager.add_batch_listener()) and is a bounded heap of
+the CAPACITY users with the most reach, which flush() writes to the
+influencers_daily table and a restart loads back from it.
+
+Table:
+    influencers_daily: one row per coin, day and top user with their reach,
+                       followers, retweets and number of tweets
+
+Error bounds: a user that falls out of a day's CAPACITY users loses the
+reach gathered so far, so a user can be missing or ranked too low only if
+their reach that day is close to the CAPACITY-th user's, the top few users
+of a day are exact in practice. Windows of several days are summed from the
+days' kept users, a user ranks too low in a window only if they were left
+out of one of its days.
+
+Usage:
+    >>> leaderboard = InfluencerLeaderboard(DatabaseWrapper(), CRYPTOS)
+    >>> leaderboard.create_table()
+    >>> leaderboard.add(tweets)  # new tweets, as generated by json_parser.py
+    >>> leaderboard.flush()
+    >>> leaderboard.top("bitcoin", start="2019-02-01", end="2019-02-07")
+"""
+
+import heapq
+import threading
+
+from data_collection.metrics import METRICS
+
+
+TABLE = "influencers_daily"
+# Users kept per coin and day, far more than are ever queried so the users
+# whose reach is still growing aren't dropped
+CAPACITY = 500
+# Dates whose boards stay in memory after a flush, the newest ones
+LOADED_DATES = 8
+
+# Fields of the users kept per coin and day
+REACH, FOLLOWERS, RETWEETS, NUM_TWEETS = range(4)
+
+
+class InfluencerLeaderboard:
+    """
+    Thread safe leaderboards of every coin and day.
+
+    Usage:
+        >>> leaderboard = InfluencerLeaderboard(DatabaseWrapper(), CRYPTOS)
+        >>> database.add_batch_listener(leaderboard.add)
+        >>> leaderboard.top("ripple", start="2019-02-11", k=10)
+        ... [{"user_id": 123, "reach": 5000, ...}, ...]
+    """
+
+    def __init__(self, database, coins, capacity: int = CAPACITY):
+        """
+        :param database: DatabaseWrapper used by flush() and top()
+        :param coins: CoinRegistry of the coins, their ids are loaded if
+                      they aren't already
+        :param capacity: int of the users kept in memory per coin and day
+        """
+        self._database = database
+        self.coins = coins
+        self.capacity = capacity
+        # (coin id, date) -> {user id: [reach, followers, retweets, num_tweets]}
+        self._boards = dict()
+        self._dirty = set()
+        # (coin id, date) -> user ids trimmed from the board since the last flush
+        self._dropped = dict()
+        self._lock = threading.Lock()
+
+
+    def create_table(self):
+        if TABLE in self._database.show_tables():
+            return
+        self._database.execute("""
+CREATE TABLE {0} (
+    coin_id INT UNSIGNED NOT NULL,
+    date DATE NOT NULL,
+    user_id BIGINT UNSIGNED NOT NULL,
+    reach BIGINT UNSIGNED NOT NULL,
+    followers INT UNSIGNED NOT NULL,
+    retweets INT UNSIGNED NOT NULL,
+    num_tweets INT UNSIGNED NOT NULL,
+    FOREIGN KEY (coin_id) REFERENCES cryptocurrencies (id) ON DELETE RESTRICT ON UPDATE CASCADE,
+    PRIMARY KEY (coin_id, date, user_id),
+    INDEX (coin_id, date, reach)
+); """.format(TABLE))
+
+
+    def add(self, tweets: list):
+        """
+        Adds a batch of new tweets to the leaderboards of their coin and day
+
+        :param tweets: list of tweet dicts (as generated by json_parser.py),
+                       each tweet must only be added once
+        """
+        # Summed per user first so every board is trimmed once per batch
+        batch = dict()
+        for tweet in tweets:
+            coin_id = self._coin_id(tweet["coin"])
+            if coin_id is None or tweet["date"] is None:
+                continue
+            user = tweet["user"]
+            retweets = tweet["retweets"] or 0
+            users = batch.setdefault((coin_id, str(tweet["date"])), dict())
+            stats = users.setdefault(user["id"], [0, 0, 0, 0])
+            stats[REACH] += user["followers"] * (1 + retweets)
+            stats[FOLLOWERS] = user["followers"]
+            stats[RETWEETS] += retweets
+            stats[NUM_TWEETS] += 1
+
+        with self._lock:
+            for key, users in batch.items():
+                board = self._board(key)
+                for user_id, stats in users.items():
+                    current = board.get(user_id)
+                    if current is None:
+                        board[user_id] = stats
+                    else:
+                        current[REACH] += stats[REACH]
+                        current[FOLLOWERS] = stats[FOLLOWERS]
+                        current[RETWEETS] += stats[RETWEETS]
+                        current[NUM_TWEETS] += stats[NUM_TWEETS]
+                if len(board) > self.capacity:
+                    kept = _largest(board, self.capacity)
+                    self._dropped.setdefault(key, set()).update(board.keys() - kept.keys())
+                    self._boards[key] = kept
+                self._dirty.add(key)
+
+
+    def flush(self) -> int:
+        """
+        Writes the users of every coin and day changed since the last flush,
+        one executemany per day, and deletes the users trimmed from them,
+        returns the number of rows written
+        """
+        with self._lock:
+            num_rows = 0
+            with METRICS.timer("leaderboard_flush_seconds"):
+                for key in sorted(self._dirty):
+                    coin_id, date = key
+                    board = self._boards[key]
+                    self._database.executemany(
+                        "INSERT INTO {0} (coin_id, date, user_id, reach, followers, "
+                        "retweets, num_tweets) VALUES (%s, %s, %s, %s, %s, %s, %s) "
+                        "ON DUPLICATE KEY UPDATE reach = VALUES(reach), "
+                        "followers = VALUES(followers), retweets = VALUES(retweets), "
+                        "num_tweets = VALUES(num_tweets)".format(TABLE),
+                        [(coin_id, date, user_id, *stats) for user_id, stats in board.items()])
+                    # A trimmed user that came back since is in the board again
+                    dropped = self._dropped.get(key, set()) - board.keys()
+                    self._database.executemany(
+                        "DELETE FROM {0} WHERE coin_id = %s AND date = %s AND user_id = %s"
+                        .format(TABLE), [(coin_id, date, user_id) for user_id in dropped])
+                    self._dropped.pop(key, None)
+                    num_rows += len(board)
+            self._dirty = set()
+            # The boards of earlier days are rarely added to again, they are
+            # loaded back from the table if they are
+            kept = set(sorted(set(date for _, date in self._boards))[-LOADED_DATES:])
+            self._boards = {key: board for key, board in self._boards.items()
+                            if key[1] in kept}
+        METRICS.counter("leaderboard_rows_written_total").inc(num_rows)
+        return num_rows
+
+
+    def top(self, coin: str, start: str, end: str = None, k: int = 10) -> list:
+        """
+        Returns the k users with the most reach about coin between the dates
+        start and end (inclusive) as dicts of their user_id, reach, followers
+        (the largest count seen in the window), retweets and num_tweets, read from the table only
+
+        :param coin: str name of the coin
+        :param start: str date, ex: 2019-02-11
+        :param end: optional str date, defaults to start
+        """
+        coin_id = self._coin_id(coin)
+        if coin_id is None:
+            return []
+        with self._lock:
+            rows = list(self._database.stream("""
+SELECT user_id, SUM(reach) AS total_reach, MAX(followers), SUM(retweets),
+    SUM(num_tweets)
+FROM {0}
+WHERE coin_id = %s AND date BETWEEN %s AND %s
+GROUP BY user_id
+ORDER BY total_reach DESC
+LIMIT %s""".format(TABLE), params=(coin_id, start, end or start, k)))
+        return [{"user_id": user_id, "reach": int(reach), "followers": followers,
+                 "retweets": int(retweets), "num_tweets": int(num_tweets)}
+                for user_id, reach, followers, retweets, num_tweets in rows]
+
+
+    def _board(self, key) -> dict:
+        """Returns the board of a coin and day, loading the stored one first"""
+        board = self._boards.get(key)
+        if board is None:
+            coin_id, date = key
+            rows = self._database.stream(
+                "SELECT user_id, reach, followers, retweets, num_tweets FROM {0} "
+                "WHERE coin_id = %s AND date = %s".format(TABLE), params=(coin_id, date))
+            board = {row[0]: list(row[1:]) for row in rows}
+            self._boards[key] = board
+        return board
+
+
+    def _coin_id(self, name: str):
+        if not self.coins.ids_loaded:
+            with self._lock:
+                if not self.coins.ids_loaded:
+                    self.coins.load_ids(self._database)
+        return self.coins.id_of(name)
+
+
+def _largest(board: dict, n: int) -> dict:
+    """Returns the n users of a board with the most reach"""
+    return dict(heapq.nlargest(n, board.items(), key=lambda item: item[1][REACH]))
+
+
+if __name__ == "__main__":
+    # Prints the leaderboard of a coin
+    # Usage: python3 influencer_leaderboard.py bitcoin 2019-02-01 [2019-02-07]
+    import sys
+
+    from cryptocurrencies import CRYPTOS
+    from database_wrapper import DatabaseWrapper
+
+    leaderboard = InfluencerLeaderboard(DatabaseWrapper(), CRYPTOS)
+    end = sys.argv[3] if len(sys.argv) > 3 else None
+    for rank, user in enumerate(leaderboard.top(sys.argv[1], sys.argv[2], end), 1):
+        print("{0:>3}. {1[user_id]}: reach {1[reach]}, {1[followers]} followers, "
+              "{1[num_tweets]} tweets, {1[retweets]} retweets".format(rank, user))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Storage for intraday (and daily) candles of every coin.
+
+All candles live in one 'klines' table keyed by (coin_id, interval_id,
+open_time) so a range of one coin's candles is a single clustered index scan.
+The row is kept as narrow as possible since 1m candles for ~34 coins add up
+to ~18M rows a year:
+    coin_id SMALLINT, interval_id TINYINT (index into INTERVALS),
+    open_time INT seconds since the epoch, FLOAT prices and volumes
+which is ~40 bytes of data per candle. Old fine grained candles can be folded
+into coarser ones with compact() to keep the table size bounded.
+
+Prices are in the quote asset of the coin's pairing (see
+Cryptocurrency.pairing()), so BTC for altcoins and USDT for bitcoin.
+"""
+
+import time
+
+from database_wrapper import DatabaseWrapper
+from data_collection.utilities import (INTERVAL_MILLISECONDS, get_kline_pages,
+                                       resample_klines)
+
+
+# The position of an interval in this tuple is its interval_id in the table,
+# only ever append to it
+INTERVALS = tuple(INTERVAL_MILLISECONDS.keys())
+
+KLINE_VALUE_COLUMNS = ("open", "high", "low", "close", "volume",
+                       "quote_volume", "num_trades")
+
+
+class KlineStore:
+    """
+    Class for writing and reading candles in the klines table.
+
+    Usage:
+        >>> store = KlineStore(DatabaseWrapper())
+        >>> store.create_table()
+        >>> store.fetch(coin, coin_id, "1m", start_time=...)
+        >>> store.read(coin_id, "1m", start="2019-01-01", end="2019-01-02")
+    """
+
+    def __init__(self, database=None):
+        self._database = database if database is not None else DatabaseWrapper()
+
+
+    def create_table(self):
+        """Creates the klines table if it doesn't already exist"""
+        if "klines" in self._database.show_tables():
+            return
+        self._database.execute("""
+CREATE TABLE klines (
+    coin_id SMALLINT UNSIGNED NOT NULL,
+    interval_id TINYINT UNSIGNED NOT NULL,
+    open_time INT UNSIGNED NOT NULL,
+    open FLOAT NOT NULL,
+    high FLOAT NOT NULL,
+    low FLOAT NOT NULL,
+    close FLOAT NOT NULL,
+    volume FLOAT NOT NULL,
+    quote_volume FLOAT NOT NULL,
+    num_trades INT UNSIGNED NOT NULL,
+    PRIMARY KEY (coin_id, interval_id, open_time)
+) ROW_FORMAT=COMPRESSED; """)
+
+
+    def insert(self, coin_id: int, interval: str, df) -> int:
+        """
+        Bulk inserts candles, candles that are already stored are updated
+        since the most recent candle of a previous fetch was still open
+
+        :param coin_id: int id of the coin in the cryptocurrencies table
+        :param interval: str key of INTERVAL_MILLISECONDS
+        :param df: dataframe of candles as returned by get_bars()
+        :returns: int of how many candles were written
+        """
+        if len(df) == 0:
+            return 0
+        interval_id = INTERVALS.index(interval)
+        rows = list(zip(
+            [coin_id] * len(df), [interval_id] * len(df),
+            (df["open_time"] // 1000).astype(int).tolist(),
+            df["open"].tolist(), df["high"].tolist(), df["low"].tolist(),
+            df["close"].tolist(), df["volume"].tolist(),
+            df["quote_asset_vol"].tolist(),
+            df["num_trades"].astype(int).tolist()))
+        self._upsert(rows)
+        return len(rows)
+
+
+    def fetch(self, coin, coin_id: int, interval: str, start_time: int = None,
+              end_time: int = None, verbose=False, rate_limiter=None) -> int:
+        """
+        Pulls the candles of a coin from binance page by page (using
+        startTime/limit) and inserts each page as it arrives. By default
+        continues from the last stored candle.
+
+        :param coin: Cryptocurrency to pull the candles of
+        :param coin_id: int id of the coin in the cryptocurrencies table
+        :param interval: str key of INTERVAL_MILLISECONDS
+        :param start_time: optional int timestamp in ms to start from
+        :param end_time: optional int timestamp in ms to stop at
+        :param rate_limiter: optional RateLimiter shared between threads that
+                             every request acquires its weight from
+        :returns: int of how many candles were written
+        """
+        if start_time is None:
+            last = self.last_open_time(coin_id, interval)
+            start_time = 0 if last is None else last * 1000
+        num_rows = 0
+        for page in get_kline_pages(coin.pairing(), interval, start_time,
+                                    end_time=end_time, rate_limiter=rate_limiter):
+            num_rows += self.insert(coin_id, interval, page)
+            if verbose:
+                print("{0} {1}: {2} candles".format(coin.name, interval,
+                                                    num_rows))
+        return num_rows
+
+
+    def last_open_time(self, coin_id: int, interval: str):
+        """
+        Returns the open time (in seconds) of the most recent stored candle,
+        None if there are no candles
+        """
+        result = self._database.query(
+            "SELECT MAX(open_time) FROM klines WHERE coin_id = {0} "
+            "AND interval_id = {1}".format(int(coin_id), INTERVALS.index(interval)))
+        return result[0][0] if result else None
+
+
+    def read(self, coin_id: int, interval: str, start: str = None,
+             end: str = None):
+        """
+        Returns the candles of a coin as a dataframe indexed by open time
+
+        :param start: optional str date/time (inclusive) to read from
+        :param end: optional str date/time (exclusive) to read up to
+        """
+        import pandas as pd
+
+        sql = ("SELECT open_time, " + ", ".join(KLINE_VALUE_COLUMNS) +
+               " FROM klines WHERE coin_id = %s AND interval_id = %s")
+        params = [coin_id, INTERVALS.index(interval)]
+        if start is not None:
+            sql += " AND open_time >= %s"
+            params.append(_to_seconds(start))
+        if end is not None:
+            sql += " AND open_time < %s"
+            params.append(_to_seconds(end))
+        sql += " ORDER BY open_time"
+
+        chunks = list(self._database.query_df_chunks(sql, params=tuple(params)))
+        if not chunks:
+            return pd.DataFrame(columns=KLINE_VALUE_COLUMNS,
+                                index=pd.DatetimeIndex([], name="open_time"))
+        df = pd.concat(chunks)
+        df["open_time"] = pd.to_datetime(df["open_time"], unit="s")
+        return df.set_index("open_time")
+
+
+    def compact(self, coin_id: int, from_interval: str, to_interval: str,
+                before: str) -> int:
+        """
+        Folds the from_interval candles older than before into to_interval
+        candles and deletes them, ex: keep 1m candles for a month and only 1h
+        candles after that. Returns the number of candles deleted.
+
+        :param before: str date, it should fall on a to_interval boundary so
+                       no coarse candle is built from a partial bucket
+        """
+        fine = self.read(coin_id, from_interval, end=before)
+        if fine.empty:
+            return 0
+        coarse = resample_klines(fine, to_interval)
+        interval_id = INTERVALS.index(to_interval)
+        rows = [(coin_id, interval_id, int(open_time.timestamp())) +
+                tuple(float(row[column]) for column in KLINE_VALUE_COLUMNS[:-1]) +
+                (int(row["num_trades"]),)
+                for open_time, row in coarse.iterrows()]
+        self._upsert(rows)
+        return self._database.execute(
+            "DELETE FROM klines WHERE coin_id = %s AND interval_id = %s "
+            "AND open_time < %s",
+            (coin_id, INTERVALS.index(from_interval), _to_seconds(before)))
+
+
+    def _upsert(self, rows: list):
+        columns = ("coin_id", "interval_id", "open_time") + KLINE_VALUE_COLUMNS
+        sql = "INSERT INTO klines ({0}) VALUES ({1}) ON DUPLICATE KEY UPDATE {2}".format(
+            ", ".join(columns), ", ".join(["%s"] * len(columns)),
+            ", ".join("{0} = VALUES({0})".format(column)
+                      for column in KLINE_VALUE_COLUMNS))
+        self._database.executemany(sql, rows)
+
+
+def _to_seconds(date: str) -> int:
+    """Converts a date/time str (UTC) to seconds since the epoch"""
+    import pandas as pd
+
+    return int(pd.Timestamp(date).value // 10 ** 9)
+
+
+if __name__ == "__main__":
+    import sys
+    from cryptocurrencies import CRYPTOS
+    from ornus_data_manager import DataManager
+
+    # Pull the candles of the last day for every coin at the given interval
+    interval = sys.argv[1] if len(sys.argv) > 1 else "1m"
+    manager = DataManager(CRYPTOS)
+    store = KlineStore()
+    store.create_table()
+    start_time = int((time.time() - 24 * 60 * 60) * 1000)
+    for coin in CRYPTOS:
+        coin_id = manager.get_coin_id(coin.name)
+        if coin_id is not None:
+            store.fetch(coin, coin_id, interval, start_time=start_time,
+                        verbose=True)
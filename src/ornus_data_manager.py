@@ -5,6 +5,19 @@ import sys
 import os
 
 from database_wrapper import DatabaseWrapper
+from data_collection import CoinRegistry
+from sentiment_rollup import SentimentRollup
+from kline_store import KlineStore
+from influencer_leaderboard import InfluencerLeaderboard
+from tweet_sketches import TweetSketches
+from twitter_user_cache import TwitterUserCache
+from data_collection.metrics import METRICS
+from data_collection.utilities import error, get_ticker_snapshot, usd_market_data
+
+MARKET_DATA_INSERT = (
+    "INSERT IGNORE INTO {0} (date, open, high, low, close, volume, num_trades, "
+    "positive_tweet_sentiment, negative_tweet_sentiment, average_tweet_sentiment) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
 
 
 class DataManager:
@@ -21,15 +34,41 @@ class DataManager:
         hashtags: table with all the hashtags found in tweets
         tweet_hashtag: many to many relationship between tweets and hashtags
         cryptocurrencies: a table of all the cryptocurrencies
+        sentiment_hourly, sentiment_daily: per coin sentiment rollups that are
+                       kept up to date as tweets are inserted
+        klines: intraday (and daily) candles of every coin, see kline_store.py
     
         Then each cryptocurrency additionally also has its own table storing 
         its daily market data. So there is an additional 30 - 100 tables for 
         all the cryptocurrencies currently being collected
     """
 
-    def __init__(self, coins):
+    def __init__(self, coins, user_cache=None):
+        """
+        :param coins: CoinRegistry (or list of Cryptocurrency, whose ids are
+                      then queried one at a time)
+        :param user_cache: optional TwitterUserCache to share between the
+                           DataManagers of a run (one per thread)
+        """
         self.coins = coins
         self._database = DatabaseWrapper()
+        self._rollups = SentimentRollup(self._database)
+        self._users = user_cache if user_cache is not None else TwitterUserCache()
+        self._batch_listeners = list()
+
+
+    def add_batch_listener(self, listener):
+        """
+        Registers listener(tweets) to be called after every insert_tweets()
+        with the tweets of the batch that were new to the database, ex: to
+        keep a TweetIndex up to date
+        """
+        self._batch_listeners.append(listener)
+
+
+    def ping(self):
+        """Makes sure the database connection is still open"""
+        self._database.ping()
 
 
     def insert_hashtag(self, hashtag):
@@ -45,15 +84,26 @@ class DataManager:
             "date_created": "DATE",
             "followers": "INT UNSIGNED",
             "friends": "INT UNSIGNED",
+        An existing user's followers and friends are updated if they changed
         """
-        self._database.insert_into_table(twitter_user, "twitter_users")
+        self.insert_twitter_users([twitter_user])
 
 
-    def insert_tweet(self, tweet: dict):
+    def insert_twitter_users(self, twitter_users: list) -> int:
+        """
+        Upserts a batch of twitter users, skipping the ones already written
+        this run with the same followers and friends (see TwitterUserCache),
+        returns how many users were written
+        """
+        return self._users.upsert(self._database, twitter_users)
+
+
+    def insert_tweet(self, tweet: dict) -> bool:
         """
         Will insert  a tweet into the 'tweets' table, with these columns:
             "id": "BIGINT UNSIGNED UNIQUE PRIMARY KEY NOT NULL",
             "date": "DATE",
+            "created_at": "DATETIME",
             "content": "VARCHAR(1120) CHARACTER SET utf8 COLLATE utf8_unicode_ci",
             "coin_id": "INT UNSIGNED NOT NULL",
             "sentiment": "FLOAT",
@@ -61,24 +111,59 @@ class DataManager:
             "retweets": "INT UNSIGNED",
 
         Will also add the hashtags to the database, and the twitter user to the database
+        Returns whether the tweet was new to the database
         """
-        self.insert_twitter_user(tweet["user"])
+        return self.insert_tweets([tweet]) == 1
+
 
+    def insert_tweets(self, tweets: list) -> int:
+        """
+        Inserts a batch of tweets (see insert_tweet()) and then updates the
+        sentiment rollup tables with the tweets that were not already in the
+        database, returns how many tweets were new
+        """
+        # The users go first since tweets.user_id references them
+        self.insert_twitter_users([tweet["user"] for tweet in tweets])
+        inserted = list()
+        new_tweets = list()
+        for tweet in tweets:
+            formatted_tweet = self._insert_tweet(tweet)
+            if formatted_tweet is not None:
+                inserted.append(formatted_tweet)
+                new_tweets.append(tweet)
+        self._rollups.add(inserted)
+        for listener in self._batch_listeners:
+            listener(new_tweets)
+        METRICS.counter("tweets_processed_total").inc(len(tweets))
+        METRICS.counter("tweets_inserted_total").inc(len(inserted))
+        return len(inserted)
+
+
+    def _insert_tweet(self, tweet: dict):
+        """
+        Inserts a single tweet and its hashtags, returns the row as inserted
+        into the tweets table or None if nothing was inserted. The tweet's
+        user must already be in the twitter_users table.
+        """
         formatted_tweet = {
                 "id": tweet["id"],
                 "date": tweet["date"],
+                "created_at": tweet["created_at"],
                 "content": tweet["text"],
                 "coin_id": self.get_coin_id(tweet["coin"]),
                 "sentiment": tweet["sentiment"],
                 "user_id": tweet["user"]["id"],
                 "retweets": tweet["retweets"]
         }
+        inserted = False
         if formatted_tweet["coin_id"] is not None:
             # The try except is for ignoring tweets that are not properly encoded and thus ignored
             try:
-                self._database.insert_into_table(formatted_tweet, "tweets")
-            except Exception as e: 
-                return
+                inserted = self._database.insert_into_table(formatted_tweet, "tweets") == 1
+            except Exception as e:
+                METRICS.counter("tweets_failed_total").inc()
+                error("Couldn't insert tweet {0}: {1}".format(tweet["id"], e))
+                return None
 
         # Insert the hashtags into the hashtag table and insert them into the 
         # tweet_hashtag table for the many to many relationship between tweets
@@ -91,8 +176,76 @@ class DataManager:
             }
             if None not in tweet_hashtag.values():
                 self._database.insert_into_table(tweet_hashtag, "tweet_hashtag")
+
+        return formatted_tweet if inserted else None
             
 
+    def insert_reddit(self, collection: dict) -> dict:
+        """
+        Bulk inserts everything collected by RedditManager.collect(), posts
+        and comments that are already stored get their score (and sentiment)
+        updated. Returns a dict of how many rows were written per table.
+        """
+        subreddits = collection["subreddits"]
+        self._database.executemany(
+            "INSERT INTO subreddits (name, subscribers, date_created) "
+            "VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE "
+            "subscribers = VALUES(subscribers)",
+            [(subreddit["name"], subreddit["subscribers"], subreddit["date_created"])
+             for subreddit in subreddits])
+        subreddit_ids = {name.lower(): subreddit_id for subreddit_id, name in
+                         self._database.query("SELECT id, name FROM subreddits")}
+
+        users = collection["users"]
+        self._database.executemany(
+            "INSERT INTO reddit_users (id, username) VALUES (%s, %s) "
+            "ON DUPLICATE KEY UPDATE username = VALUES(username)",
+            [(user["id"], user["username"]) for user in users])
+
+        coin_ids = {coin: self.get_coin_id(coin) for coin in
+                    set(record["coin"] for record in
+                        collection["posts"] + collection["comments"])}
+
+        posts = [(post["id"], post["date"], post["title"], post["content"],
+                  coin_ids[post["coin"]], post["sentiment"], post["user_id"],
+                  post["score"], post["num_comments"], post["upvote_percentage"],
+                  subreddit_ids.get(post["subreddit"].lower()), post["link"])
+                 for post in collection["posts"]
+                 if coin_ids[post["coin"]] is not None]
+        posts = [post for post in posts if post[10] is not None]
+        self._database.executemany(
+            "INSERT INTO reddit_posts (id, date, title, content, coin_id, "
+            "sentiment, user_id, score, num_comments, upvote_percentage, "
+            "subreddit_id, link) VALUES (" + ", ".join(["%s"] * 12) + ") "
+            "ON DUPLICATE KEY UPDATE score = VALUES(score), "
+            "num_comments = VALUES(num_comments), "
+            "upvote_percentage = VALUES(upvote_percentage), "
+            "sentiment = VALUES(sentiment)", posts)
+
+        comments = [(comment["id"], comment["date"], comment["content"],
+                     coin_ids[comment["coin"]], comment["sentiment"],
+                     comment["user_id"], comment["score"], comment["parent_id"],
+                     comment["permalink"], comment["submission_id"])
+                    for comment in collection["comments"]
+                    if coin_ids[comment["coin"]] is not None]
+        self._database.executemany(
+            "INSERT INTO reddit_comments (id, date, content, coin_id, sentiment, "
+            "user_id, score, parent_id, permalink, submission_id) VALUES (" +
+            ", ".join(["%s"] * 10) + ") ON DUPLICATE KEY UPDATE "
+            "score = VALUES(score), sentiment = VALUES(sentiment)", comments)
+
+        return {"subreddits": len(subreddits), "reddit_users": len(users),
+                "reddit_posts": len(posts), "reddit_comments": len(comments)}
+
+
+    def sentiment_totals(self, start: str, end: str = None) -> dict:
+        """
+        Returns the sentiment of every coin's tweets dated in [start, end)
+        from the daily rollups, in the format fill_market_data_tables() takes
+        """
+        return self._rollups.totals(start, end)
+
+
     def get_hashtag_id(self, hashtag: str):
         """
         Returns the id of coin in the cryptocurrency table, 
@@ -115,6 +268,11 @@ class DataManager:
         returns None if coin is not in the table
         :param coin: str of the name of the coin, note: not the ticker
         """
+        if isinstance(self.coins, CoinRegistry):
+            # All the ids are loaded in one query, then every lookup is a dict hit
+            if not self.coins.ids_loaded:
+                self.coins.load_ids(self._database)
+            return self.coins.id_of(coin)
         sql = "SELECT id FROM cryptocurrencies WHERE name = '{0}'".format(coin)
         result = self._database.query(sql)
         if result == []:
@@ -130,40 +288,63 @@ class DataManager:
         for coin in self.coins:
             self._database.insert_into_table(entry=coin.schema(), 
                     table="cryptocurrencies")
+        if isinstance(self.coins, CoinRegistry):
+            # New coins were just given their ids
+            self.coins.load_ids(self._database)
 
 
-    def fill_market_data_tables(self, sentiment_data: dict, verbose=False):
+    def fill_market_data_tables(self, sentiment_data: dict, verbose=False,
+                                coins=None, tickers=None, date: str = None,
+                                rate_limiter=None):
         """
-        Populate each table for each individual cryptocurrency with its daily market data
+        Populate each table for each individual cryptocurrency with its daily market data,
+        the prices of every coin come from one binance snapshot and are written in one transaction
         :param sentiment_data: dict storing all the twitter sentiment values for each coin
                                so its structure should be: 
                                {"coin1": [ ... ], "coin2": [ ... ], ... }
         :paramm verbose: bool on whether to periodically notify the user how much has been completed
+        :param coins: optional list of the coins to fill, defaults to self.coins
+        :param tickers: optional dataframe of get_ticker_snapshot(), pulled if not given
+        :param date: optional str date of the rows, defaults to today
+        :param rate_limiter: optional RateLimiter of the binance requests the
+                             snapshot acquires its weight from
         """
-        for index, coin in enumerate(self.coins): 
+        coins = self.coins if coins is None else coins
+        with METRICS.timer("market_data_seconds"):
+            if tickers is None:
+                tickers = get_ticker_snapshot(rate_limiter=rate_limiter)
+            prices = usd_market_data(tickers, coins)
+            if date is not None:
+                prices["date"] = date
+
+        statements = list()
+        for coin in coins: 
+            if coin.name not in prices.index:
+                error("No market data for {0} ({1})".format(coin.name, coin.pairing()))
+                continue
             average_sentiment = sentiment_data[coin.name]["sum"] / sentiment_data[coin.name]["length"]
             pos_percentage = sentiment_data[coin.name]["pos_sentiment"] / sentiment_data[coin.name]["length"]
             neg_percentage = sentiment_data[coin.name]["neg_sentiment"] / sentiment_data[coin.name]["length"]
 
-
-            coin_data = coin.current_market_data()
-            market_data = {
-                "date": coin_data["date"],
-                "open": coin_data["open"],
-                "high": coin_data["high"],
-                "low": coin_data["low"],
-                "close": coin_data["close"],
-                "volume": coin_data["volume"],
-                "num_trades": coin_data["num_trades"],
-                "positive_tweet_sentiment": pos_percentage,
-                "negative_tweet_sentiment": neg_percentage,
-                "average_tweet_sentiment": average_sentiment,
-            }
-            self._database.insert_into_table(market_data, coin.name)
-            if (index+1) % 10 == 0 and verbose:
-                print("Processed market data for", (index+1), 
-                        "of", len(self.coins), "coins.", end=" ")
-                print("Percent Complete: {:0.2f}".format(index/len(self.coins)))
+            coin_data = prices.loc[coin.name]
+            market_data = (
+                coin_data["date"],
+                float(coin_data["open"]),
+                float(coin_data["high"]),
+                float(coin_data["low"]),
+                float(coin_data["close"]),
+                float(coin_data["volume"]),
+                int(coin_data["num_trades"]),
+                pos_percentage,
+                neg_percentage,
+                average_sentiment,
+            )
+            statements.append((MARKET_DATA_INSERT.format(coin.name), market_data))
+
+        self._database.execute_batch(statements)
+        if verbose:
+            print("Processed market data for", len(statements), 
+                    "of", len(coins), "coins.")
 
 
     def create_tables(self):
@@ -204,6 +385,7 @@ class DataManager:
         tweets_schema = {
                 "id": "BIGINT UNSIGNED UNIQUE PRIMARY KEY NOT NULL",
                 "date": "DATE",
+                "created_at": "DATETIME",
                 "content": "VARCHAR(1120) CHARACTER SET utf8 COLLATE utf8_unicode_ci",
                 "coin_id": "INT UNSIGNED NOT NULL",
                 "sentiment": "FLOAT",
@@ -215,6 +397,12 @@ class DataManager:
                 "user_id": ("twitter_users", "id"),
         }
         self._database.create_table("tweets", tweets_schema, tweets_foreign_keys)
+        # Tables created before tweets had a timestamp need the column added
+        self._database.add_column("tweets", "created_at", tweets_schema["created_at"])
+        self._rollups.create_tables()
+        KlineStore(self._database).create_table()
+        InfluencerLeaderboard(self._database, self.coins).create_table()
+        TweetSketches(self._database, self.coins).create_table()
 
         hashtag_schema = {
                 "id": "INT UNSIGNED AUTO_INCREMENT PRIMARY KEY NOT NULL",
@@ -243,10 +431,13 @@ CREATE TABLE tweet_hashtag (
                 "user_id": "BIGINT UNSIGNED NOT NULL",
                 "score": "INT UNSIGNED",
                 "parent_id": "BIGINT UNSIGNED",
-                "permalink": "VARCHAR(100)",
+                "permalink": "VARCHAR(512)",
                 "submission_id": "VARCHAR(15)",
         } 
         self._database.create_table("reddit_comments", reddit_comments_schema)
+        # Tables created when the links were truncated to 100 characters
+        self._database.modify_column("reddit_comments", "permalink",
+                                     reddit_comments_schema["permalink"])
 
         reddit_user_schema = {
                 "id": "VARCHAR(20) UNIQUE PRIMARY KEY NOT NULL",
@@ -272,9 +463,10 @@ CREATE TABLE tweet_hashtag (
                 "num_comments": "INT UNSIGNED",
                 "upvote_percentage": "FLOAT UNSIGNED",
                 "subreddit_id": "BIGINT UNSIGNED NOT NULL",
-                "link": "VARCHAR(100)",
+                "link": "VARCHAR(512)",
         }
         self._database.create_table("reddit_posts", reddit_post_schema)
+        self._database.modify_column("reddit_posts", "link", reddit_post_schema["link"])
 
         subreddit_schema = {
                 "id": "INT UNSIGNED AUTO_INCREMENT PRIMARY KEY NOT NULL",
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Profiling support for the collection pipeline (see daily_data.py --profile).
+
+Two modes are available:
+    cprofile: deterministic profiling with cProfile of the main thread and
+              every thread started while a stage is running, the per thread
+              stats are merged into one pstats file per stage
+    sampling: a background thread samples the stacks of every thread at a
+              fixed interval, which has a much lower overhead and writes the
+              samples as collapsed stacks (the input format of flamegraph.pl
+              and speedscope)
+
+Process pool workers can be profiled by passing worker_initializer() (with
+worker_initargs()) as the pool's initializer, each worker then writes its own
+file into the stage directory which is merged into the stage's report.
+
+Usage:
+    >>> profiler = Profiler("cprofile", output_dir="profiles/")
+    >>> with profiler.stage("insert_tweets"):
+    ...     threader.analyze_sentiment()
+    ... # writes profiles/insert_tweets.pstats and prints the hot functions
+"""
+
+import collections
+import contextlib
+import cProfile
+import glob
+import io
+import os
+import pstats
+import sys
+import threading
+
+
+PROFILE_MODES = ("cprofile", "sampling")
+PROFILE_DIRECTORY = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "profiles")
+
+# Seconds between two stack samples in sampling mode
+SAMPLING_INTERVAL = 0.005
+# Number of functions printed at the end of each stage
+NUM_HOT_FUNCTIONS = 25
+
+# Since python 3.12 cProfile is built on sys.monitoring which sees every
+# thread, so one profiler is enough and a second one can't be enabled
+_PROFILER_SEES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class Profiler:
+    """
+    Class that profiles named stages of a run, stages are profiled one at a
+    time and each of them gets its own output files
+    """
+
+    def __init__(self, mode: str = None, output_dir: str = PROFILE_DIRECTORY,
+                 num_hot_functions: int = NUM_HOT_FUNCTIONS):
+        """
+        :param mode: str in PROFILE_MODES or None to disable profiling
+        :param output_dir: str of the directory the profiles are written to
+        :param num_hot_functions: int of how many functions are printed
+        """
+        if mode is not None and mode not in PROFILE_MODES:
+            raise ValueError("Profile mode must be one of " + str(PROFILE_MODES))
+        self.mode = mode
+        self.output_dir = output_dir
+        self.num_hot_functions = num_hot_functions
+
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode is not None
+
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Context manager that profiles everything run inside of it"""
+        if not self.enabled:
+            yield
+            return
+
+        os.makedirs(self.stage_directory(name), exist_ok=True)
+        if self.mode == "cprofile":
+            profile = _ThreadedCProfile()
+        else:
+            profile = _StackSampler(SAMPLING_INTERVAL)
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            self._report(name, profile)
+
+
+    def stage_directory(self, name: str) -> str:
+        """Directory the process pool workers of a stage write their files to"""
+        return os.path.join(self.output_dir, name + ".workers")
+
+
+    def worker_initargs(self, name: str) -> tuple:
+        """Arguments for worker_initializer() in the workers of stage name"""
+        return (self.mode, self.stage_directory(name))
+
+
+    def _report(self, name: str, profile):
+        worker_directory = self.stage_directory(name)
+        if self.mode == "cprofile":
+            path = os.path.join(self.output_dir, name + ".pstats")
+            stats = profile.stats()
+            for worker_file in glob.glob(os.path.join(worker_directory, "*.pstats")):
+                stats = _add_stats(stats, pstats.Stats(worker_file))
+            if stats is None:
+                return
+            stats.dump_stats(path)
+            print("Profile of stage '{0}' written to {1}".format(name, path))
+            _print_hot_functions(stats, self.num_hot_functions)
+        else:
+            path = os.path.join(self.output_dir, name + ".collapsed")
+            samples = profile.samples()
+            for worker_file in glob.glob(os.path.join(worker_directory, "*.collapsed")):
+                samples.update(_read_collapsed(worker_file))
+            _write_collapsed(samples, path)
+            print("Profile of stage '{0}' written to {1} ({2} samples)".format(
+                name, path, sum(samples.values())))
+            _print_hot_samples(samples, self.num_hot_functions)
+
+
+class _ThreadedCProfile:
+    """
+    cProfile of the current thread and every thread started while it runs.
+    threading.setprofile() installs a hook in each new thread whose first
+    call replaces itself with a cProfile profiler owned by that thread.
+    """
+
+    def __init__(self):
+        self._profiles = list()
+        self._lock = threading.Lock()
+
+    def start(self):
+        main_profile = cProfile.Profile()
+        self._profiles.append(main_profile)
+        if not _PROFILER_SEES_ALL_THREADS:
+            threading.setprofile(self._thread_hook)
+        main_profile.enable()
+
+    def stop(self):
+        if not _PROFILER_SEES_ALL_THREADS:
+            threading.setprofile(None)
+        self._profiles[0].disable()
+
+    def stats(self):
+        stats = None
+        with self._lock:
+            profiles = list(self._profiles)
+        for profile in profiles:
+            stats = _add_stats(stats, pstats.Stats(profile))
+        return stats
+
+    def _thread_hook(self, frame, event, arg):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+
+class _StackSampler:
+    """Samples the stacks of every thread from a background thread"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack_sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def samples(self):
+        return collections.Counter(self._samples)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self._samples[_collapse(frame, names.get(thread_id, thread_id))] += 1
+
+
+def worker_initializer(mode: str, output_dir: str):
+    """
+    Initializer for process pool workers that profiles the worker until it
+    exits and then writes its profile to output_dir
+    """
+    if mode is None:
+        return
+    from multiprocessing.util import Finalize
+
+    os.makedirs(output_dir, exist_ok=True)
+    if mode == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+
+        def dump():
+            profile.disable()
+            profile.dump_stats(os.path.join(output_dir, "{0}.pstats".format(os.getpid())))
+    else:
+        sampler = _StackSampler(SAMPLING_INTERVAL)
+        sampler.start()
+
+        def dump():
+            sampler.stop()
+            _write_collapsed(sampler.samples(), os.path.join(
+                output_dir, "{0}.collapsed".format(os.getpid())))
+    # Finalizers run when a pool worker shuts down, unlike atexit handlers
+    Finalize(None, dump, exitpriority=16)
+
+
+def _collapse(frame, thread_name) -> str:
+    stack = list()
+    while frame is not None:
+        code = frame.f_code
+        stack.append("{0} ({1}:{2})".format(code.co_name,
+                                           os.path.basename(code.co_filename),
+                                           code.co_firstlineno))
+        frame = frame.f_back
+    stack.append("thread:{0}".format(thread_name))
+    return ";".join(reversed(stack))
+
+
+def _write_collapsed(samples, path: str):
+    with open(path, "w") as f:
+        for stack, count in samples.most_common():
+            f.write("{0} {1}\n".format(stack, count))
+
+
+def _read_collapsed(path: str):
+    samples = collections.Counter()
+    with open(path, "r") as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            samples[stack] += int(count)
+    return samples
+
+
+def _add_stats(stats, other):
+    if stats is None:
+        return other
+    stats.add(other)
+    return stats
+
+
+def _print_hot_functions(stats, num_functions: int):
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats("tottime").print_stats(num_functions)
+    stats.sort_stats("cumulative").print_stats(num_functions)
+    print(stream.getvalue())
+
+
+def _print_hot_samples(samples, num_functions: int):
+    """Prints the functions that appear in the most samples (self and total)"""
+    own = collections.Counter()
+    total = collections.Counter()
+    num_samples = sum(samples.values())
+    for stack, count in samples.items():
+        frames = stack.split(";")[1:]
+        if not frames:
+            continue
+        own[frames[-1]] += count
+        for function in set(frames):
+            total[function] += count
+    print("{0:>8} {1:>8}  function".format("self%", "total%"))
+    for function, count in own.most_common(num_functions):
+        print("{0:>7.1f}% {1:>7.1f}%  {2}".format(
+            100.0 * count / num_samples, 100.0 * total[function] / num_samples,
+            function))
+
+
+if __name__ == "__main__":
+    # Prints the hot functions of a pstats or collapsed file written earlier
+    path = sys.argv[1]
+    if path.endswith(".collapsed"):
+        _print_hot_samples(_read_collapsed(path), NUM_HOT_FUNCTIONS)
+    else:
+        _print_hot_functions(pstats.Stats(path), NUM_HOT_FUNCTIONS)
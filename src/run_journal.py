@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Journal of the progress of a daily_data.py run so a run that died can be
+resumed (--resume) without repeating the work that was already done.
+
+Every run gets a directory in JOURNAL_DIRECTORY with:
+    journal.jsonl: append only log of the completed steps, one JSON event
+                   per line, flushed and fsynced as it's written
+    fetched/: the scored tweets of every coin and search round, written
+              before the round is journaled
+
+Tweets are inserted in batches whose ids are derived from the fetched
+round they come from ("<coin>/<round>/<chunk>"), so a resumed run splits
+the tweets into the same batches and only inserts the ones that were not
+journaled as inserted. A batch that was being inserted during the crash is
+inserted again, which is harmless as only new tweets are written and added
+to the sentiment rollups (see DataManager.insert_tweets()).
+
+The batch listeners of the insert (the tweet index, leaderboards, ...) only
+persist their state when they are flushed, so every inserted batch is
+journaled with the ids of its tweets that were new, and every flush of a
+listener is journaled too. A resumed run feeds each listener the new tweets
+of the batches inserted since its last flush (see unflushed()).
+
+Usage:
+    >>> journal = RunJournal.create(num_tweets_per_coin=500)
+    >>> journal.record_fetch("bitcoin", 0, tweets)
+    >>> for batch_id, batch in journal.tweet_batches(100):
+    ...     if not journal.inserted(batch_id):
+    ...         insert(batch)
+    ...         journal.record_insert(batch_id)
+    >>> journal.finish()
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+from data_collection import error
+
+
+JOURNAL_DIRECTORY = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "journal")
+JOURNAL_FILE = "journal.jsonl"
+FETCHED_DIRECTORY = "fetched"
+
+
+class RunJournal:
+    """
+    Progress of one run, safe to record from several threads.
+
+    Usage:
+        >>> journal = RunJournal.resume()  # the latest unfinished run
+        >>> journal.stage_done("collect_tweets")
+        ... True
+    """
+
+    def __init__(self, run_id: str, directory: str = JOURNAL_DIRECTORY,
+                 read_only: bool = False):
+        """
+        Opens the journal of run_id, replaying its events if it exists
+
+        :param run_id: str id of the run, ex: 2019-02-11-120000
+        :param directory: str of the directory holding every run's journal
+        :param read_only: bool for whether to only replay the journal, ex: to
+                          print its progress, without creating its directories,
+                          cutting off a torn last line or recording events
+        """
+        self.run_id = run_id
+        self.path = os.path.join(directory, run_id)
+        self.params = dict()
+        self.finished = False
+        self._stages = dict()
+        # (coin, round) -> (file name, number of tweets)
+        self._fetched = dict()
+        self._inserted = set()
+        # batch id -> ids of its tweets that were new, if they were journaled
+        self._new_ids = dict()
+        # listener -> set of the batch ids inserted before its last flush
+        self._flushed = dict()
+        self._lock = threading.Lock()
+
+        self._log = None
+        if read_only:
+            self._replay(repair=False)
+            return
+        os.makedirs(os.path.join(self.path, FETCHED_DIRECTORY), exist_ok=True)
+        self._replay()
+        self._log = open(os.path.join(self.path, JOURNAL_FILE), "a")
+
+
+    @classmethod
+    def create(cls, directory: str = JOURNAL_DIRECTORY, **params):
+        """Starts the journal of a new run, params are kept for resuming it"""
+        journal = cls(time.strftime("%Y-%m-%d-%H%M%S"), directory)
+        journal.params = params
+        journal._write({"event": "started", "params": params})
+        return journal
+
+
+    @classmethod
+    def resume(cls, run_id: str = None, directory: str = JOURNAL_DIRECTORY):
+        """
+        Opens the journal of run_id, defaults to the latest unfinished run
+
+        :raises ValueError: if there is no such run or it already finished
+        """
+        if run_id is None:
+            run_ids = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+            unfinished = [run for run in run_ids
+                          if os.path.exists(os.path.join(directory, run, JOURNAL_FILE))
+                          and not _finished(os.path.join(directory, run, JOURNAL_FILE))]
+            if not unfinished:
+                raise ValueError("No unfinished run to resume in " + directory)
+            run_id = unfinished[-1]
+        if not os.path.exists(os.path.join(directory, run_id, JOURNAL_FILE)):
+            raise ValueError("No journal for run " + run_id)
+        journal = cls(run_id, directory)
+        if journal.finished:
+            raise ValueError("Run {0} already finished".format(run_id))
+        journal._write({"event": "resumed"})
+        return journal
+
+
+    def stage_done(self, stage: str) -> bool:
+        with self._lock:
+            return stage in self._stages
+
+
+    def stages(self) -> list:
+        """Returns the names of the completed stages"""
+        with self._lock:
+            return list(self._stages)
+
+
+    def complete_stage(self, stage: str, **details):
+        """Journals that a stage of the run is done, with optional details"""
+        self._write({"event": "stage", "stage": stage, "details": details})
+
+
+    def fetched(self, coin: str, search_round: int) -> bool:
+        """Returns whether the tweets of a coin's search round are journaled"""
+        with self._lock:
+            return (coin, search_round) in self._fetched
+
+
+    def record_fetch(self, coin: str, search_round: int, tweets: list):
+        """
+        Writes the scored tweets of a coin's search round and journals them,
+        a crash in between leaves an orphan file that is never read
+        """
+        name = "{0}-{1}.json".format(coin, search_round)
+        path = os.path.join(self.path, FETCHED_DIRECTORY, name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(tweets, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self._write({"event": "fetched", "coin": coin, "round": search_round,
+                     "file": name, "num_tweets": len(tweets)})
+
+
+    def num_tweets(self) -> int:
+        with self._lock:
+            return sum(num_tweets for _, num_tweets in self._fetched.values())
+
+
+    def tweet_batches(self, batch_size: int):
+        """
+        Generator of (batch_id, list of tweets) over every fetched round, a
+        round at a time, the ids are the same every time it's called
+        """
+        with self._lock:
+            fetched = sorted(self._fetched.items())
+        for (coin, search_round), (name, _) in fetched:
+            with open(os.path.join(self.path, FETCHED_DIRECTORY, name), "r") as f:
+                tweets = json.load(f)
+            for chunk, start in enumerate(range(0, len(tweets), batch_size)):
+                batch_id = "{0}/{1}/{2}".format(coin, search_round, chunk)
+                yield batch_id, tweets[start:start + batch_size]
+
+
+    def inserted(self, batch_id: str) -> bool:
+        with self._lock:
+            return batch_id in self._inserted
+
+
+    def num_inserted(self) -> int:
+        with self._lock:
+            return len(self._inserted)
+
+
+    def record_insert(self, batch_id: str, new_ids: list = None):
+        """
+        Journals that a batch was inserted
+
+        :param new_ids: optional list of the ids of its tweets that were new
+                        to the database, the ones its listeners were given
+        """
+        self._write({"event": "inserted", "batch": batch_id, "new": new_ids})
+
+
+    def record_flush(self, listener: str):
+        """
+        Journals that a batch listener persisted every batch journaled as
+        inserted so far, call it once no batch is being inserted
+        """
+        self._write({"event": "flushed", "listener": listener})
+
+
+    def unflushed(self, listener: str) -> dict:
+        """
+        Returns a dict of the batches inserted since listener's last flush to
+        the ids of their new tweets, the batches whose ids weren't journaled
+        are left out
+        """
+        with self._lock:
+            flushed = self._flushed.get(listener, set())
+            return {batch_id: self._new_ids[batch_id] for batch_id in self._inserted
+                    if batch_id not in flushed and self._new_ids.get(batch_id)}
+
+
+    def finish(self, cleanup: bool = True):
+        """
+        Journals that the run is done
+
+        :param cleanup: bool for whether to delete the fetched tweets, which
+                        are all in the database by now
+        """
+        self._write({"event": "finished"})
+        self._log.close()
+        if cleanup:
+            shutil.rmtree(os.path.join(self.path, FETCHED_DIRECTORY),
+                          ignore_errors=True)
+
+
+    def _write(self, event: dict):
+        if self._log is None:
+            raise ValueError("The journal of run {0} was opened read only".format(
+                self.run_id))
+        event["time"] = time.time()
+        with self._lock:
+            self._log.write(json.dumps(event) + "\n")
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._apply(event)
+
+
+    def _replay(self, repair: bool = True):
+        """
+        Applies the journaled events
+
+        :param repair: bool for whether to cut off a torn last line, otherwise
+                       it's only ignored
+        """
+        path = os.path.join(self.path, JOURNAL_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            content = f.read()
+        complete = content.rfind(b"\n") + 1
+        if complete < len(content) and repair:
+            # A crash mid write leaves a torn last line, it's cut off so the
+            # next event starts on a line of its own
+            error("Ignoring the torn last line of " + path)
+            with open(path, "r+b") as f:
+                f.truncate(complete)
+        for line in content[:complete].decode("utf8").splitlines():
+            self._apply(json.loads(line))
+
+
+    def _apply(self, event: dict):
+        kind = event["event"]
+        if kind == "started":
+            self.params = event["params"]
+        elif kind == "stage":
+            self._stages[event["stage"]] = event["details"]
+        elif kind == "fetched":
+            self._fetched[(event["coin"], event["round"])] = (
+                event["file"], event["num_tweets"])
+        elif kind == "inserted":
+            self._inserted.add(event["batch"])
+            self._new_ids[event["batch"]] = event.get("new")
+        elif kind == "flushed":
+            self._flushed[event["listener"]] = set(self._inserted)
+        elif kind == "finished":
+            self.finished = True
+
+
+def _finished(path: str) -> bool:
+    with open(path, "r") as f:
+        return any('"event": "finished"' in line for line in f)
+
+
+if __name__ == "__main__":
+    # Prints the progress of every journaled run
+    # Usage: python3 run_journal.py
+    if os.path.isdir(JOURNAL_DIRECTORY):
+        for run_id in sorted(os.listdir(JOURNAL_DIRECTORY)):
+            if not os.path.exists(os.path.join(JOURNAL_DIRECTORY, run_id, JOURNAL_FILE)):
+                continue
+            journal = RunJournal(run_id, read_only=True)
+            print("{0}: {1}, {2} tweets fetched, {3} batches inserted, "
+                  "stages done: {4}".format(
+                      run_id, "finished" if journal.finished else "unfinished",
+                      journal.num_tweets(), journal.num_inserted(),
+                      ", ".join(journal.stages()) or "none"))
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Maintains the per coin sentiment rollup tables so that sentiment time series
+can be read from O(days) rows instead of rescanning the tweets table.
+
+Tables:
+    sentiment_hourly: one row per coin per hour
+    sentiment_daily: one row per coin per day
+
+    Both tables store the number of tweets, the sum and the sum of squares of
+    their sentiment and how many of them were positive or negative, which is
+    enough to recover the mean, variance and positive/negative percentages
+    of any period and to combine periods together.
+"""
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from database_wrapper import DatabaseWrapper
+
+
+# granularity: (table name, type of the period column, sql expression that
+# buckets a row of the tweets table into a period, column of the tweets table
+# the periods are made from)
+GRANULARITIES = {
+    "hourly": ("sentiment_hourly", "DATETIME",
+               "DATE_FORMAT(created_at, '%Y-%m-%d %H:00:00')", "created_at"),
+    "daily": ("sentiment_daily", "DATE", "date", "date"),
+}
+
+ROLLUP_COLUMNS = ("num_tweets", "sentiment_sum", "sentiment_sum_squares",
+                  "num_positive", "num_negative")
+
+
+class SentimentRollup:
+    """
+    Class for maintaining the sentiment rollup tables.
+
+    Usage:
+        >>> rollup = SentimentRollup(DatabaseWrapper())
+        >>> rollup.create_tables()
+        >>> rollup.add(formatted_tweets)  # after inserting into tweets
+        >>> rollup.series(coin_id=1, granularity="daily")
+    """
+
+    def __init__(self, database):
+        """
+        :param database: DatabaseWrapper used for the incremental upserts
+        """
+        self._database = database
+
+
+    def create_tables(self):
+        """Creates the rollup tables if they don't already exist"""
+        tables = self._database.show_tables()
+        for table, period_type, _, _ in GRANULARITIES.values():
+            if table in tables:
+                continue
+            self._database.execute("""
+CREATE TABLE {0} (
+    coin_id INT UNSIGNED NOT NULL,
+    period {1} NOT NULL,
+    num_tweets INT UNSIGNED NOT NULL,
+    sentiment_sum DOUBLE NOT NULL,
+    sentiment_sum_squares DOUBLE NOT NULL,
+    num_positive INT UNSIGNED NOT NULL,
+    num_negative INT UNSIGNED NOT NULL,
+    FOREIGN KEY (coin_id) REFERENCES cryptocurrencies (id) ON DELETE RESTRICT ON UPDATE CASCADE,
+    PRIMARY KEY (coin_id, period)
+); """.format(table, period_type))
+
+
+    def add(self, tweets: list):
+        """
+        Adds a batch of newly inserted tweets to every rollup table with one
+        upsert per table. Only pass tweets that were actually inserted,
+        otherwise they will be counted twice.
+
+        :param tweets: list of dicts formatted as rows of the tweets table,
+                       they need at least coin_id, date, created_at and
+                       sentiment
+        """
+        for granularity, rows in self.aggregate(tweets).items():
+            if rows:
+                self._upsert(GRANULARITIES[granularity][0], rows)
+
+
+    @staticmethod
+    def aggregate(tweets: list) -> dict:
+        """
+        Collapses a batch of tweets into rollup rows, returns a dict mapping
+        each granularity to a list of tuples in the column order of
+        (coin_id, period) + ROLLUP_COLUMNS
+        """
+        buckets = {granularity: defaultdict(lambda: [0, 0.0, 0.0, 0, 0])
+                   for granularity in GRANULARITIES}
+        for tweet in tweets:
+            sentiment = tweet["sentiment"]
+            periods = {"daily": tweet["date"]}
+            if tweet.get("created_at"):
+                periods["hourly"] = _hour_of(tweet["created_at"])
+            for granularity, period in periods.items():
+                bucket = buckets[granularity][(tweet["coin_id"], period)]
+                bucket[0] += 1
+                bucket[1] += sentiment
+                bucket[2] += sentiment * sentiment
+                if sentiment > 0:
+                    bucket[3] += 1
+                elif sentiment < 0:
+                    bucket[4] += 1
+
+        return {granularity: [key + tuple(values)
+                              for key, values in bucket.items()]
+                for granularity, bucket in buckets.items()}
+
+
+    def rebuild(self, coin_ids, granularities=tuple(GRANULARITIES),
+                start: str = None, end: str = None, num_threads=8):
+        """
+        Recomputes the rollups from the tweets table, for backfills or after
+        the tweets table was edited by hand. The rows of the range are
+        replaced, so periods whose tweets were all deleted are dropped. Every
+        (coin, granularity) pair is rebuilt by its own worker with its own
+        connection so the group by queries run in parallel on the server.
+
+        :param coin_ids: iterable of the coin ids to rebuild
+        :param granularities: iterable of keys of GRANULARITIES
+        :param start: optional str date (inclusive) to rebuild from
+        :param end: optional str date (exclusive) to rebuild up to
+        :param num_threads: int of how many queries run at the same time
+        """
+        jobs = [(coin_id, granularity) for coin_id in coin_ids
+                for granularity in granularities]
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = [executor.submit(self._rebuild_one, coin_id,
+                                       granularity, start, end)
+                       for coin_id, granularity in jobs]
+            return sum(future.result() for future in futures)
+
+
+    def series(self, coin_id: int, granularity="daily", start: str = None,
+               end: str = None):
+        """
+        Returns a pandas DataFrame indexed by period with the columns
+        num_tweets, average_sentiment, sentiment_std, positive_percentage and
+        negative_percentage for a single coin
+        """
+        import numpy as np
+        import pandas as pd
+
+        table = GRANULARITIES[granularity][0]
+        sql = ("SELECT period, " + ", ".join(ROLLUP_COLUMNS) +
+               " FROM {0} WHERE coin_id = %s".format(table))
+        params = [coin_id]
+        if start is not None:
+            sql += " AND period >= %s"
+            params.append(start)
+        if end is not None:
+            sql += " AND period < %s"
+            params.append(end)
+        sql += " ORDER BY period"
+
+        chunks = list(self._database.query_df_chunks(sql, params=tuple(params),
+                                                      dates=("period",)))
+        if not chunks:
+            return pd.DataFrame(columns=["num_tweets", "average_sentiment",
+                                         "sentiment_std", "positive_percentage",
+                                         "negative_percentage"])
+        df = pd.concat(chunks).set_index("period")
+        count = df["num_tweets"].astype(float)
+        mean = df["sentiment_sum"] / count
+        variance = (df["sentiment_sum_squares"] / count - mean ** 2).clip(lower=0)
+        return pd.DataFrame({
+            "num_tweets": df["num_tweets"],
+            "average_sentiment": mean,
+            "sentiment_std": np.sqrt(variance),
+            "positive_percentage": df["num_positive"] / count,
+            "negative_percentage": df["num_negative"] / count,
+        })
+
+
+    def totals(self, start: str, end: str = None, granularity="daily") -> dict:
+        """
+        Returns the combined rollups of every coin over [start, end) in the
+        format of SentimentAggregator.result(), ex: the sentiment of a run
+        whose tweets were inserted by several processes
+            {coin_name: {"length": ..., "sum": ..., "pos_sentiment": ...,
+                         "neg_sentiment": ...}, ...}
+        """
+        table = GRANULARITIES[granularity][0]
+        sql = ("SELECT c.name, SUM(r.num_tweets), SUM(r.sentiment_sum), "
+               "SUM(r.num_positive), SUM(r.num_negative) FROM {0} r "
+               "JOIN cryptocurrencies c ON c.id = r.coin_id "
+               "WHERE r.period >= %s").format(table)
+        params = [start]
+        if end is not None:
+            sql += " AND r.period < %s"
+            params.append(end)
+        sql += " GROUP BY c.name"
+        totals = dict()
+        for name, length, total, positive, negative in self._database.stream(
+                sql, params=tuple(params)):
+            if length:
+                totals[name] = {"length": int(length), "sum": float(total),
+                                "pos_sentiment": int(positive),
+                                "neg_sentiment": int(negative)}
+        return totals
+
+
+    def _upsert(self, table: str, rows: list):
+        """Adds rollup rows onto the existing rows of table"""
+        columns = ("coin_id", "period") + ROLLUP_COLUMNS
+        updates = ", ".join("{0} = {0} + VALUES({0})".format(column)
+                            for column in ROLLUP_COLUMNS)
+        sql = "INSERT INTO {0} ({1}) VALUES ({2}) ON DUPLICATE KEY UPDATE {3}".format(
+            table, ", ".join(columns), ", ".join(["%s"] * len(columns)), updates)
+        self._database.executemany(sql, rows)
+
+
+    @staticmethod
+    def _rebuild_one(coin_id: int, granularity: str, start: str, end: str) -> int:
+        table, _, period_expression, time_column = GRANULARITIES[granularity]
+        delete = "DELETE FROM {0} WHERE coin_id = %s".format(table)
+        sql = """
+INSERT INTO {0} (coin_id, period, {1})
+SELECT coin_id, {2} AS bucket, COUNT(*), SUM(sentiment),
+    SUM(sentiment * sentiment), SUM(sentiment > 0), SUM(sentiment < 0)
+FROM tweets
+WHERE coin_id = %s AND {3} IS NOT NULL""".format(
+            table, ", ".join(ROLLUP_COLUMNS),
+            period_expression.replace("%", "%%"), time_column)
+        params = [coin_id]
+        # The periods of a range are the buckets of its tweets' time column
+        if start is not None:
+            delete += " AND period >= %s"
+            sql += " AND {0} >= %s".format(time_column)
+            params.append(start)
+        if end is not None:
+            delete += " AND period < %s"
+            sql += " AND {0} < %s".format(time_column)
+            params.append(end)
+        sql += " GROUP BY coin_id, bucket ON DUPLICATE KEY UPDATE " + ", ".join(
+            "{0} = VALUES({0})".format(column) for column in ROLLUP_COLUMNS)
+
+        database = DatabaseWrapper()
+        return database.execute_batch([(delete, tuple(params)), (sql, tuple(params))])
+
+
+def _hour_of(timestamp: str) -> str:
+    """Truncates a 'YYYY-M-D HH:MM:SS' timestamp to the start of its hour"""
+    date, clock = timestamp.split()
+    return "{0} {1}:00:00".format(date, clock.split(":")[0])
+
+
+if __name__ == "__main__":
+    import sys
+    from cryptocurrencies import CRYPTOS
+    from ornus_data_manager import DataManager
+
+    # Backfill every rollup table from the tweets table
+    database = DataManager(CRYPTOS)
+    database.create_tables()
+    coin_ids = [database.get_coin_id(coin.name) for coin in CRYPTOS]
+    start = sys.argv[1] if len(sys.argv) > 1 else None
+    end = sys.argv[2] if len(sys.argv) > 2 else None
+    rollup = SentimentRollup(DatabaseWrapper())
+    num_rows = rollup.rebuild([c for c in coin_ids if c is not None],
+                              start=start, end=end)
+    print("Rebuilt", num_rows, "rollup rows")
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Sharded collection of the daily tweets of CRYPTOS across several processes,
+on one or more machines.
+
+The coins of a run are rows of a shared work table (collection_leases, in
+the MySQL database or in a local SQLite file for a single machine). Every
+worker repeatedly leases a few coins, collects and inserts their tweets with
+its own subset of the api keys and marks them done. A worker keeps renewing
+its lease while it works, if it crashes the lease expires and another worker
+picks the coins up again. The coordinator seeds the table, optionally starts
+local workers, waits for every coin to be done and then runs the market data
+step once, with each coin's sentiment read back from the daily rollups.
+
+Usage:
+    # one machine, 4 worker processes
+    python3 sharded_collection.py coordinate --local-workers 4
+    # several machines: every machine runs workers with distinct indices
+    python3 sharded_collection.py worker --worker-index 0 --num-workers 8
+    python3 sharded_collection.py coordinate --local-workers 0
+"""
+
+import argparse
+import contextlib
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from cryptocurrencies import CRYPTOS
+from data_collection import error
+from data_collection.api_manager import APIManager
+from data_collection.metrics import METRICS
+
+
+NUM_TWEETS = 500
+NUM_THREADS = 8
+INSERT_BATCH_SIZE = 100
+# How many coins a worker leases at once
+COINS_PER_LEASE = 2
+# Seconds a lease lasts without being renewed
+LEASE_SECONDS = 600
+# A coin that failed this many times is given up on for the run
+MAX_ATTEMPTS = 3
+# Seconds between two checks of the work table while waiting
+POLL_INTERVAL = 5
+
+
+class LeaseTable:
+    """
+    Work table of the coins of one run, safe to share between processes.
+
+    Usage:
+        >>> leases = LeaseTable("2019-04-25")
+        >>> leases.seed(coin.name for coin in CRYPTOS)
+        >>> token, coins = leases.lease("host:1234", num_coins=2)
+        >>> with leases.heartbeat(token):
+        ...     collect(coins)
+        >>> leases.complete(token)
+    """
+
+    def __init__(self, run_id: str, sqlite_path: str = None):
+        """
+        :param run_id: str identifying the run, rows of other runs are ignored
+        :param sqlite_path: optional str path of a SQLite file to keep the
+                            table in instead of the MySQL database
+        """
+        self.run_id = run_id
+        if sqlite_path is not None:
+            self._database = _SQLiteDatabase(sqlite_path)
+        else:
+            from database_wrapper import DatabaseWrapper
+            self._database = DatabaseWrapper()
+
+
+    def create_table(self):
+        """Creates the collection_leases table if it doesn't already exist"""
+        if "collection_leases" in self._database.show_tables():
+            return
+        self._database.execute("""
+CREATE TABLE collection_leases (
+    run_id VARCHAR(40) NOT NULL,
+    coin VARCHAR(30) NOT NULL,
+    status VARCHAR(10) NOT NULL,
+    worker VARCHAR(100),
+    token VARCHAR(32),
+    lease_expires DOUBLE,
+    attempts INT NOT NULL,
+    PRIMARY KEY (run_id, coin)
+); """)
+
+
+    def seed(self, coins):
+        """Adds the coins (str names) to the run, coins already in it are kept"""
+        ignore = "OR IGNORE" if self._database.dialect == "sqlite" else "IGNORE"
+        self._database.executemany(
+            "INSERT {0} INTO collection_leases (run_id, coin, status, attempts) "
+            "VALUES (%s, %s, 'pending', 0)".format(ignore),
+            [(self.run_id, coin) for coin in coins])
+
+
+    def lease(self, worker: str, num_coins: int = COINS_PER_LEASE,
+              lease_seconds: float = LEASE_SECONDS,
+              max_attempts: int = MAX_ATTEMPTS):
+        """
+        Leases up to num_coins pending coins (or coins whose lease expired),
+        returns a tuple of (str token, list of coin names), the list is empty
+        if there is nothing to lease right now. Coins whose lease expired
+        after max_attempts attempts (their worker keeps dying) are marked as
+        failed instead.
+        """
+        token = uuid.uuid4().hex
+        now = time.time()
+        give_up = ("UPDATE collection_leases SET status = 'failed', token = NULL "
+                   "WHERE run_id = %s AND status = 'leased' AND lease_expires < %s "
+                   "AND attempts >= %s")
+        if self._database.dialect == "sqlite":
+            # One writer at a time, the select and update are atomic
+            with self._database.transaction():
+                self._database.execute(give_up, (self.run_id, now, max_attempts))
+                coins = [row[0] for row in self._database.stream(
+                    "SELECT coin FROM collection_leases WHERE run_id = %s AND "
+                    "(status = 'pending' OR (status = 'leased' AND lease_expires < %s "
+                    "AND attempts < %s)) ORDER BY coin LIMIT %s",
+                    params=(self.run_id, now, max_attempts, num_coins))]
+                for coin in coins:
+                    self._database.execute(
+                        "UPDATE collection_leases SET status = 'leased', worker = %s, "
+                        "token = %s, lease_expires = %s, attempts = attempts + 1 "
+                        "WHERE run_id = %s AND coin = %s",
+                        (worker, token, now + lease_seconds, self.run_id, coin))
+            return token, coins
+
+        self._database.execute(give_up, (self.run_id, now, max_attempts))
+        # A single UPDATE ... LIMIT locks and claims the rows atomically
+        self._database.execute(
+            "UPDATE collection_leases SET status = 'leased', worker = %s, "
+            "token = %s, lease_expires = %s, attempts = attempts + 1 "
+            "WHERE run_id = %s AND (status = 'pending' OR "
+            "(status = 'leased' AND lease_expires < %s AND attempts < %s)) "
+            "ORDER BY coin LIMIT %s",
+            (worker, token, now + lease_seconds, self.run_id, now, max_attempts,
+             num_coins))
+        coins = [row[0] for row in self._database.stream(
+            "SELECT coin FROM collection_leases WHERE run_id = %s AND token = %s",
+            params=(self.run_id, token))]
+        return token, coins
+
+
+    def renew(self, token: str, lease_seconds: float = LEASE_SECONDS) -> bool:
+        """Extends a lease, returns False if it was lost (it expired and was taken)"""
+        return self._database.execute(
+            "UPDATE collection_leases SET lease_expires = %s WHERE run_id = %s "
+            "AND token = %s AND status = 'leased'",
+            (time.time() + lease_seconds, self.run_id, token)) > 0
+
+
+    def complete(self, token: str):
+        self._database.execute(
+            "UPDATE collection_leases SET status = 'done' WHERE run_id = %s "
+            "AND token = %s", (self.run_id, token))
+
+
+    def release(self, token: str, max_attempts: int = MAX_ATTEMPTS):
+        """
+        Gives the coins of a failed lease back to the run, coins that
+        already failed max_attempts times are marked as failed instead
+        """
+        self._database.execute(
+            "UPDATE collection_leases SET status = CASE WHEN attempts >= %s "
+            "THEN 'failed' ELSE 'pending' END, token = NULL WHERE run_id = %s "
+            "AND token = %s", (max_attempts, self.run_id, token))
+
+
+    def progress(self) -> dict:
+        """Returns a dict of status -> number of coins"""
+        return {status: count for status, count in self._database.stream(
+            "SELECT status, COUNT(*) FROM collection_leases WHERE run_id = %s "
+            "GROUP BY status", params=(self.run_id,))}
+
+
+    def remaining(self) -> int:
+        """Returns how many coins are pending or leased"""
+        progress = self.progress()
+        return progress.get("pending", 0) + progress.get("leased", 0)
+
+
+    def coins(self, status: str) -> list:
+        return [row[0] for row in self._database.stream(
+            "SELECT coin FROM collection_leases WHERE run_id = %s AND status = %s",
+            params=(self.run_id, status))]
+
+
+    @contextlib.contextmanager
+    def heartbeat(self, token: str, lease_seconds: float = LEASE_SECONDS):
+        """Context manager that keeps renewing a lease in a background thread"""
+        stop = threading.Event()
+        # The heartbeat needs its own connection since the worker's
+        # connection is busy with the collection
+        leases = LeaseTable(self.run_id, getattr(self._database, "path", None))
+
+        def renew():
+            while not stop.wait(lease_seconds / 4):
+                if not leases.renew(token, lease_seconds):
+                    error("Lost the lease", token)
+                    return
+
+        thread = threading.Thread(target=renew, name="lease_heartbeat")
+        thread.daemon = True
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+class _SQLiteDatabase:
+    """
+    The subset of DatabaseWrapper used by LeaseTable on top of a SQLite file,
+    statements are written with %s placeholders like for MySQL
+    """
+    dialect = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        # Autocommit, transactions are explicit (see transaction())
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                           check_same_thread=False)
+
+    def show_tables(self) -> list:
+        return [row[0] for row in self._connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+    def execute(self, sql: str, params=None) -> int:
+        return self._connection.execute(sql.replace("%s", "?"), params or ()).rowcount
+
+    def executemany(self, sql: str, rows: list) -> int:
+        with self.transaction():
+            return self._connection.executemany(sql.replace("%s", "?"), rows).rowcount
+
+    def stream(self, sql: str, params=None):
+        yield from self._connection.execute(sql.replace("%s", "?"), params or ())
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+
+def run_worker(run_id: str, worker_index: int, num_workers: int,
+               sqlite_path: str = None, num_tweets: int = NUM_TWEETS,
+               coins_per_lease: int = COINS_PER_LEASE):
+    """
+    Leases coins and collects their tweets until every coin of the run is
+    done (or failed). Worker worker_index of num_workers uses every
+    num_workers-th twitter api key starting at worker_index.
+    """
+    from data_collection import TweetManager
+    from database_wrapper import DatabaseWrapper
+    from ornus_data_manager import DataManager
+    from tweet_sketches import TweetSketches
+
+    name = "{0}:{1}".format(socket.gethostname(), os.getpid())
+    coins = {coin.name: coin for coin in CRYPTOS}
+    leases = LeaseTable(run_id, sqlite_path)
+    api_manager = APIManager(shard=(worker_index, num_workers))
+    database = DataManager(CRYPTOS)
+    # Every worker index writes sketch rows of its own, merged when queried
+    sketches = TweetSketches(DatabaseWrapper(), CRYPTOS,
+                             source="worker-{0}".format(worker_index))
+    database.add_batch_listener(sketches.add)
+
+    while True:
+        token, shard = leases.lease(name, coins_per_lease)
+        if not shard:
+            # An empty table means the coordinator hasn't seeded the run yet
+            if leases.progress() and leases.remaining() == 0:
+                break
+            # The other coins are leased, wait in case a worker dies
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        print(name, "collecting", ", ".join(shard))
+        try:
+            with leases.heartbeat(token):
+                tweet_manager = TweetManager([coins[coin] for coin in shard],
+                                             num_threads=NUM_THREADS,
+                                             api_manager=api_manager)
+                tweets = tweet_manager.get_tweets(num_tweets_per_coin=num_tweets)
+                for batch in tweets.batches(INSERT_BATCH_SIZE):
+                    database.insert_tweets(batch)
+                tweets.close()
+                sketches.flush()
+        except Exception as e:
+            METRICS.counter("shard_failures_total").inc()
+            error("Failed to collect {0}: {1}".format(", ".join(shard), e))
+            leases.release(token)
+            continue
+        leases.complete(token)
+        METRICS.counter("shards_completed_total").inc()
+    # The tweets of failed shards that were inserted anyway
+    sketches.flush()
+
+
+def coordinate(run_id: str, num_local_workers: int, num_workers: int = None,
+               sqlite_path: str = None, num_tweets: int = NUM_TWEETS):
+    """
+    Seeds the run with CRYPTOS, starts num_local_workers worker processes,
+    waits for every coin to be collected and then fills the market data
+    tables once
+
+    :param num_workers: int of the total number of workers of the run across
+                        every machine (for splitting the api keys), defaults
+                        to num_local_workers
+    """
+    from ornus_data_manager import DataManager
+
+    start = time.time()
+    database = DataManager(CRYPTOS)
+    database.create_tables()
+    database.fill_cryptocurrency_table()
+
+    leases = LeaseTable(run_id, sqlite_path)
+    leases.create_table()
+    leases.seed(coin.name for coin in CRYPTOS)
+
+    processes = list()
+    for index in range(num_local_workers):
+        process = multiprocessing.Process(
+            target=run_worker, name="worker-{0}".format(index),
+            args=(run_id, index, num_workers or num_local_workers, sqlite_path,
+                  num_tweets))
+        process.start()
+        processes.append(process)
+
+    while leases.remaining() > 0:
+        print("Progress of run {0}: {1}".format(run_id, leases.progress()))
+        if processes and not any(process.is_alive() for process in processes):
+            error("Every local worker exited before the run was done")
+            break
+        time.sleep(POLL_INTERVAL)
+    for process in processes:
+        process.join()
+
+    failed = leases.coins("failed")
+    if failed:
+        error("Gave up on", ", ".join(failed))
+
+    # The workers' tweets all went through the rollups, so the run's
+    # sentiment is read back from them rather than from the workers: the
+    # sentiment of the tweets dated on the run's day, [run_id, run_id + 1 day)
+    next_day = datetime.strptime(run_id, "%Y-%m-%d") + timedelta(days=1)
+    sentiment = database.sentiment_totals(start=run_id,
+                                          end=next_day.strftime("%Y-%m-%d"))
+    collected = [coin for coin in CRYPTOS if coin.name in sentiment]
+    database.fill_market_data_tables(sentiment, verbose=True, coins=collected)
+    print("Sharded run {0} took {1:.2f}s".format(run_id, time.time() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Collect the daily tweets of CRYPTOS across processes")
+    parser.add_argument("role", choices=("coordinate", "worker"))
+    parser.add_argument("--run-id", default=datetime.utcnow().strftime("%Y-%m-%d"),
+                        help="date (UTC) of the run, the market data uses the "
+                             "sentiment of the tweets dated on it")
+    parser.add_argument("--sqlite", default=None,
+                        help="keep the work table in this SQLite file instead "
+                             "of the MySQL database (single machine only)")
+    parser.add_argument("--local-workers", type=int, default=4,
+                        help="worker processes started by the coordinator")
+    parser.add_argument("--num-workers", type=int, default=None,
+                        help="total number of workers across every machine")
+    parser.add_argument("--worker-index", type=int, default=0)
+    parser.add_argument("--num-tweets", type=int, default=NUM_TWEETS)
+    args = parser.parse_args()
+
+    if args.role == "coordinate":
+        coordinate(args.run_id, args.local_workers, args.num_workers,
+                   sqlite_path=args.sqlite, num_tweets=args.num_tweets)
+    else:
+        run_worker(args.run_id, args.worker_index,
+                   args.num_workers or 1, sqlite_path=args.sqlite,
+                   num_tweets=args.num_tweets)
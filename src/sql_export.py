@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Exports the joins stored in bin/sql_statements to parquet files.
+The result set is streamed from the database in chunks and each chunk is
+written out as its own row group, so memory use is bounded by the chunk size
+rather than by the size of the table.
+
+Usage:
+    python3 sql_export.py tweet_query ../exports/
+    python3 sql_export.py tweet_hashtag_query ../exports/ --chunksize 20000
+"""
+
+import argparse
+import os
+import re
+import time
+
+from database_wrapper import DatabaseWrapper, STREAM_BATCH_SIZE
+
+
+SQL_DIRECTORY = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "bin", "sql_statements")
+
+# Statements that are plain SELECTs and therefore make sense to export
+EXPORTABLE_STATEMENTS = ("tweet_query", "tweet_hashtag_query")
+
+
+def load_sql_statement(name: str) -> str:
+    """
+    Returns the sql found in bin/sql_statements/<name>.sql with the comments
+    and trailing semicolon removed
+
+    :param name: str of the file name, with or without the .sql extension
+    """
+    if not name.endswith(".sql"):
+        name += ".sql"
+    with open(os.path.join(SQL_DIRECTORY, name), "r") as f:
+        sql = f.read()
+    sql = re.sub(r"/\*.*?\*/", "", sql, flags=re.S)
+    return sql.strip().rstrip(";")
+
+
+def export_query_to_parquet(database, sql: str, path: str,
+                            chunksize: int = STREAM_BATCH_SIZE,
+                            verbose=False) -> int:
+    """
+    Streams the result of sql into a single parquet file and returns the
+    number of rows written
+
+    :param database: DatabaseWrapper to run the query with
+    :param sql: str of the query to export
+    :param path: str of the parquet file to create
+    :param chunksize: int of how many rows are held in memory at once, this
+                      is also the size of each row group in the file
+    :param verbose: bool on whether to print the progress after each chunk
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    start = time.time()
+    writer = None
+    schema = None
+    num_rows = 0
+    try:
+        for df in database.query_df_chunks(sql, chunksize=chunksize):
+            if writer is None:
+                schema = _stable_schema(pa.Schema.from_pandas(
+                    df, preserve_index=False))
+                writer = pq.ParquetWriter(path, schema, compression="snappy")
+            table = pa.Table.from_pandas(df, schema=schema,
+                                         preserve_index=False)
+            writer.write_table(table)
+            num_rows += len(df)
+            if verbose:
+                print("Exported {0} rows ({1:0.0f} rows/s)".format(
+                    num_rows, num_rows / max(time.time() - start, 1e-9)))
+    finally:
+        if writer is not None:
+            writer.close()
+    return num_rows
+
+
+def _stable_schema(schema):
+    """
+    The category codes pandas picks depend on how many categories a chunk
+    has, so widen every dictionary column to int32 indices to keep the
+    schema identical between chunks
+    """
+    import pyarrow as pa
+
+    fields = []
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            field = field.with_type(
+                pa.dictionary(pa.int32(), field.type.value_type))
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def export_statement(name: str, output_dir: str,
+                     chunksize: int = STREAM_BATCH_SIZE, verbose=False) -> str:
+    """
+    Exports bin/sql_statements/<name>.sql to <output_dir>/<name>.parquet
+    and returns the path of the file that was written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, name + ".parquet")
+    database = DatabaseWrapper()
+    num_rows = export_query_to_parquet(database, load_sql_statement(name),
+                                       path, chunksize=chunksize,
+                                       verbose=verbose)
+    print("Wrote {0} rows to {1}".format(num_rows, path))
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Export a query from bin/sql_statements to parquet")
+    parser.add_argument("statement", choices=EXPORTABLE_STATEMENTS)
+    parser.add_argument("output_dir")
+    parser.add_argument("--chunksize", type=int, default=STREAM_BATCH_SIZE)
+    args = parser.parse_args()
+    export_statement(args.statement, args.output_dir,
+                     chunksize=args.chunksize, verbose=True)
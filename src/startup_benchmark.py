@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Measures the cold start import time of every entry point with
+`python -X importtime` and keeps a history of the results so startup
+regressions show up.
+
+Every entry point is imported in a fresh interpreter (so nothing is cached
+in sys.modules), the slowest imports it pulled in are printed and the
+totals are appended to reports/startup.json.
+
+Usage:
+    python3 startup_benchmark.py
+    python3 startup_benchmark.py database_wrapper sql_export --repeat 5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HISTORY_FILE = os.path.join(os.path.dirname(SOURCE_DIRECTORY), "reports",
+                            "startup.json")
+
+# Modules that are run as scripts or imported on their own by tools
+ENTRY_POINTS = (
+    "daily_data",
+    "database_wrapper",
+    "ornus_data_manager",
+    "sql_export",
+    "backfill",
+    "feature_engine",
+    "sentiment_rollup",
+    "kline_store",
+    "sharded_collection",
+    "collector_daemon",
+    "tweet_archive",
+    "tweet_index",
+    "influencer_leaderboard",
+    "tweet_sketches",
+    "hashtag_graph",
+    "tfidf_features",
+    "data_collection",
+)
+NUM_SLOWEST_IMPORTS = 8
+
+
+def measure(module: str) -> dict:
+    """
+    Imports module in a fresh interpreter and returns a dict with its total
+    import time and the imports that took the longest (cumulative, in ms)
+    """
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=SOURCE_DIRECTORY, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, universal_newlines=True)
+    wall_time = time.perf_counter() - start
+
+    imports = list()
+    errors = list()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            errors.append(line)
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(fields[1]) / 1000.0, depth))
+
+    result = {
+        "module": module,
+        "ok": process.returncode == 0,
+        "wall_ms": wall_time * 1000,
+        "import_ms": next((ms for name, ms, _ in imports if name == module),
+                          sum(ms for _, ms, depth in imports if depth <= 1)),
+        "slowest": sorted(((name, ms) for name, ms, _ in imports
+                           if name != module),
+                          key=lambda item: -item[1])[:NUM_SLOWEST_IMPORTS],
+    }
+    if process.returncode != 0:
+        result["error"] = errors[-1] if errors else "exit code {0}".format(
+            process.returncode)
+    return result
+
+
+def benchmark(modules=ENTRY_POINTS, repeat: int = 3) -> list:
+    """Measures every module repeat times and keeps the fastest run of each"""
+    results = list()
+    for module in modules:
+        runs = [measure(module) for _ in range(repeat)]
+        results.append(min(runs, key=lambda run: run["wall_ms"]))
+    return results
+
+
+def record(results: list, path: str = HISTORY_FILE):
+    """Appends the totals of a benchmark to the history file"""
+    history = list()
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            history = json.load(f)
+    history.append({
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "results": {result["module"]: {"wall_ms": round(result["wall_ms"], 1),
+                                       "import_ms": round(result["import_ms"], 1),
+                                       "ok": result["ok"]}
+                    for result in results},
+    })
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(history, f, indent=4)
+
+
+def _previous(path: str = HISTORY_FILE) -> dict:
+    if not os.path.exists(path):
+        return dict()
+    with open(path, "r") as f:
+        history = json.load(f)
+    return history[-1]["results"] if history else dict()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Benchmark the cold start time of the entry points")
+    parser.add_argument("modules", nargs="*", default=list(ENTRY_POINTS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-record", action="store_true",
+                        help="don't append the results to the history file")
+    args = parser.parse_args()
+
+    previous = _previous()
+    results = benchmark(args.modules, repeat=args.repeat)
+    for result in results:
+        change = ""
+        if result["module"] in previous and result["ok"]:
+            change = " ({0:+.1f}ms since last run)".format(
+                result["wall_ms"] - previous[result["module"]]["wall_ms"])
+        print("{0}: {1:.1f}ms wall, {2:.1f}ms importing{3}".format(
+            result["module"], result["wall_ms"], result["import_ms"], change))
+        if not result["ok"]:
+            print("    failed: " + result["error"])
+        for name, ms in result["slowest"]:
+            print("    {0:>8.1f}ms  {1}".format(ms, name))
+    if not args.no_record:
+        record(results)
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+TF-IDF features of the tweets in bounded memory.
+
+The content is tokenized with clean_text_for_tfidf() and every token is
+hashed into one of NUM_FEATURES columns, so there's no vocabulary to hold in
+memory and a tweet's features never depend on the tweets before it. Tokens
+that share a column are counted together, with 2^20 columns that's rare
+enough not to matter for the tokens that carry any weight.
+
+The document frequencies (how many tweets of a coin's day have each column)
+are kept up to date as batches of tweets are inserted (see
+DataManager.add_batch_listener()) and flush() writes them to one file per
+date:
+    <directory>/frequencies/<date>.npz: a sparse row per coin and the number
+                                        of tweets of each coin that day
+Only the dates being updated or read are in memory.
+
+Since the frequencies are already known, the TF-IDF matrices of every coin
+and day are produced in a single pass over the tweets (chunks()), one CSR
+matrix per chunk of tweets of a coin's day, each row L2 normalized and
+weighted by the smoothed idf of its coin and day:
+    idf = log((1 + tweets) / (1 + tweets with the column)) + 1
+
+Usage:
+    >>> features = TfidfFeatures()
+    >>> features.add(tweets)  # new tweets, as generated by json_parser.py
+    >>> features.flush()
+    >>> for coin, date, tweet_ids, matrix in features.chunks(
+    ...         DatabaseWrapper(), start="2019-02-11", end="2019-02-11"):
+    ...     print(coin, date, matrix.shape)
+"""
+
+import argparse
+import datetime as dt
+import os
+import threading
+import time
+import zlib
+
+from data_collection import clean_text_for_tfidf
+from data_collection.metrics import METRICS
+from tweet_archive import first_snowflake
+
+
+TFIDF_DIRECTORY = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tfidf")
+FREQUENCIES_DIRECTORY = "frequencies"
+
+NUM_FEATURES = 2 ** 20
+# Tweets read (and vectorized) at once
+CHUNK_SIZE = 10000
+# Dates whose frequencies stay in memory after a flush, the newest ones
+LOADED_DATES = 8
+
+CONTENT_QUERY = """
+SELECT tweets.id, cryptocurrencies.name, tweets.date, tweets.content
+FROM tweets
+    JOIN cryptocurrencies ON cryptocurrencies.id = tweets.coin_id
+WHERE tweets.id > %s AND tweets.date IS NOT NULL{conditions}
+ORDER BY tweets.id
+LIMIT %s
+"""
+
+
+def hash_tokens(content: str, num_features: int = NUM_FEATURES) -> dict:
+    """Returns a dict of the columns of the tokens of content to their counts"""
+    counts = dict()
+    for token in clean_text_for_tfidf(content).split():
+        column = zlib.crc32(token.encode("utf8")) % num_features
+        counts[column] = counts.get(column, 0) + 1
+    return counts
+
+
+def vectorize(contents, num_features: int = NUM_FEATURES):
+    """Returns the sparse (tweets x num_features) matrix of the token counts"""
+    import numpy as np
+    import scipy.sparse as sp
+
+    indptr = [0]
+    indices = list()
+    data = list()
+    for content in contents:
+        counts = hash_tokens(content or "", num_features)
+        indices.extend(counts)
+        data.extend(counts.values())
+        indptr.append(len(indices))
+    matrix = sp.csr_matrix((np.array(data, dtype=np.float32),
+                            np.array(indices, dtype=np.int32),
+                            np.array(indptr, dtype=np.int64)),
+                           shape=(len(indptr) - 1, num_features))
+    matrix.sort_indices()
+    return matrix
+
+
+def tfidf(counts, frequencies, num_documents: int):
+    """
+    Returns the L2 normalized TF-IDF matrix of a matrix of token counts
+
+    :param counts: sparse (tweets x features) matrix (see vectorize())
+    :param frequencies: sparse (1 x features) row of document frequencies
+    :param num_documents: int of the tweets the frequencies were counted on
+    """
+    import numpy as np
+    import scipy.sparse as sp
+
+    document_frequencies = np.asarray(frequencies.todense()).ravel() \
+        if sp.issparse(frequencies) else np.asarray(frequencies)
+    matrix = sp.csr_matrix(counts, dtype=np.float32, copy=True)
+    idf = np.log((1 + num_documents) / (1 + document_frequencies[matrix.indices])) + 1
+    matrix.data *= idf.astype(np.float32)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix.data /= np.repeat(norms, np.diff(matrix.indptr)).astype(np.float32)
+    return matrix
+
+
+class TfidfFeatures:
+    """
+    Thread safe document frequencies of every coin and day, and the TF-IDF
+    matrices built from them.
+
+    Usage:
+        >>> features = TfidfFeatures()
+        >>> database.add_batch_listener(features.add)
+        >>> frequencies, num_documents = features.document_frequencies(
+        ...     "bitcoin", start="2019-02-01", end="2019-02-07")
+    """
+
+    def __init__(self, directory: str = TFIDF_DIRECTORY,
+                 num_features: int = NUM_FEATURES):
+        """
+        :param directory: str of the directory the frequencies are stored in
+        :param num_features: int of hashed columns, the stored frequencies
+                             must have been counted with the same
+        """
+        self.directory = directory
+        self.num_features = num_features
+        # date -> {coin: [sparse row of frequencies, number of tweets]}
+        self._dates = dict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+
+    def add(self, tweets: list):
+        """
+        Adds a batch of new tweets to the document frequencies of their coin
+        and day
+
+        :param tweets: list of tweet dicts (as generated by json_parser.py),
+                       each tweet must only be added once
+        """
+        groups = dict()
+        for tweet in tweets:
+            if tweet["date"] is None:
+                continue
+            groups.setdefault((str(tweet["date"]), tweet["coin"]), []).append(
+                tweet["text"])
+        counts = {key: vectorize(contents, self.num_features)
+                  for key, contents in groups.items()}
+        with self._lock:
+            for (date, coin), matrix in counts.items():
+                self._add(date, coin, matrix)
+        METRICS.counter("tfidf_documents_total").inc(
+            sum(matrix.shape[0] for matrix in counts.values()))
+
+
+    def flush(self) -> int:
+        """Writes the frequencies of the dates changed since the last flush"""
+        with self._lock:
+            dates = sorted(self._dirty)
+            for date in dates:
+                self._write(date, self._dates[date])
+            self._dirty = set()
+            # The dates of earlier days are rarely added to again
+            for date in sorted(self._dates)[:-LOADED_DATES]:
+                del self._dates[date]
+        return len(dates)
+
+
+    def rebuild(self, database, start: str = None, end: str = None,
+                chunk_size: int = CHUNK_SIZE, verbose=False) -> int:
+        """
+        Recounts the document frequencies of the dates between start and end
+        (inclusive) from the tweets table, for tweets inserted before the
+        frequencies were kept, returns the number of tweets counted
+        """
+        with self._lock:
+            for date in self.dates():
+                if (start is None or date >= start) and (end is None or date <= end):
+                    os.remove(self._path(date))
+            self._dates = dict()
+            self._dirty = set()
+
+        started = time.time()
+        num_tweets = 0
+        for rows in _pages(database, start, end, None, chunk_size):
+            groups = dict()
+            for _, coin, date, content in rows:
+                groups.setdefault((str(date), coin), []).append(content)
+            with self._lock:
+                for (date, coin), contents in groups.items():
+                    self._add(date, coin, vectorize(contents, self.num_features))
+            num_tweets += len(rows)
+            if verbose:
+                print("Counted {0} tweets ({1:0.0f} tweets/s)".format(
+                    num_tweets, num_tweets / max(time.time() - started, 1e-9)))
+            # Pages are in id order, so roughly in date order, a date is
+            # written once the pages moved past it
+            self.flush()
+        self.flush()
+        return num_tweets
+
+
+    def dates(self) -> list:
+        """Returns the sorted dates that have stored frequencies"""
+        path = os.path.join(self.directory, FREQUENCIES_DIRECTORY)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name[:-len(".npz")] for name in os.listdir(path)
+                      if name.endswith(".npz"))
+
+
+    def document_frequencies(self, coin: str = None, start: str = None,
+                             end: str = None):
+        """
+        Returns a tuple of the sparse (1 x features) row of document
+        frequencies and the number of tweets of coin between the dates start
+        and end (inclusive), a date at a time
+
+        :param coin: optional str name of the coin, defaults to every coin
+        :param end: optional str date, defaults to start
+        """
+        import scipy.sparse as sp
+
+        end = end or start
+        frequencies = sp.csr_matrix((1, self.num_features), dtype="int64")
+        num_documents = 0
+        for date in self.dates():
+            if (start is not None and date < start) or (end is not None and date > end):
+                continue
+            with self._lock:
+                coins = self._load(date, keep=False)
+            for name, (row, count) in coins.items():
+                if coin is None or name == coin:
+                    frequencies = frequencies + row
+                    num_documents += count
+        return frequencies, num_documents
+
+
+    def chunks(self, database, start: str, end: str = None, coins=None,
+               chunk_size: int = CHUNK_SIZE):
+        """
+        Generator of (coin, date, list of tweet ids, TF-IDF matrix) over the
+        tweets of coins between the dates start and end (inclusive), in one
+        pass, weighted by the stored frequencies of each coin and day
+
+        :param coins: optional list of coin names, defaults to every coin
+        :param chunk_size: int of tweets read at once, a matrix is at most
+                           that many rows
+        """
+        # The frequencies of the dates being read, loaded once instead of for
+        # every coin of every page
+        loaded = dict()
+        for rows in _pages(database, start, end or start, coins, chunk_size):
+            groups = dict()
+            for tweet_id, coin, date, content in rows:
+                group = groups.setdefault((coin, str(date)), ([], []))
+                group[0].append(tweet_id)
+                group[1].append(content)
+            for (coin, date), (tweet_ids, contents) in sorted(groups.items()):
+                if date not in loaded:
+                    with self._lock:
+                        loaded[date] = self._load(date, keep=False)
+                    # The pages are in id order, so the dates only move forward
+                    for old in sorted(loaded)[:-LOADED_DATES]:
+                        del loaded[old]
+                row, num_documents = loaded[date].get(coin, (None, 0))
+                if row is None:
+                    row = self._empty()
+                with METRICS.timer("tfidf_chunk_seconds"):
+                    matrix = tfidf(vectorize(contents, self.num_features), row,
+                                   num_documents)
+                yield coin, date, tweet_ids, matrix
+
+
+    def write(self, database, start: str, end: str = None, coins=None,
+              chunk_size: int = CHUNK_SIZE) -> int:
+        """
+        Writes the TF-IDF matrices of chunks() along with their tweet ids to
+        <directory>/matrices/<date>/<coin>-<first tweet id>.npz, returns the
+        number of tweets written
+        """
+        import numpy as np
+
+        num_tweets = 0
+        for coin, date, tweet_ids, matrix in self.chunks(database, start, end,
+                                                         coins, chunk_size):
+            directory = os.path.join(self.directory, "matrices", date)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, "{0}-{1}.npz".format(coin, tweet_ids[0]))
+            np.savez_compressed(path, data=matrix.data, indices=matrix.indices,
+                                indptr=matrix.indptr, shape=matrix.shape,
+                                tweet_ids=np.array(tweet_ids, dtype=np.uint64))
+            num_tweets += len(tweet_ids)
+        return num_tweets
+
+
+    def _add(self, date: str, coin: str, counts):
+        """Adds a matrix of token counts to a coin's day, under the lock"""
+        import numpy as np
+        import scipy.sparse as sp
+
+        # Every column appears once per row, so its count is its frequency
+        columns, frequencies = np.unique(counts.indices, return_counts=True)
+        row = sp.csr_matrix((frequencies.astype(np.int64),
+                             (np.zeros(len(columns), dtype=np.int64), columns)),
+                            shape=(1, self.num_features))
+        coins = self._load(date)
+        current = coins.get(coin)
+        if current is None:
+            coins[coin] = [row, counts.shape[0]]
+        else:
+            current[0] = current[0] + row
+            current[1] += counts.shape[0]
+        self._dirty.add(date)
+
+
+    def _load(self, date: str, keep: bool = True) -> dict:
+        """
+        Returns the frequencies of a date, reading them first, under the lock
+
+        :param keep: bool on whether to keep a date that was read in memory
+        """
+        import numpy as np
+        import scipy.sparse as sp
+
+        coins = self._dates.get(date)
+        if coins is not None:
+            return coins
+        coins = dict()
+        path = self._path(date)
+        if os.path.exists(path):
+            with np.load(path) as stored:
+                if int(stored["num_features"]) != self.num_features:
+                    raise ValueError("{0} has {1} features instead of {2}".format(
+                        path, int(stored["num_features"]), self.num_features))
+                matrix = sp.csr_matrix(
+                    (stored["data"], stored["indices"], stored["indptr"]),
+                    shape=(len(stored["coins"]), self.num_features))
+                for i, (coin, count) in enumerate(zip(stored["coins"],
+                                                      stored["num_documents"])):
+                    coins[str(coin)] = [matrix[i], int(count)]
+        if keep:
+            self._dates[date] = coins
+        return coins
+
+
+    def _write(self, date: str, coins: dict):
+        import numpy as np
+        import scipy.sparse as sp
+
+        names = sorted(coins)
+        matrix = sp.vstack([coins[coin][0] for coin in names], format="csr")
+        path = self._path(date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # np.savez adds .npz to names without it
+        temporary_path = path[:-len(".npz")] + ".tmp.npz"
+        np.savez_compressed(temporary_path, data=matrix.data, indices=matrix.indices,
+                            indptr=matrix.indptr, coins=np.array(names),
+                            num_documents=np.array([coins[coin][1] for coin in names]),
+                            num_features=self.num_features)
+        os.replace(temporary_path, path)
+
+
+    def _path(self, date: str) -> str:
+        return os.path.join(self.directory, FREQUENCIES_DIRECTORY, date + ".npz")
+
+
+    def _empty(self):
+        import scipy.sparse as sp
+
+        return sp.csr_matrix((1, self.num_features), dtype="int64")
+
+
+def _pages(database, start: str, end: str, coins, page_size: int):
+    """Generator of pages of (id, coin, date, content) rows in id order"""
+    conditions = ""
+    params = tuple()
+    if coins is not None:
+        coins = list(coins)
+        conditions += " AND cryptocurrencies.name IN ({0})".format(
+            ", ".join(["%s"] * len(coins)))
+        params += tuple(coins)
+    if start is not None:
+        conditions += " AND tweets.date >= %s"
+        params += (start,)
+    if end is not None:
+        # Tweets are at most a few hours from their date
+        conditions += " AND tweets.date <= %s AND tweets.id < %s"
+        params += (end, first_snowflake(dt.date.fromisoformat(end) + dt.timedelta(days=2)))
+    query = CONTENT_QUERY.format(conditions=conditions)
+
+    last_id = 0
+    if start is not None:
+        # A day early as the dates of the tweets aren't necessarily UTC
+        last_id = first_snowflake(dt.date.fromisoformat(start) - dt.timedelta(days=1)) - 1
+    while True:
+        page = list(database.stream(query, params=(last_id,) + params + (page_size,)))
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last_id = page[-1][0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Count the tweets' document frequencies or write their "
+                        "TF-IDF matrices")
+    parser.add_argument("command", choices=("rebuild", "write"))
+    parser.add_argument("--start", default=None)
+    parser.add_argument("--end", default=None)
+    parser.add_argument("--coins", nargs="+", default=None)
+    parser.add_argument("--directory", default=TFIDF_DIRECTORY)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    from database_wrapper import DatabaseWrapper
+
+    start = time.time()
+    features = TfidfFeatures(args.directory)
+    if args.command == "rebuild":
+        num_tweets = features.rebuild(DatabaseWrapper(), args.start, args.end,
+                                      chunk_size=args.chunk_size, verbose=True)
+    else:
+        num_tweets = features.write(DatabaseWrapper(), args.start, args.end,
+                                    coins=args.coins, chunk_size=args.chunk_size)
+    print("{0} {1} tweets in {2:0.2f}s".format(
+        "Counted" if args.command == "rebuild" else "Wrote", num_tweets,
+        time.time() - start))
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Columnar archive of the tweets for offline analysis without going through
+the production database.
+
+The tweets are exported with their hashtags, the attributes of their user
+and their sentiment to a Parquet dataset partitioned by date and coin:
+    <directory>/date=2019-02-11/coin=bitcoin/part-<first id>-<n>.parquet
+    <directory>/archive.json: the last exported date and row counts
+The coin is only stored in the partition path and the hashtags are
+dictionary encoded, so both cost next to nothing per row.
+
+Every update() re-exports the last LOOKBACK_DAYS dates, since a twitter
+search returns tweets up to a week old and those are inserted after newer
+ones, and appends the dates after them. The tweets are read in pages of
+consecutive ids: tweet ids are snowflakes that start with their timestamp,
+so the first id of a date is known and the pages are range scans of the
+primary key.
+
+The reader prunes the partitions that can't match before opening any file
+and only decodes the requested columns.
+
+Usage:
+    >>> archive = TweetArchive()
+    >>> archive.update(DatabaseWrapper())
+    >>> archive.read(columns=["created_at", "sentiment", "hashtags"],
+    ...              coins=["bitcoin"], start="2019-01-01", end="2019-03-31")
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+import shutil
+import time
+
+from data_collection.metrics import METRICS
+
+
+ARCHIVE_DIRECTORY = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "archive",
+        "tweets")
+METADATA_FILE = "archive.json"
+
+# Dates re-exported by every update, a twitter search goes back 7 days
+LOOKBACK_DAYS = 8
+PAGE_SIZE = 50000
+# Rows per row group, the unit the reader skips by its statistics
+ROW_GROUP_SIZE = 64 * 1024
+
+# Milliseconds since the epoch of twitter's snowflake ids, whose bits above
+# the 22nd are the milliseconds since then
+TWITTER_EPOCH = 1288834974657
+
+TWEET_QUERY = """
+SELECT
+    tweets.id,
+    tweets.date,
+    tweets.created_at,
+    tweets.content,
+    tweets.sentiment,
+    tweets.retweets,
+    cryptocurrencies.name AS coin,
+    tweets.user_id,
+    twitter_users.followers AS user_followers,
+    twitter_users.friends AS user_friends,
+    twitter_users.date_created AS user_date_created
+FROM tweets
+    JOIN cryptocurrencies ON cryptocurrencies.id = tweets.coin_id
+    JOIN twitter_users ON twitter_users.id = tweets.user_id
+WHERE tweets.id > %s AND tweets.date IS NOT NULL
+ORDER BY tweets.id
+LIMIT %s
+"""
+TWEET_COLUMNS = ("id", "date", "created_at", "content", "sentiment", "retweets",
+                 "coin", "user_id", "user_followers", "user_friends",
+                 "user_date_created")
+
+HASHTAG_QUERY = """
+SELECT tweet_hashtag.tweet_id, hashtags.name
+FROM tweet_hashtag
+    JOIN hashtags ON hashtags.id = tweet_hashtag.hashtag_id
+WHERE tweet_hashtag.tweet_id BETWEEN %s AND %s
+"""
+
+
+def archive_schema():
+    """Returns the pyarrow schema of the archive, partition columns last"""
+    import pyarrow as pa
+
+    return pa.schema([
+        ("id", pa.uint64()),
+        ("created_at", pa.timestamp("s")),
+        ("content", pa.string()),
+        ("sentiment", pa.float32()),
+        ("retweets", pa.uint32()),
+        ("user_id", pa.uint64()),
+        ("user_followers", pa.uint32()),
+        ("user_friends", pa.uint32()),
+        ("user_date_created", pa.date32()),
+        ("hashtags", pa.list_(pa.string())),
+        ("date", pa.string()),
+        ("coin", pa.string()),
+    ])
+
+
+def _partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([("date", pa.string()), ("coin", pa.string())]),
+                           flavor="hive")
+
+
+class TweetArchive:
+    """
+    Class for exporting the tweets to the partitioned Parquet dataset and
+    reading them back.
+
+    Usage:
+        >>> archive = TweetArchive()
+        >>> archive.update(DatabaseWrapper(), verbose=True)
+        >>> for df in archive.batches(columns=["sentiment"], start="2019-02-01"):
+        ...     print(df["sentiment"].mean())
+    """
+
+    def __init__(self, directory: str = ARCHIVE_DIRECTORY):
+        self.directory = directory
+        self._metadata_path = os.path.join(directory, METADATA_FILE)
+
+
+    def metadata(self):
+        """Returns the stored metadata dict, or None if nothing is exported"""
+        if not os.path.exists(self._metadata_path):
+            return None
+        with open(self._metadata_path, "r") as f:
+            return json.load(f)
+
+
+    def update(self, database, page_size: int = PAGE_SIZE, verbose=False) -> int:
+        """
+        Exports the tweets of the last LOOKBACK_DAYS exported dates and of
+        every date after them, returns the number of tweets written. An
+        update that dies half way is redone by the next one.
+
+        :param database: DatabaseWrapper to read the tweets with
+        :param page_size: int of the tweets read (and held in memory) at once
+        :param verbose: bool on whether to print the progress after each page
+        """
+        metadata = self.metadata() or {"last_date": None, "num_rows": {}}
+        start_date = None
+        if metadata["last_date"] is not None:
+            start_date = (dt.date.fromisoformat(metadata["last_date"]) -
+                          dt.timedelta(days=LOOKBACK_DAYS))
+        # The re-exported dates are replaced as a whole
+        for date in self.dates():
+            if start_date is None or date >= start_date.isoformat():
+                shutil.rmtree(os.path.join(self.directory, "date=" + date))
+                metadata["num_rows"].pop(date, None)
+
+        start = time.time()
+        num_rows = 0
+        last_id = 0
+        if start_date is not None:
+            # A day early as the dates of the tweets aren't necessarily UTC,
+            # the tweets before start_date are in the kept partitions already
+            last_id = first_snowflake(start_date - dt.timedelta(days=1)) - 1
+        while True:
+            with METRICS.timer("archive_page_seconds"):
+                page = list(database.stream(TWEET_QUERY, params=(last_id, page_size)))
+                if not page:
+                    break
+                last_id = page[-1][0]
+                rows = [row for row in page
+                        if start_date is None or row[1] >= start_date]
+                if rows:
+                    table = self._table(database, rows)
+                    self._write(table, first_id=rows[0][0])
+                    for date, count in _counts(table.column("date").to_pylist()).items():
+                        metadata["num_rows"][date] = metadata["num_rows"].get(date, 0) + count
+            num_rows += len(rows)
+            METRICS.counter("archive_rows_written_total").inc(len(rows))
+            if verbose:
+                print("Archived {0} tweets ({1:0.0f} tweets/s)".format(
+                    num_rows, num_rows / max(time.time() - start, 1e-9)))
+            if len(page) < page_size:
+                break
+
+        metadata["last_date"] = max(metadata["num_rows"], default=None)
+        self._write_metadata(metadata)
+        return num_rows
+
+
+    def dates(self) -> list:
+        """Returns the sorted dates that have a partition"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[len("date="):] for name in os.listdir(self.directory)
+                      if name.startswith("date="))
+
+
+    def files(self, coins=None, start: str = None, end: str = None) -> list:
+        """
+        Returns the parquet files of the partitions of coins between the
+        dates start and end (inclusive), without opening any of them
+
+        :param coins: optional iterable of coin names, defaults to every coin
+        :param start: optional str date, ex: 2019-02-11
+        :param end: optional str date
+        """
+        coins = None if coins is None else set(coins)
+        files = list()
+        for date in self.dates():
+            if (start is not None and date < start) or (end is not None and date > end):
+                continue
+            date_directory = os.path.join(self.directory, "date=" + date)
+            for name in sorted(os.listdir(date_directory)):
+                if not name.startswith("coin=") or \
+                        (coins is not None and name[len("coin="):] not in coins):
+                    continue
+                coin_directory = os.path.join(date_directory, name)
+                files.extend(os.path.join(coin_directory, part)
+                             for part in sorted(os.listdir(coin_directory))
+                             if part.endswith(".parquet"))
+        return files
+
+
+    def dataset(self, coins=None, start: str = None, end: str = None):
+        """
+        Returns a pyarrow Dataset of the pruned partitions (see files()), None
+        if no partition matches
+        """
+        import pyarrow.dataset as ds
+
+        files = self.files(coins, start, end)
+        if not files:
+            return None
+        return ds.dataset(files, schema=archive_schema(), format="parquet",
+                          partitioning=_partitioning(),
+                          partition_base_dir=self.directory)
+
+
+    def read(self, columns=None, coins=None, start: str = None, end: str = None,
+             filter=None):
+        """
+        Returns a DataFrame of the tweets of coins between start and end, the
+        date and coin columns are categoricals
+
+        :param columns: optional list of the columns to read, defaults to all
+        :param filter: optional pyarrow.dataset expression the rows must match,
+                       ex: ds.field("user_followers") > 10000
+        """
+        dataset = self.dataset(coins, start, end)
+        if dataset is None:
+            table = archive_schema().empty_table()
+            if columns is not None:
+                table = table.select(columns)
+        else:
+            table = dataset.to_table(columns=columns, filter=filter)
+        return _categorical(table).to_pandas()
+
+
+    def batches(self, columns=None, coins=None, start: str = None,
+                end: str = None, filter=None):
+        """
+        Generator of DataFrames of the tweets (see read()) a record batch at a
+        time, for scans that don't fit in memory
+        """
+        import pyarrow as pa
+
+        dataset = self.dataset(coins, start, end)
+        if dataset is None:
+            return
+        for batch in dataset.to_batches(columns=columns, filter=filter):
+            if batch.num_rows:
+                yield _categorical(pa.Table.from_batches([batch])).to_pandas()
+
+
+    def _table(self, database, rows: list):
+        """Returns the pyarrow Table of a page of rows with their hashtags"""
+        import pyarrow as pa
+
+        hashtags = dict()
+        for tweet_id, name in database.stream(HASHTAG_QUERY,
+                                              params=(rows[0][0], rows[-1][0])):
+            hashtags.setdefault(tweet_id, []).append(name)
+
+        data = dict(zip(TWEET_COLUMNS, map(list, zip(*rows))))
+        data["date"] = [str(date) for date in data["date"]]
+        data["hashtags"] = [hashtags.get(tweet_id, []) for tweet_id in data["id"]]
+        return pa.Table.from_pydict(data, schema=archive_schema())
+
+
+    def _write(self, table, first_id: int):
+        import pyarrow.dataset as ds
+
+        # Named after the page, so redoing an update overwrites its files
+        ds.write_dataset(
+                table, self.directory, format="parquet",
+                partitioning=_partitioning(),
+                basename_template="part-{0}-{{i}}.parquet".format(first_id),
+                existing_data_behavior="overwrite_or_ignore",
+                max_rows_per_group=ROW_GROUP_SIZE,
+                file_options=ds.ParquetFileFormat().make_write_options(
+                    compression="zstd", use_dictionary=True))
+
+
+    def _write_metadata(self, metadata: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = self._metadata_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(metadata, f, indent=4)
+        os.replace(temporary_path, self._metadata_path)
+
+
+def first_snowflake(date) -> int:
+    """Returns the smallest tweet id that can have been created on date (UTC)"""
+    midnight = dt.datetime(date.year, date.month, date.day, tzinfo=dt.timezone.utc)
+    return max(int(midnight.timestamp() * 1000) - TWITTER_EPOCH, 0) << 22
+
+
+def _categorical(table):
+    """Dictionary encodes the partition columns, they become pandas categoricals"""
+    for name in ("date", "coin"):
+        if name in table.column_names:
+            index = table.column_names.index(name)
+            table = table.set_column(index, name, table.column(name).dictionary_encode())
+    return table
+
+
+def _counts(values) -> dict:
+    counts = dict()
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Export the tweets to the partitioned parquet archive")
+    parser.add_argument("--directory", default=ARCHIVE_DIRECTORY)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    args = parser.parse_args()
+
+    from database_wrapper import DatabaseWrapper
+
+    start = time.time()
+    archive = TweetArchive(args.directory)
+    num_rows = archive.update(DatabaseWrapper(), page_size=args.page_size,
+                              verbose=True)
+    print("Archived {0} tweets in {1:0.2f}s, {2} dates in {3}".format(
+        num_rows, time.time() - start, len(archive.dates()), archive.directory))
@@ -0,0 +1,794 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Local inverted index of the content of the tweets, so finding the tweets
+that mention a term doesn't need a LIKE '%...%' scan of the tweets table.
+
+The content is tokenized with clean_text_for_tfidf() and every term maps to
+a posting list of the tweets containing it, in tweet id order (ids are
+snowflakes, so that is the order of their dates), along with the positions
+of the term for phrase queries. The index is updated as batches of tweets
+are inserted (see DataManager.add_batch_listener()): new tweets are
+buffered in memory and written out as an immutable segment every
+FLUSH_DOCS tweets, and segments are merged once there are more than
+MAX_SEGMENTS of them. Buffered tweets are lost if the process dies before
+the next flush, rebuild() (--rebuild) indexes the whole tweets table again.
+
+A segment is a single file:
+    postings: per term, a skip table of the previous doc number and byte
+              offset of every SKIP_INTERVAL-th posting, then the varint
+              encoded doc number deltas, each followed by the byte length
+              and varint encoded deltas of its positions
+    terms: the sorted terms with the offset, length and document frequency
+           of their posting list, a footer keeps every SPARSE_INTERVAL-th
+           term so a lookup only decodes a few terms
+    docs: a fixed size (tweet id, day, coin) record per doc number
+    footer: JSON metadata, followed by its length and MAGIC
+Segments whose coins or dates can't match a query are skipped entirely.
+Posting lists are decoded a block of SKIP_INTERVAL postings at a time: the
+rarest term's list is walked newest first and the others are only decoded
+around its docs, so a search with a limit stops once it has the newest
+tweets instead of decoding whole posting lists.
+
+Usage:
+    >>> index = TweetIndex()
+    >>> index.add(tweets)  # dicts with "id", "date", "coin" and "text"
+    >>> index.flush()
+    >>> index.search("hack")
+    >>> index.search("etf approval", coins=["bitcoin"], start="2019-01-01")
+    >>> index.search("rug pull", phrase=True, limit=100)
+"""
+
+import argparse
+import bisect
+import datetime as dt
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+
+from data_collection import clean_text_for_tfidf
+from data_collection.metrics import METRICS
+
+
+INDEX_DIRECTORY = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "index",
+        "tweets")
+# Tweets buffered in memory before they are written out as a segment
+FLUSH_DOCS = 50000
+# Segments kept before the MERGE_FACTOR smallest are merged into one
+MAX_SEGMENTS = 16
+MERGE_FACTOR = 8
+SPARSE_INTERVAL = 64
+SKIP_INTERVAL = 128
+
+MAGIC = b"TIX1"
+# tweet id, days since the epoch, index of the coin in the footer's coins
+DOC_RECORD = struct.Struct("<QIH")
+FOOTER_LENGTH = struct.Struct("<Q")
+
+CONTENT_QUERY = """
+SELECT tweets.id, tweets.date, cryptocurrencies.name, tweets.content
+FROM tweets
+    JOIN cryptocurrencies ON cryptocurrencies.id = tweets.coin_id
+WHERE tweets.date IS NOT NULL
+"""
+
+
+class TweetIndex:
+    """
+    Thread safe inverted index made of the segments in a directory and of
+    the tweets added since the last flush.
+
+    Usage:
+        >>> index = TweetIndex()
+        >>> database.add_batch_listener(index.add)
+        >>> index.search("hack", start="2019-02-01", end="2019-02-11")
+        ... [1094747843589046272, ...]
+    """
+
+    def __init__(self, directory: str = INDEX_DIRECTORY,
+                 flush_docs: int = FLUSH_DOCS):
+        """
+        :param directory: str of the directory holding the segments
+        :param flush_docs: int of the tweets buffered before writing a segment
+        """
+        self.directory = directory
+        self.flush_docs = flush_docs
+        self._lock = threading.Lock()
+        self._buffer = _MemorySegment()
+        os.makedirs(directory, exist_ok=True)
+        self._segments = [_DiskSegment(path) for path in self._segment_paths()]
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buffer) + sum(len(segment) for segment in self._segments)
+
+
+    @property
+    def num_segments(self) -> int:
+        return len(self._segments)
+
+
+    def add(self, tweets: list):
+        """
+        Indexes a batch of tweets, flushing the buffer once it's full
+
+        :param tweets: list of dicts with the "id", "date", "coin" and "text"
+                       of a tweet (as generated by json_parser.py)
+        """
+        documents = [(tweet["id"], tweet["date"], tweet["coin"],
+                      tokenize(tweet["text"])) for tweet in tweets]
+        with self._lock:
+            for tweet_id, date, coin, tokens in documents:
+                self._buffer.add(tweet_id, _days(date), coin, tokens)
+            METRICS.counter("index_tweets_added_total").inc(len(documents))
+            if len(self._buffer) >= self.flush_docs:
+                self._flush()
+
+
+    def flush(self):
+        """Writes the buffered tweets out as a segment"""
+        with self._lock:
+            self._flush()
+
+
+    def compact(self):
+        """Merges every segment into one"""
+        with self._lock:
+            self._flush()
+            if len(self._segments) > 1:
+                self._merge(list(self._segments))
+
+
+    def search(self, query: str, phrase=False, coins=None, start: str = None,
+               end: str = None, limit: int = None) -> list:
+        """
+        Returns the ids of the tweets containing every term of query, sorted
+        by id (and therefore by date)
+
+        :param query: str of the terms, cleaned like the tweets' content
+        :param phrase: bool for whether the terms must be consecutive
+        :param coins: optional iterable of coin names the tweets must be about
+        :param start: optional str date of the oldest tweets, ex: 2019-02-11
+        :param end: optional str date of the newest tweets (inclusive)
+        :param limit: optional int, only the newest limit tweets are returned
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        coins = None if coins is None else set(coins)
+        first_day = _days(start) if start is not None else None
+        last_day = _days(end) if end is not None else None
+
+        # Merges close the segments they replace, so searches hold the lock
+        with METRICS.timer("index_search_seconds"), self._lock:
+            segments = [self._buffer] + self._segments
+            if not limit:
+                tweet_ids = set()
+                for segment in segments:
+                    tweet_ids.update(_search(segment, terms, phrase, coins,
+                                             first_day, last_day))
+                return sorted(tweet_ids)
+
+            # Newest segments first, each yields its newest tweets first, so
+            # the search stops once nothing left can be newer than the
+            # limit newest tweets found
+            newest = list()
+            found = set()
+            for segment in sorted(segments, key=lambda segment: segment.max_id,
+                                  reverse=True):
+                if len(newest) == limit and segment.max_id < newest[0]:
+                    break
+                for tweet_id in _search(segment, terms, phrase, coins,
+                                        first_day, last_day):
+                    if tweet_id in found:
+                        continue
+                    if len(newest) < limit:
+                        heapq.heappush(newest, tweet_id)
+                    elif tweet_id > newest[0]:
+                        found.discard(heapq.heapreplace(newest, tweet_id))
+                    elif segment.ordered:
+                        break
+                    else:
+                        continue
+                    found.add(tweet_id)
+        return sorted(newest)
+
+
+    def rebuild(self, database, verbose=False) -> int:
+        """
+        Replaces the index with one of every tweet in the database, returns
+        the number of tweets indexed
+
+        :param database: DatabaseWrapper to stream the tweets with
+        """
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+                os.remove(segment.path)
+            self._segments = list()
+            self._buffer = _MemorySegment()
+
+        batch = list()
+        num_tweets = 0
+        for tweet_id, date, coin, content in database.stream(CONTENT_QUERY):
+            batch.append({"id": tweet_id, "date": str(date), "coin": coin,
+                          "text": content or ""})
+            if len(batch) == 10000:
+                self.add(batch)
+                num_tweets += len(batch)
+                batch = list()
+                if verbose:
+                    print("Indexed", num_tweets, "tweets")
+        self.add(batch)
+        self.compact()
+        return num_tweets + len(batch)
+
+
+    def _flush(self):
+        if not len(self._buffer):
+            return
+        docs, order = self._buffer.sorted_docs()
+        new_doc = {old: new for new, old in enumerate(order)}
+        postings = ((term, sorted((new_doc[doc], positions) for doc, positions in entries))
+                    for term, entries in sorted(self._buffer.postings_by_term.items()))
+        path = self._next_path()
+        with METRICS.timer("index_flush_seconds"):
+            _write_segment(path, docs, postings)
+        self._segments.append(_DiskSegment(path))
+        self._buffer = _MemorySegment()
+        if len(self._segments) > MAX_SEGMENTS:
+            smallest = sorted(self._segments, key=len)[:MERGE_FACTOR]
+            self._merge(smallest)
+
+
+    def _merge(self, segments: list):
+        """Replaces segments by one segment, dropping duplicate tweets"""
+        docs = list()
+        for number, segment in enumerate(segments):
+            docs.extend((tweet_id, number, doc) for doc, tweet_id in
+                        enumerate(segment.tweet_ids()))
+        docs.sort()
+        # (segment, old doc number) -> new doc number
+        mappings = [[None] * len(segment) for segment in segments]
+        merged_docs = list()
+        previous = None
+        for tweet_id, number, doc in docs:
+            if tweet_id == previous:
+                continue
+            previous = tweet_id
+            mappings[number][doc] = len(merged_docs)
+            merged_docs.append(segments[number].doc(doc))
+
+        def postings():
+            terms = heapq.merge(*[_tagged(segment.terms(), number)
+                                  for number, segment in enumerate(segments)])
+            current, entries = None, list()
+            for term, number in terms:
+                if term != current and entries:
+                    yield current, sorted(entries)
+                    entries = list()
+                current = term
+                mapping = mappings[number]
+                for doc, positions in segments[number].postings(term, positions=True):
+                    if mapping[doc] is not None:
+                        entries.append((mapping[doc], positions))
+            if entries:
+                yield current, sorted(entries)
+
+        path = self._next_path()
+        with METRICS.timer("index_merge_seconds"):
+            _write_segment(path, merged_docs, postings())
+        merged = set(id(segment) for segment in segments)
+        self._segments = [segment for segment in self._segments
+                          if id(segment) not in merged] + [_DiskSegment(path)]
+        for segment in segments:
+            segment.close()
+            os.remove(segment.path)
+
+
+    def _segment_paths(self) -> list:
+        return sorted((os.path.join(self.directory, name)
+                       for name in os.listdir(self.directory)
+                       if name.endswith(".seg")), key=_segment_number)
+
+
+    def _next_path(self) -> str:
+        numbers = [_segment_number(segment.path) for segment in self._segments]
+        return os.path.join(self.directory, "segment-{0:08d}.seg".format(
+            max(numbers, default=0) + 1))
+
+
+class _MemorySegment:
+    """The tweets added since the last flush, with the interface of _DiskSegment"""
+
+    def __init__(self):
+        self.docs = list()
+        self.postings_by_term = dict()
+        self.coins = set()
+        self.min_day = None
+        self.max_day = None
+        self.max_id = 0
+        # The doc numbers are in the order the tweets were added
+        self.ordered = False
+
+
+    def __len__(self):
+        return len(self.docs)
+
+
+    def add(self, tweet_id: int, day: int, coin: str, tokens: list):
+        doc = len(self.docs)
+        self.docs.append((tweet_id, day, coin))
+        self.max_id = max(self.max_id, tweet_id)
+        self.coins.add(coin)
+        self.min_day = day if self.min_day is None else min(self.min_day, day)
+        self.max_day = day if self.max_day is None else max(self.max_day, day)
+        positions = dict()
+        for position, token in enumerate(tokens):
+            positions.setdefault(token, []).append(position)
+        for token, token_positions in positions.items():
+            self.postings_by_term.setdefault(token, []).append((doc, token_positions))
+
+
+    def sorted_docs(self):
+        """Returns the docs sorted by tweet id and the old doc numbers in that order"""
+        order = sorted(range(len(self.docs)), key=lambda doc: self.docs[doc][0])
+        return [self.docs[doc] for doc in order], order
+
+
+    def doc_freq(self, term: str) -> int:
+        return len(self.postings_by_term.get(term, ()))
+
+
+    def postings(self, term: str, positions=False) -> list:
+        return self.postings_by_term.get(term, [])
+
+
+    def posting_list(self, term: str, positions=False):
+        return _ListPostings(self.postings_by_term.get(term, []))
+
+
+    def doc(self, doc: int):
+        return self.docs[doc]
+
+
+class _DiskSegment:
+    """Memory mapped, immutable segment file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        end = len(self._map) - len(MAGIC)
+        if self._map[end:] != MAGIC:
+            raise ValueError("{0} is not a complete index segment".format(path))
+        footer_length, = FOOTER_LENGTH.unpack_from(self._map, end - FOOTER_LENGTH.size)
+        footer_start = end - FOOTER_LENGTH.size - footer_length
+        footer = json.loads(self._map[footer_start:footer_start + footer_length])
+        self.num_docs = footer["num_docs"]
+        self.coin_names = footer["coins"]
+        self.coins = set(self.coin_names)
+        self.min_day = footer["min_day"]
+        self.max_day = footer["max_day"]
+        self._terms_offset = footer["terms_offset"]
+        self._terms_end = footer["terms_offset"] + footer["terms_length"]
+        self._docs_offset = footer["docs_offset"]
+        self._sparse_terms = [term for term, _ in footer["sparse"]]
+        self._sparse_offsets = [offset for _, offset in footer["sparse"]]
+        # Segments written before skip tables have none
+        self._skips = "skip_interval" in footer
+        # The doc numbers are in tweet id order
+        self.ordered = True
+        self.max_id = self.doc(self.num_docs - 1)[0] if self.num_docs else 0
+
+
+    def __len__(self):
+        return self.num_docs
+
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+    def doc_freq(self, term: str) -> int:
+        entry = self._lookup(term)
+        return entry[2] if entry is not None else 0
+
+
+    def postings(self, term: str, positions=False) -> list:
+        """
+        Returns the sorted list of (doc, positions) of term, positions is None
+        unless asked for
+        """
+        return list(self.posting_list(term, positions))
+
+
+    def posting_list(self, term: str, positions=False):
+        """Returns the _PostingList of term, decoded as it's read"""
+        entry = self._lookup(term)
+        if entry is None:
+            return _ListPostings([])
+        offset, length, doc_freq = entry
+        return _PostingList(self._map, offset, offset + length, doc_freq,
+                            self._skips, positions)
+
+
+    def doc(self, doc: int):
+        tweet_id, day, coin = DOC_RECORD.unpack_from(
+            self._map, self._docs_offset + doc * DOC_RECORD.size)
+        return tweet_id, day, self.coin_names[coin]
+
+
+    def tweet_ids(self):
+        for doc in range(self.num_docs):
+            yield DOC_RECORD.unpack_from(
+                self._map, self._docs_offset + doc * DOC_RECORD.size)[0]
+
+
+    def terms(self):
+        """Generator of every term in sorted order"""
+        offset = self._terms_offset
+        while offset < self._terms_end:
+            term, _, offset = self._read_term(offset)
+            yield term
+
+
+    def _lookup(self, term: str):
+        """Returns the (offset, length, doc frequency) of term's postings"""
+        block = bisect.bisect_right(self._sparse_terms, term) - 1
+        if block < 0:
+            return None
+        offset = self._sparse_offsets[block]
+        for _ in range(SPARSE_INTERVAL):
+            if offset >= self._terms_end:
+                return None
+            current, entry, offset = self._read_term(offset)
+            if current > term:
+                return None
+            if current == term:
+                return entry
+        return None
+
+
+    def _read_term(self, offset: int):
+        """
+        Returns the term at offset, the (offset, length, doc frequency) of its
+        postings and the offset of the next term
+        """
+        length, offset = _decode_varint(self._map, offset)
+        term = self._map[offset:offset + length].decode("utf8")
+        offset += length
+        entry = list()
+        for _ in range(3):
+            value, offset = _decode_varint(self._map, offset)
+            entry.append(value)
+        return term, tuple(entry), offset
+
+
+class _PostingList:
+    """
+    Posting list of a term in a _DiskSegment, decoded a block of
+    SKIP_INTERVAL postings at a time
+    """
+
+    def __init__(self, buffer, offset: int, end: int, doc_freq: int, skips: bool,
+                 positions: bool):
+        """
+        :param skips: bool for whether the postings start with a skip table
+        :param positions: bool for whether the positions are decoded
+        """
+        self._buffer = buffer
+        self._end = end
+        self._positions = positions
+        self.doc_freq = doc_freq
+        # Doc number before every block (the base of its deltas) and offset
+        previous = [0]
+        offsets = [0]
+        if skips:
+            num_skips, offset = _decode_varint(buffer, offset)
+            for _ in range(num_skips):
+                doc_delta, offset = _decode_varint(buffer, offset)
+                offset_delta, offset = _decode_varint(buffer, offset)
+                previous.append(previous[-1] + doc_delta)
+                offsets.append(offsets[-1] + offset_delta)
+        self._previous = previous
+        self._offsets = [offset + block_offset for block_offset in offsets]
+        self._block_number = None
+        self._block_docs = None
+        self._block = None
+
+
+    def __len__(self):
+        return self.doc_freq
+
+
+    def __iter__(self):
+        for number in range(len(self._offsets)):
+            yield from self._decode(number)
+
+
+    def newest_first(self):
+        """Generator of the (doc, positions) from the last doc to the first"""
+        for number in reversed(range(len(self._offsets))):
+            yield from reversed(self._decode(number))
+
+
+    def find(self, doc: int):
+        """Returns the (doc, positions) of doc, None if the term isn't in doc"""
+        number = bisect.bisect_left(self._previous, doc, 1) - 1
+        if number != self._block_number:
+            self._block = self._decode(number)
+            self._block_docs = [posting[0] for posting in self._block]
+            self._block_number = number
+        index = bisect.bisect_left(self._block_docs, doc)
+        if index < len(self._block_docs) and self._block_docs[index] == doc:
+            return self._block[index]
+        return None
+
+
+    def _decode(self, number: int) -> list:
+        end = self._offsets[number + 1] if number + 1 < len(self._offsets) else self._end
+        return _decode_postings(self._buffer, self._offsets[number], end,
+                                self._positions, self._previous[number])
+
+
+class _ListPostings:
+    """Posting list of a term in a _MemorySegment, with the interface of _PostingList"""
+
+    def __init__(self, postings: list):
+        self._postings = postings
+        self._docs = [doc for doc, _ in postings]
+
+
+    def __len__(self):
+        return len(self._postings)
+
+
+    def __iter__(self):
+        return iter(self._postings)
+
+
+    def newest_first(self):
+        return reversed(self._postings)
+
+
+    def find(self, doc: int):
+        index = bisect.bisect_left(self._docs, doc)
+        if index < len(self._docs) and self._docs[index] == doc:
+            return self._postings[index]
+        return None
+
+
+def _tagged(terms, number: int):
+    for term in terms:
+        yield term, number
+
+
+def tokenize(content: str) -> list:
+    return clean_text_for_tfidf(content).split()
+
+
+def _search(segment, terms: list, phrase: bool, coins, first_day, last_day):
+    """
+    Generator of the ids of the tweets of a segment that match the query,
+    newest first if the segment's doc numbers are in tweet id order
+    """
+    if not len(segment):
+        return
+    if coins is not None and not (coins & segment.coins):
+        return
+    if (first_day is not None and segment.max_day < first_day) or \
+            (last_day is not None and segment.min_day > last_day):
+        return
+
+    # The rarest term's docs are the candidates, the other terms' lists are
+    # only decoded around them
+    posting_lists = sorted(((term, segment.posting_list(term, positions=phrase))
+                            for term in set(terms)), key=lambda item: len(item[1]))
+    if not len(posting_lists[0][1]):
+        return
+    rarest_term, rarest = posting_lists[0]
+
+    for doc, doc_positions in rarest.newest_first():
+        positions = {rarest_term: doc_positions}
+        for term, postings in posting_lists[1:]:
+            posting = postings.find(doc)
+            if posting is None:
+                break
+            positions[term] = posting[1]
+        if len(positions) < len(posting_lists):
+            continue
+        if phrase and not _is_phrase(terms, positions):
+            continue
+        tweet_id, day, coin = segment.doc(doc)
+        if coins is not None and coin not in coins:
+            continue
+        if (first_day is not None and day < first_day) or \
+                (last_day is not None and day > last_day):
+            continue
+        yield tweet_id
+
+
+def _is_phrase(terms: list, positions: dict) -> bool:
+    """
+    Returns whether the terms appear one after the other in a doc
+
+    :param positions: dict of every term to its positions in the doc
+    """
+    following = [set(positions[term]) for term in terms[1:]]
+    for start in positions[terms[0]]:
+        if all(start + offset + 1 in term_positions
+               for offset, term_positions in enumerate(following)):
+            return True
+    return False
+
+
+def _write_segment(path: str, docs: list, postings):
+    """
+    Writes a segment file
+
+    :param docs: list of (tweet id, day, coin) sorted by tweet id
+    :param postings: iterable of (term, sorted list of (doc, positions)) in
+                     sorted term order
+    """
+    coins = sorted(set(coin for _, _, coin in docs))
+    coin_numbers = {coin: number for number, coin in enumerate(coins)}
+    terms = bytearray()
+    sparse = list()
+    offset = 0
+    with open(path + ".tmp", "wb") as f:
+        for number, (term, entries) in enumerate(postings):
+            encoded = _encode_postings(entries)
+            f.write(encoded)
+            if number % SPARSE_INTERVAL == 0:
+                sparse.append((term, len(terms)))
+            term_bytes = term.encode("utf8")
+            _encode_varint(len(term_bytes), terms)
+            terms += term_bytes
+            _encode_varint(offset, terms)
+            _encode_varint(len(encoded), terms)
+            _encode_varint(len(entries), terms)
+            offset += len(encoded)
+
+        f.write(terms)
+        for tweet_id, day, coin in docs:
+            f.write(DOC_RECORD.pack(tweet_id, day, coin_numbers[coin]))
+        days = [day for _, day, _ in docs]
+        footer = json.dumps({
+            "num_docs": len(docs),
+            "coins": coins,
+            "min_day": min(days, default=0),
+            "max_day": max(days, default=0),
+            "terms_offset": offset,
+            "terms_length": len(terms),
+            "docs_offset": offset + len(terms),
+            "skip_interval": SKIP_INTERVAL,
+            # Offsets in the terms block, made absolute below
+            "sparse": [[term, offset + position] for term, position in sparse],
+        }).encode("utf8")
+        f.write(footer)
+        f.write(FOOTER_LENGTH.pack(len(footer)))
+        f.write(MAGIC)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _encode_postings(entries: list) -> bytes:
+    encoded = bytearray()
+    skips = list()
+    previous = 0
+    for number, (doc, positions) in enumerate(entries):
+        if number and number % SKIP_INTERVAL == 0:
+            skips.append((previous, len(encoded)))
+        _encode_varint(doc - previous, encoded)
+        previous = doc
+        encoded_positions = bytearray()
+        previous_position = 0
+        for position in positions:
+            _encode_varint(position - previous_position, encoded_positions)
+            previous_position = position
+        _encode_varint(len(encoded_positions), encoded)
+        encoded += encoded_positions
+
+    skip_table = bytearray()
+    _encode_varint(len(skips), skip_table)
+    previous_doc, previous_offset = 0, 0
+    for doc, offset in skips:
+        _encode_varint(doc - previous_doc, skip_table)
+        _encode_varint(offset - previous_offset, skip_table)
+        previous_doc, previous_offset = doc, offset
+    return bytes(skip_table + encoded)
+
+
+def _decode_postings(buffer, offset: int, end: int, positions=False,
+                     doc: int = 0) -> list:
+    """
+    Returns the list of (doc, positions) encoded between offset and end
+
+    :param doc: int of the doc number before the first one, the base of its delta
+    """
+    postings = list()
+    while offset < end:
+        delta, offset = _decode_varint(buffer, offset)
+        doc += delta
+        length, offset = _decode_varint(buffer, offset)
+        if positions:
+            decoded = list()
+            position = 0
+            positions_end = offset + length
+            while offset < positions_end:
+                delta, offset = _decode_varint(buffer, offset)
+                position += delta
+                decoded.append(position)
+            postings.append((doc, decoded))
+        else:
+            postings.append((doc, None))
+            offset += length
+    return postings
+
+
+def _encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(buffer, offset: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def _days(date: str) -> int:
+    """Returns the days since the epoch of a YYYY-MM-DD date"""
+    return (dt.date.fromisoformat(str(date)[:10]) - dt.date(1970, 1, 1)).days
+
+
+def _segment_number(path: str) -> int:
+    return int(os.path.basename(path)[len("segment-"):-len(".seg")])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the tweet index")
+    parser.add_argument("query", nargs="?", default=None)
+    parser.add_argument("--phrase", action="store_true")
+    parser.add_argument("--coin", action="append", dest="coins", default=None)
+    parser.add_argument("--start", default=None)
+    parser.add_argument("--end", default=None)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild the index from the tweets table first")
+    args = parser.parse_args()
+
+    import time
+
+    index = TweetIndex()
+    if args.rebuild:
+        from database_wrapper import DatabaseWrapper
+
+        start = time.time()
+        num_tweets = index.rebuild(DatabaseWrapper(), verbose=True)
+        print("Indexed {0} tweets in {1:0.2f}s".format(num_tweets, time.time() - start))
+    if args.query is not None:
+        start = time.time()
+        tweet_ids = index.search(args.query, phrase=args.phrase, coins=args.coins,
+                                 start=args.start, end=args.end, limit=args.limit)
+        print("{0} tweets in {1:0.2f}ms".format(len(tweet_ids),
+                                                 (time.time() - start) * 1000))
+        for tweet_id in tweet_ids:
+            print(tweet_id)
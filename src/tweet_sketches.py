@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Streaming sketches of the tweets of every coin and day, so questions like
+"how many distinct users talked about ripple today" or "the top hashtags of
+ethereum this week" don't need a COUNT(DISTINCT) or GROUP BY over the joins
+of tweets and tweet_hashtag (see tweet_hashtag_query.sql).
+
+Every coin and day has:
+    a HyperLogLog of its users
+    a Count-Min sketch of its hashtags, with the heavy hitters among them
+
+Error bounds, for the default sizes:
+    HyperLogLog (PRECISION=12, 4 KiB): the standard error of a count is
+        1.04 / sqrt(2^12) = 1.6%, small counts are exact in practice
+    Count-Min (WIDTH=2048, DEPTH=4, 32 KiB): a count never comes out too
+        low and comes out too high by more than e / WIDTH = 0.13% of the
+        total number of hashtags with a probability of e^-DEPTH = 1.8%
+    Heavy hitters (HEAVY_HITTERS=100): every hashtag whose count is above
+        that of the HEAVY_HITTERS-th hashtag by more than the Count-Min error
+        is in the list, their counts are Count-Min estimates
+Merging two sketches (a union of their tweets) keeps these bounds, so the
+sketches of several threads, shards or days are merged into one in constant
+memory.
+
+The sketches are updated as batches of tweets are inserted (see
+DataManager.add_batch_listener()) and flush() writes them to the
+tweet_sketches table. Each writer (source) has its own row per coin and day
+which it loads back when it starts again, the queries merge the rows of
+every source, so shards never overwrite each other's counts.
+
+Usage:
+    >>> sketches = TweetSketches(DatabaseWrapper(), CRYPTOS, source="daily")
+    >>> sketches.create_table()
+    >>> sketches.add(tweets)  # new tweets, as generated by json_parser.py
+    >>> sketches.flush()
+    >>> sketches.distinct_users("ripple", start="2019-02-11")
+    >>> sketches.top_hashtags("ethereum", start="2019-02-05", end="2019-02-11")
+"""
+
+import hashlib
+import heapq
+import math
+import struct
+import threading
+import zlib
+from array import array
+
+from data_collection.metrics import METRICS
+
+
+TABLE = "tweet_sketches"
+DEFAULT_SOURCE = "default"
+
+# HyperLogLog registers are 2^PRECISION bytes
+PRECISION = 12
+# Count-Min sketch of DEPTH rows of WIDTH counters
+WIDTH = 2048
+DEPTH = 4
+# Hashtags whose counts are kept, the rest are only in the Count-Min sketch
+HEAVY_HITTERS = 100
+# Dates whose sketches stay in memory after a flush, the newest ones
+LOADED_DATES = 8
+
+_HLL_HEADER = struct.Struct("<BB")
+_COUNT_MIN_HEADER = struct.Struct("<BIBQ")
+_VERSION = 1
+
+
+def _hash(value) -> int:
+    """Returns a 64 bit hash of value that is the same in every process"""
+    digest = hashlib.blake2b(str(value).encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct values added to it.
+
+    Usage:
+        >>> users = HyperLogLog()
+        >>> users.add(123)
+        >>> users.merge(other_users)
+        >>> len(users)
+        ... 2
+    """
+
+    def __init__(self, precision: int = PRECISION):
+        """
+        :param precision: int of the bits of the hash picking the register,
+                          the standard error is 1.04 / sqrt(2^precision)
+        """
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+
+    def add(self, value):
+        hashed = _hash(value)
+        index = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+
+    def merge(self, other: "HyperLogLog"):
+        """Adds every value of other, which must have the same precision"""
+        if other.precision != self.precision:
+            raise ValueError("Can't merge HyperLogLogs of precision {0} and {1}".format(
+                self.precision, other.precision))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+
+    def count(self) -> int:
+        """Returns the estimated number of distinct values"""
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        estimate = alpha * num_registers ** 2 / sum(
+            2.0 ** -register for register in self.registers)
+        num_zeros = self.registers.count(0)
+        if estimate <= 2.5 * num_registers and num_zeros:
+            # Linear counting is more accurate for small counts
+            estimate = num_registers * math.log(num_registers / num_zeros)
+        return int(round(estimate))
+
+
+    def __len__(self):
+        return self.count()
+
+
+    def to_bytes(self) -> bytes:
+        return _HLL_HEADER.pack(_VERSION, self.precision) + zlib.compress(self.registers)
+
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        _, precision = _HLL_HEADER.unpack_from(data)
+        sketch = cls(precision)
+        sketch.registers = bytearray(zlib.decompress(data[_HLL_HEADER.size:]))
+        return sketch
+
+
+class CountMinSketch:
+    """
+    Estimates how often every value was added to it, never too low.
+
+    Usage:
+        >>> hashtags = CountMinSketch()
+        >>> hashtags.add("btc", 3)
+        >>> hashtags.estimate("btc")
+        ... 3
+    """
+
+    def __init__(self, width: int = WIDTH, depth: int = DEPTH):
+        """
+        :param width: int of counters per row, the error is e / width of the
+                      total count
+        :param depth: int of rows, the error is exceeded with a probability
+                      of e^-depth
+        """
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.counters = array("Q", bytes(8 * width * depth))
+
+
+    def add(self, value, count: int = 1) -> int:
+        """Adds count occurrences of value, returns its new estimate"""
+        estimate = None
+        for position in self._positions(value):
+            self.counters[position] += count
+            if estimate is None or self.counters[position] < estimate:
+                estimate = self.counters[position]
+        self.total += count
+        return estimate
+
+
+    def estimate(self, value) -> int:
+        return min(self.counters[position] for position in self._positions(value))
+
+
+    def merge(self, other: "CountMinSketch"):
+        """Adds every count of other, which must have the same dimensions"""
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Can't merge Count-Min sketches of {0}x{1} and {2}x{3}".format(
+                self.depth, self.width, other.depth, other.width))
+        self.counters = array("Q", map(sum, zip(self.counters, other.counters)))
+        self.total += other.total
+
+
+    def to_bytes(self) -> bytes:
+        return _COUNT_MIN_HEADER.pack(_VERSION, self.width, self.depth, self.total) + \
+            zlib.compress(self.counters.tobytes())
+
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CountMinSketch":
+        _, width, depth, total = _COUNT_MIN_HEADER.unpack_from(data)
+        sketch = cls(width, depth)
+        sketch.total = total
+        sketch.counters = array("Q")
+        sketch.counters.frombytes(zlib.decompress(data[_COUNT_MIN_HEADER.size:]))
+        return sketch
+
+
+    def _positions(self, value):
+        # Double hashing, row i uses hash1 + i * hash2
+        hashed = _hash(value)
+        hash1, hash2 = hashed & 0xFFFFFFFF, (hashed >> 32) | 1
+        return [row * self.width + (hash1 + row * hash2) % self.width
+                for row in range(self.depth)]
+
+
+class HashtagSketch:
+    """
+    Count-Min sketch of hashtags along with the counts of the most frequent.
+
+    Usage:
+        >>> hashtags = HashtagSketch()
+        >>> hashtags.add(["BTC", "crypto"])
+        >>> hashtags.top(10)
+        ... [("btc", 1), ("crypto", 1)]
+    """
+
+    def __init__(self, capacity: int = HEAVY_HITTERS, width: int = WIDTH,
+                 depth: int = DEPTH):
+        """
+        :param capacity: int of the heavy hitters kept
+        """
+        self.capacity = capacity
+        self.counts = CountMinSketch(width, depth)
+        # hashtag -> estimated count of the heavy hitters
+        self.heavy_hitters = dict()
+
+
+    def add(self, hashtags):
+        """Adds an iterable of hashtags, case insensitive like the hashtags table"""
+        for hashtag in hashtags:
+            hashtag = hashtag.lower()
+            estimate = self.counts.add(hashtag)
+            if hashtag in self.heavy_hitters or len(self.heavy_hitters) < self.capacity:
+                self.heavy_hitters[hashtag] = estimate
+                continue
+            smallest = min(self.heavy_hitters, key=self.heavy_hitters.get)
+            if estimate > self.heavy_hitters[smallest]:
+                del self.heavy_hitters[smallest]
+                self.heavy_hitters[hashtag] = estimate
+
+
+    def estimate(self, hashtag: str) -> int:
+        return self.counts.estimate(hashtag.lower())
+
+
+    def top(self, n: int = 10) -> list:
+        """Returns the n most frequent hashtags as (hashtag, count) tuples"""
+        return heapq.nlargest(n, self.heavy_hitters.items(), key=lambda item: item[1])
+
+
+    def merge(self, other: "HashtagSketch"):
+        """Adds every hashtag of other, the heavy hitters of both are re-estimated"""
+        self.counts.merge(other.counts)
+        candidates = set(self.heavy_hitters) | set(other.heavy_hitters)
+        self.heavy_hitters = dict(heapq.nlargest(
+            self.capacity, ((hashtag, self.counts.estimate(hashtag))
+                            for hashtag in candidates),
+            key=lambda item: item[1]))
+
+
+    def to_bytes(self) -> bytes:
+        heavy_hitters = "\n".join(self.heavy_hitters).encode("utf8")
+        return struct.pack("<HI", self.capacity, len(heavy_hitters)) + heavy_hitters + \
+            self.counts.to_bytes()
+
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HashtagSketch":
+        capacity, length = struct.unpack_from("<HI", data)
+        start = struct.calcsize("<HI")
+        sketch = cls(capacity)
+        sketch.counts = CountMinSketch.from_bytes(data[start + length:])
+        heavy_hitters = data[start:start + length].decode("utf8")
+        sketch.heavy_hitters = {hashtag: sketch.counts.estimate(hashtag)
+                                for hashtag in heavy_hitters.split("\n") if hashtag}
+        return sketch
+
+
+class TweetSketches:
+    """
+    Thread safe sketches of the users and hashtags of every coin and day.
+
+    Usage:
+        >>> sketches = TweetSketches(DatabaseWrapper(), CRYPTOS)
+        >>> database.add_batch_listener(sketches.add)
+        >>> sketches.distinct_users("bitcoin", start="2019-02-11")
+        ... 5231
+    """
+
+    def __init__(self, database, coins, source: str = DEFAULT_SOURCE):
+        """
+        :param database: DatabaseWrapper used by flush() and the queries
+        :param coins: CoinRegistry of the coins, their ids are loaded if
+                      they aren't already
+        :param source: str name of the writer, two processes writing at the
+                       same time need different sources, ex: "worker-3"
+        """
+        self._database = database
+        self.coins = coins
+        self.source = source
+        # (coin id, date) -> [number of tweets, HyperLogLog, HashtagSketch]
+        self._sketches = dict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+
+    def create_table(self):
+        if TABLE in self._database.show_tables():
+            return
+        self._database.execute("""
+CREATE TABLE {0} (
+    coin_id INT UNSIGNED NOT NULL,
+    date DATE NOT NULL,
+    source VARCHAR(64) NOT NULL,
+    num_tweets INT UNSIGNED NOT NULL,
+    users BLOB NOT NULL,
+    hashtags MEDIUMBLOB NOT NULL,
+    FOREIGN KEY (coin_id) REFERENCES cryptocurrencies (id) ON DELETE RESTRICT ON UPDATE CASCADE,
+    PRIMARY KEY (coin_id, date, source)
+); """.format(TABLE))
+
+
+    def add(self, tweets: list):
+        """
+        Adds a batch of new tweets to the sketches of their coin and day
+
+        :param tweets: list of tweet dicts (as generated by json_parser.py),
+                       a tweet added twice counts twice in the hashtags
+        """
+        with self._lock:
+            for tweet in tweets:
+                coin_id = self._coin_id(tweet["coin"])
+                if coin_id is None or tweet["date"] is None:
+                    continue
+                key = (coin_id, str(tweet["date"]))
+                sketch = self._sketch(key)
+                sketch[0] += 1
+                sketch[1].add(tweet["user"]["id"])
+                sketch[2].add(tweet["hashtags"])
+                self._dirty.add(key)
+
+
+    def flush(self) -> int:
+        """
+        Writes the sketches of this source changed since the last flush in
+        one transaction, returns how many were written
+        """
+        with self._lock:
+            statements = [(
+                "INSERT INTO {0} (coin_id, date, source, num_tweets, users, hashtags) "
+                "VALUES (%s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+                "num_tweets = VALUES(num_tweets), users = VALUES(users), "
+                "hashtags = VALUES(hashtags)".format(TABLE),
+                (coin_id, date, self.source, num_tweets, users.to_bytes(),
+                 hashtags.to_bytes()))
+                for (coin_id, date), (num_tweets, users, hashtags)
+                in ((key, self._sketches[key]) for key in sorted(self._dirty))]
+            if statements:
+                with METRICS.timer("sketch_flush_seconds"):
+                    self._database.execute_batch(statements)
+            self._dirty = set()
+            # The sketches of earlier days are rarely added to again, they
+            # are loaded back from the table if they are
+            kept = set(sorted(set(date for _, date in self._sketches))[-LOADED_DATES:])
+            self._sketches = {key: sketch for key, sketch in self._sketches.items()
+                              if key[1] in kept}
+        METRICS.counter("sketches_written_total").inc(len(statements))
+        return len(statements)
+
+
+    def merged(self, coin: str, start: str, end: str = None):
+        """
+        Returns a tuple of (number of tweets, HyperLogLog, HashtagSketch) of
+        the tweets about coin between the dates start and end (inclusive),
+        merged over every source and day, None if there are none
+
+        :param coin: str name of the coin
+        :param start: str date, ex: 2019-02-11
+        :param end: optional str date, defaults to start
+        """
+        result = None
+        with self._lock:
+            coin_id = self._coin_id(coin)
+            if coin_id is None:
+                return None
+            rows = self._database.stream(
+                "SELECT num_tweets, users, hashtags FROM {0} "
+                "WHERE coin_id = %s AND date BETWEEN %s AND %s".format(TABLE),
+                params=(coin_id, start, end or start))
+            for num_tweets, users, hashtags in rows:
+                sketch = [num_tweets, HyperLogLog.from_bytes(users),
+                          HashtagSketch.from_bytes(hashtags)]
+                if result is None:
+                    result = sketch
+                else:
+                    result[0] += sketch[0]
+                    result[1].merge(sketch[1])
+                    result[2].merge(sketch[2])
+        return None if result is None else tuple(result)
+
+
+    def distinct_users(self, coin: str, start: str, end: str = None) -> int:
+        """Returns the estimated number of users that tweeted about coin"""
+        merged = self.merged(coin, start, end)
+        return 0 if merged is None else merged[1].count()
+
+
+    def top_hashtags(self, coin: str, start: str, end: str = None,
+                     n: int = 10) -> list:
+        """Returns the n most used hashtags about coin as (hashtag, count) tuples"""
+        merged = self.merged(coin, start, end)
+        return [] if merged is None else merged[2].top(n)
+
+
+    def hashtag_count(self, coin: str, hashtag: str, start: str,
+                      end: str = None) -> int:
+        """Returns the estimated number of uses of hashtag about coin"""
+        merged = self.merged(coin, start, end)
+        return 0 if merged is None else merged[2].estimate(hashtag)
+
+
+    def _sketch(self, key) -> list:
+        """Returns the sketches of a coin and day, loading this source's first"""
+        sketch = self._sketches.get(key)
+        if sketch is None:
+            coin_id, date = key
+            rows = list(self._database.stream(
+                "SELECT num_tweets, users, hashtags FROM {0} "
+                "WHERE coin_id = %s AND date = %s AND source = %s".format(TABLE),
+                params=(coin_id, date, self.source)))
+            if rows:
+                num_tweets, users, hashtags = rows[0]
+                sketch = [num_tweets, HyperLogLog.from_bytes(users),
+                          HashtagSketch.from_bytes(hashtags)]
+            else:
+                sketch = [0, HyperLogLog(), HashtagSketch()]
+            self._sketches[key] = sketch
+        return sketch
+
+
+    def _coin_id(self, name: str):
+        if not self.coins.ids_loaded:
+            self.coins.load_ids(self._database)
+        return self.coins.id_of(name)
+
+
+if __name__ == "__main__":
+    # Prints the distinct users and top hashtags of a coin
+    # Usage: python3 tweet_sketches.py bitcoin 2019-02-01 [2019-02-07]
+    import sys
+
+    from cryptocurrencies import CRYPTOS
+    from database_wrapper import DatabaseWrapper
+
+    sketches = TweetSketches(DatabaseWrapper(), CRYPTOS)
+    end = sys.argv[3] if len(sys.argv) > 3 else None
+    merged = sketches.merged(sys.argv[1], sys.argv[2], end)
+    if merged is None:
+        print("No sketches of", sys.argv[1])
+    else:
+        num_tweets, users, hashtags = merged
+        print("{0} tweets by ~{1} distinct users".format(num_tweets, users.count()))
+        for hashtag, count in hashtags.top(20):
+            print("    #{0}: ~{1}".format(hashtag, count))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Per run cache of the twitter_users table.
+
+The same accounts show up in many tweets of a run, so instead of writing the
+user of every tweet the users of a batch are collapsed to one row each (with
+the latest followers/friends counts seen) and only the users that are new or
+whose counts changed since they were last written are upserted, in a single
+INSERT ... ON DUPLICATE KEY UPDATE. This also keeps the follower counts used
+by tweet_query.sql up to date instead of frozen at the first tweet seen.
+
+A user only goes into the snapshot once its write committed. While a thread
+is writing a user, the other threads that need the same user wait for that
+write instead of skipping it, so a tweet is never inserted before its user
+(tweets.user_id references twitter_users.id).
+"""
+
+import threading
+
+from data_collection.metrics import METRICS
+
+
+USER_COLUMNS = ("id", "date_created", "followers", "friends")
+
+
+class TwitterUserCache:
+    """
+    Class that remembers the followers/friends of every twitter user written
+    during a run, one instance can be shared by every thread of the run
+
+    Usage:
+        >>> cache = TwitterUserCache()
+        >>> cache.upsert(database, [tweet["user"] for tweet in tweets])
+    """
+
+    def __init__(self):
+        # user id -> (followers, friends) as last written to the database
+        self._snapshot = dict()
+        # user id -> threading.Event set once its write finished, for the
+        # users being written by some thread
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._snapshot)
+
+
+    def upsert(self, database, users) -> int:
+        """
+        Writes the users that are new or changed since they were last written
+
+        :param database: DatabaseWrapper to write to
+        :param users: iterable of user dicts (see JSONTweetParser.get_userinfo())
+        :returns: int of how many users were written
+        """
+        latest = dict()
+        for user in users:
+            latest[user["id"]] = user
+        remaining = list(latest.values())
+        num_written = 0
+        while remaining:
+            changed, waiting = self._claim(remaining)
+            if changed:
+                self._write(database, changed)
+                num_written += len(changed)
+            # The users another thread was writing are checked again once it's
+            # done, in case its write failed or had other counts
+            for event in {id(event): event for _, event in waiting}.values():
+                event.wait()
+            remaining = [user for user, _ in waiting]
+        METRICS.counter("twitter_users_skipped_total").inc(len(latest) - num_written)
+        return num_written
+
+
+    def _write(self, database, users: list):
+        sql = ("INSERT INTO twitter_users ({0}) VALUES ({1}) "
+               "ON DUPLICATE KEY UPDATE followers = VALUES(followers), "
+               "friends = VALUES(friends)").format(
+                   ", ".join(USER_COLUMNS), ", ".join(["%s"] * len(USER_COLUMNS)))
+        try:
+            database.executemany(sql, [tuple(user[column] for column in USER_COLUMNS)
+                                       for user in users])
+        except Exception:
+            self._release(users, written=False)
+            raise
+        self._release(users, written=True)
+        METRICS.counter("twitter_users_written_total").inc(len(users))
+
+
+    def _claim(self, users: list):
+        """
+        Returns a tuple of the users whose counts differ from the snapshot,
+        which are now in flight for this thread, and a list of (user, event)
+        of the users another thread is writing
+        """
+        changed = list()
+        waiting = list()
+        with self._lock:
+            for user in users:
+                event = self._in_flight.get(user["id"])
+                if event is not None:
+                    waiting.append((user, event))
+                elif self._snapshot.get(user["id"]) != (user["followers"], user["friends"]):
+                    self._in_flight[user["id"]] = threading.Event()
+                    changed.append(user)
+        return changed, waiting
+
+
+    def _release(self, users: list, written: bool):
+        """Ends the writes of users, they go in the snapshot if they were written"""
+        with self._lock:
+            for user in users:
+                if written:
+                    self._snapshot[user["id"]] = (user["followers"], user["friends"])
+                self._in_flight.pop(user["id"]).set()
+
+
+if __name__ == "__main__":
+    pass
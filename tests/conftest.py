@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+The modules of src import each other by their bare names, ex: "from
+database_wrapper import DatabaseWrapper", so src is put on the path like
+running them from src does.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
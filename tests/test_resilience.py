@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+Retries and circuit breaking of resilience.call() against the local
+StubServer, requests are made with urllib so requests isn't needed.
+"""
+
+import json
+import time
+import urllib.request
+
+import pytest
+
+from data_collection import resilience
+from data_collection.resilience import (CircuitBreaker, CircuitOpenError,
+                                        RetryPolicy, call)
+from data_collection.stub_server import StubServer
+
+
+FAST = RetryPolicy(max_attempts=4, base_delay=0.01, max_delay=0.05,
+                   deadline=10, timeout=0.5)
+
+
+def fetch(url: str):
+    """Returns a call() function that gets the JSON body of url"""
+    def attempt(timeout):
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return json.loads(response.read())
+    return attempt
+
+
+def failing(statuses: list, headers: dict = None):
+    """Returns a route answering with statuses in turn, then with 200"""
+    remaining = list(statuses)
+
+    def handler(path, query):
+        if remaining:
+            return remaining.pop(0), {"error": "failing"}, headers or {}
+        return 200, {"ok": True}
+    return handler
+
+
+@pytest.fixture
+def breaker(request, monkeypatch):
+    """A breaker of its own for the test's endpoint, with a short reset"""
+    endpoint = request.node.name
+    breaker = CircuitBreaker(endpoint, threshold=2, reset_seconds=0.2)
+    monkeypatch.setitem(resilience._breakers, endpoint, breaker)
+    return breaker
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retries_rate_limits_and_server_errors(breaker, status):
+    with StubServer({"/": failing([status], {"Retry-After": "0"})}) as server:
+        assert call(breaker.endpoint, fetch(server.url + "/"), FAST) == {"ok": True}
+        assert server.request_count == 2
+
+
+def test_waits_for_retry_after():
+    with StubServer({"/": failing([429], {"Retry-After": "0.3"})}) as server:
+        start = time.monotonic()
+        call("test_waits_for_retry_after", fetch(server.url + "/"), FAST)
+        assert time.monotonic() - start >= 0.3
+
+
+def test_rate_limit_callback_skips_the_wait():
+    switched = list()
+    with StubServer({"/": failing([429], {"Retry-After": "30"})}) as server:
+        start = time.monotonic()
+        call("test_rate_limit_callback", fetch(server.url + "/"), FAST,
+             on_rate_limit=lambda e: switched.append(e) or True)
+        assert time.monotonic() - start < 5
+    assert len(switched) == 1
+
+
+def test_retries_timeouts(breaker):
+    hung = list()
+
+    def handler(path, query):
+        if not hung:
+            hung.append(path)
+            time.sleep(1)
+        return 200, {"ok": True}
+
+    with StubServer({"/": handler}) as server:
+        assert call(breaker.endpoint, fetch(server.url + "/"), FAST) == {"ok": True}
+        assert server.request_count == 2
+
+
+def test_client_errors_are_not_retried(breaker):
+    with StubServer({"/": failing([404] * 3)}) as server:
+        with pytest.raises(urllib.error.HTTPError):
+            call(breaker.endpoint, fetch(server.url + "/"), FAST)
+        assert server.request_count == 1
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_gives_up_after_max_attempts():
+    with StubServer({"/": failing([503] * 10)}) as server:
+        with pytest.raises(urllib.error.HTTPError):
+            call("test_gives_up", fetch(server.url + "/"), FAST)
+        assert server.request_count == FAST.max_attempts
+
+
+def test_injected_faults_are_retried():
+    routes = {"/": lambda path, query: (200, {"ok": True})}
+    policy = RetryPolicy(max_attempts=20, base_delay=0.01, max_delay=0.02,
+                         deadline=30, timeout=0.2)
+    with StubServer(routes, fault_rate=0.3, faults=(429, 500, 503, "timeout"),
+                    hang=0.5, retry_after=0, seed=7) as server:
+        for _ in range(20):
+            assert call("test_injected_faults", fetch(server.url + "/"),
+                        policy) == {"ok": True}
+        assert server.fault_count > 0
+        assert server.request_count == 20 + server.fault_count
+
+
+def test_breaker_opens_and_half_opens():
+    breaker = CircuitBreaker("test_breaker", threshold=2, reset_seconds=0.2)
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+    time.sleep(0.25)
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only one trial call at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    # A failed trial opens it again right away
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.25)
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.allow()
+
+
+def test_open_circuit_fails_fast(breaker):
+    policy = RetryPolicy(max_attempts=2, base_delay=0.01, max_delay=0.01,
+                         deadline=10, timeout=0.5)
+    with StubServer({"/": failing([503] * 10)}) as server:
+        with pytest.raises(urllib.error.HTTPError):
+            call(breaker.endpoint, fetch(server.url + "/"), policy)
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            call(breaker.endpoint, fetch(server.url + "/"), policy)
+        assert server.request_count == 2
+
+        # The trial call after the reset closes it again once the server is back
+        time.sleep(0.25)
+        server.route("/", failing([]))
+        assert call(breaker.endpoint, fetch(server.url + "/"), policy) == {"ok": True}
+        assert breaker.state == CircuitBreaker.CLOSED
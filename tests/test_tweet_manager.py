@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+"""
+TweetManager.get_tweets() with a fake twitter client, so no api keys or
+requests to twitter are needed.
+"""
+
+import threading
+
+import pytest
+
+pytest.importorskip("twitter")
+
+from data_collection.cryptocurrency import Cryptocurrency
+from data_collection.tweet_manager import TweetManager
+
+
+class FakeSearch:
+    """Stands in for Twitter().search, the searches of failing fail"""
+
+    def __init__(self, failing: set):
+        self.failing = failing
+        self.queries = list()
+        self._lock = threading.Lock()
+
+
+    def tweets(self, q: str, **kwargs):
+        with self._lock:
+            self.queries.append(q.strip())
+        if q.strip() in self.failing:
+            raise ValueError("search of {0} failed".format(q.strip()))
+        return {"statuses": []}
+
+
+class FakeTwitter:
+    def __init__(self, failing=()):
+        self.search = FakeSearch(set(failing))
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(TweetManager, "SECONDS_PER_ITERATION", 0)
+    coins = [Cryptocurrency("bitcoin", "btc"), Cryptocurrency("ripple", "xrp")]
+    manager = TweetManager(coins, num_threads=2, api_manager=object())
+    manager._twitter = FakeTwitter(failing=["ripple"])
+    return manager
+
+
+def test_skips_coins_that_fail_twice(manager):
+    rounds = list()
+    # 3 search rounds of 200 tweets
+    manager.get_tweets(num_tweets_per_coin=600,
+                       on_batch=lambda coin, round, tweets: rounds.append((coin, round)))
+
+    queries = manager._twitter.search.queries
+    assert queries.count("ripple") == TweetManager.MAX_COIN_FAILURES
+    assert queries.count("bitcoin") == 3
+    assert sorted(rounds) == [("bitcoin", 0), ("bitcoin", 1), ("bitcoin", 2)]
+    failures, message = manager.failed_coins["ripple"]
+    assert failures == TweetManager.MAX_COIN_FAILURES
+    assert "ripple" in message
+    assert manager._skipped_coins() == ["ripple"]
+
+
+def test_a_success_resets_the_failures(manager):
+    search = manager._twitter.search
+    original = search.tweets
+    calls = {"ripple": 0}
+
+    def flaky(q, **kwargs):
+        # Ripple fails every other round, never twice in a row
+        if q.strip() == "ripple":
+            calls["ripple"] += 1
+            if calls["ripple"] % 2:
+                raise ValueError("search of ripple failed")
+            return {"statuses": []}
+        return original(q, **kwargs)
+
+    search.tweets = flaky
+    manager.get_tweets(num_tweets_per_coin=800, on_batch=lambda *args: None)
+    assert manager._skipped_coins() == []
+    assert "ripple" not in manager.failed_coins